@@ -9,6 +9,7 @@ from . import mast
 from . import plotting
 from . import psf
 from . import pyklippipeline
+from . import scheduler
 from . import utils
 
 from ._version import *
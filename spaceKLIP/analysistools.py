@@ -438,13 +438,13 @@ class AnalysisTools():
                 if date is not None:
                     if date == 'auto':
                         date = pyfits.getheader(self.database.obs[key]['FITSFILE'][ww_sci[0]], 0)['DATE-BEG']
-                offsetpsf_func = JWST_PSF(inst,
-                                          filt,
-                                          image_mask,
-                                          fov_pix=65,
-                                          sp=sed,
-                                          use_coeff=False,
-                                          date=date)
+                offsetpsf_func = JWST_PSF.get(inst,
+                                              filt,
+                                              image_mask,
+                                              fov_pix=65,
+                                              sp=sed,
+                                              use_coeff=False,
+                                              date=date)
                 
                 # Loop through companions.
                 tab = Table(names=('ID',
@@ -513,17 +513,15 @@ class AnalysisTools():
                     # model PSFs are defined by the offset between the
                     # coronagraphic mask center and the companion. Hence, we
                     # need to generate a separate model PSF for each roll.
-                    rot_offsetpsfs = []
-                    sci_totinttime = []
-                    all_offsetpsfs = []
-                    all_pas = []
+                    sim_seps = []
+                    sim_pas = []
                     for ww in ww_sci:
                         roll_ref = self.database.obs[key]['ROLL_REF'][ww]  # deg
                         
                         # Get shift between star and coronagraphic mask
                         # position. If positive, the coronagraphic mask center
                         # is to the left/bottom of the star position.
-                        _, _, _, _, _, _, _, maskoffs = ut.read_obs(self.database.obs[key]['FITSFILE'][ww])
+                        maskoffs = ut.read_ext(self.database.obs[key]['FITSFILE'][ww], 'MASKOFFS')
                         
                         # NIRCam.
                         if maskoffs is not None:
@@ -551,17 +549,25 @@ class AnalysisTools():
                         else:
                             sim_sep = np.sqrt(guess_dx**2 + guess_dy**2) * pxsc_arcsec  # arcsec
                             sim_pa = np.rad2deg(np.arctan2(guess_dx, guess_dy))  # deg
-                        
-                        
-                        # Generate offset PSF for this roll angle. Do not add
-                        # the V3Yidl angle as it has already been added to the
-                        # roll angle by spaceKLIP.
-                        offsetpsf = offsetpsf_func.gen_psf([sim_sep, sim_pa],
-                                                           mode='rth',
-                                                           PA_V3=roll_ref,
-                                                           do_shift=False,
-                                                           quick=False,
-                                                           addV3Yidl=False)
+                        sim_seps += [sim_sep]
+                        sim_pas += [sim_pa]
+                    
+                    # Generate offset PSFs for all roll angles at once. Do not
+                    # add the V3Yidl angle as it has already been added to the
+                    # roll angle by spaceKLIP.
+                    offsetpsfs = offsetpsf_func.gen_psf([np.array(sim_seps), np.array(sim_pas)],
+                                                        mode='rth',
+                                                        PA_V3=np.array(self.database.obs[key]['ROLL_REF'][ww_sci]),
+                                                        do_shift=False,
+                                                        quick=False,
+                                                        addV3Yidl=False)
+                    rot_offsetpsfs = []
+                    sci_totinttime = []
+                    all_offsetpsfs = []
+                    all_pas = []
+                    for index, ww in enumerate(ww_sci):
+                        roll_ref = self.database.obs[key]['ROLL_REF'][ww]  # deg
+                        offsetpsf = offsetpsfs[index].copy()
                         
                         # Coronagraphic mask throughput is not incorporated
                         # into the flux calibration of the JWST pipeline so
@@ -122,7 +122,7 @@ def run_obs(database,
             ref_erro = [np.concatenate(ref_erro)]
             ref_pxdq = [np.concatenate(ref_pxdq)]
         for dpos in range(len(ref_data)):
-            ref_data_temp = np.nanmedian(ref_data[dpos], axis=0)
+            ref_data_temp = ut.temporal_median(ref_data[dpos])
             nsample = np.sum(np.logical_not(np.isnan(ref_erro[dpos])), axis=0)
             ref_erro_temp = np.true_divide(np.sqrt(np.nansum(ref_erro[dpos]**2, axis=0)), nsample)
             if database.obs[key]['TELESCOP'][ww_ref[0]] == 'JWST' and database.obs[key]['INSTRUME'][ww_ref[0]] == 'NIRCAM':
@@ -151,7 +151,7 @@ def run_obs(database,
                 #     raise UserWarning('This routine does not work with nans')
                 
                 # Compute median science.
-                data = np.nanmedian(data, axis=0)
+                data = ut.temporal_median(data)
                 nsample = np.sum(np.logical_not(np.isnan(erro)), axis=0)
                 erro = np.true_divide(np.sqrt(np.nansum(erro**2, axis=0)), nsample)
                 if database.obs[key]['TELESCOP'][j] == 'JWST' and database.obs[key]['INSTRUME'][j] == 'NIRCAM':
@@ -266,7 +266,7 @@ def run_obs(database,
             sci_data = np.array(sci_data)
             sci_erro = np.array(sci_erro)
             sci_pxdq = np.array(sci_pxdq)
-            sci_data = np.nanmedian(sci_data, axis=0)
+            sci_data = ut.temporal_median(sci_data)
             nsample = np.sum(np.logical_not(np.isnan(sci_erro)), axis=0)
             sci_erro = np.true_divide(np.sqrt(np.nansum(sci_erro**2, axis=0)), nsample)
             if database.obs[key]['TELESCOP'][ww_sci[0]] == 'JWST' and database.obs[key]['INSTRUME'][ww_sci[0]] == 'NIRCAM':
@@ -8,16 +8,20 @@ matplotlib.rcParams.update({'font.size': 14})
 # IMPORTS
 # =============================================================================
 
+import functools
 import os
 import pdb
+import resource
 import sys
 
 import astropy.io.fits as pyfits
 import matplotlib.pyplot as plt
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor
 from jwst.datamodels import dqflags, RampModel
 from jwst.pipeline import Detector1Pipeline, Image2Pipeline, Coron3Pipeline
+from scipy.stats import sigmaclip
 
 import logging
 log = logging.getLogger(__name__)
@@ -63,18 +67,24 @@ class Coron1Pipeline_spaceKLIP(Detector1Pipeline):
         self.refpix.ncol_off = 0
         self.ramp_fit.save_calibrated_ramp = False
         
+        # Set number of integrations per chunk for the integration-chunked
+        # mode. If None, all integrations are processed at once.
+        self.chunk_nints = None
+        
         pass
     
     def process(self,
                 input):
         """
         Process an input JWST datamodel with the spaceKLIP JWST stage 1
-        pipeline.
+        pipeline. If the chunk_nints attribute is set and the input is a FITS
+        file with more integrations, the steps before the jump detection are
+        run in chunks of chunk_nints integrations, see process_chunked.
         
         Parameters
         ----------
-        input : jwst.datamodel
-            Input JWST datamodel to be processed.
+        input : jwst.datamodel or path
+            Input JWST datamodel or FITS file to be processed.
         
         Returns
         -------
@@ -83,33 +93,85 @@ class Coron1Pipeline_spaceKLIP(Detector1Pipeline):
         
         """
         
-        # Open input as ramp model.
-        input = RampModel(input)
+        # Run integration-chunked steps or open input as ramp model.
+        if self.chunk_nints is not None and isinstance(input, str) and pyfits.getheader(input, 'SCI')['NAXIS4'] > self.chunk_nints:
+            input, istep = self.process_chunked(input)
+        else:
+            input, istep = RampModel(input), 0
+        
+        # Process ramp.
+        input, ints_model = self.process_ramp(input, istep=istep)
+        if ints_model is not None and self.save_results:
+            self.save_model(ints_model, suffix='rateints')
+        
+        # Setup output file.
+        self.setup_output(input)
+        
+        return input
+    
+    def get_sequence(self,
+                     instrument):
+        """
+        Get the spaceKLIP JWST stage 1 step sequence before the jump
+        detection.
+        
+        Parameters
+        ----------
+        instrument : str
+            Name of the JWST instrument.
+        
+        Returns
+        -------
+        sequence : list of tuple
+            List of (step name, function) tuples. Each function takes the
+            input JWST datamodel and returns the output JWST datamodel.
+        
+        """
         
         # Process MIR & NIR exposures differently.
-        instrument = input.meta.instrument.name
         if instrument == 'MIRI':
-            input = self.run_step(self.group_scale, input)
-            input = self.run_step(self.dq_init, input)
-            input = self.run_step(self.saturation, input)
-            input = self.run_step(self.ipc, input)
-            input = self.run_step(self.firstframe, input)
-            input = self.run_step(self.lastframe, input)
-            input = self.run_step(self.reset, input)
-            input = self.run_step(self.linearity, input)
-            input = self.run_step(self.rscd, input)
-            input = self.run_step(self.dark_current, input)
-            input = self.do_refpix(input)
+            names = ['group_scale', 'dq_init', 'saturation', 'ipc', 'firstframe', 'lastframe', 'reset', 'linearity', 'rscd', 'dark_current', 'refpix']
         else:
-            input = self.run_step(self.group_scale, input)
-            input = self.run_step(self.dq_init, input)
-            input = self.do_saturation(input)
-            input = self.run_step(self.ipc, input)
-            input = self.run_step(self.superbias, input)
-            input = self.do_refpix(input)
-            input = self.run_step(self.linearity, input)
-            input = self.run_step(self.persistence, input)
-            input = self.run_step(self.dark_current, input)
+            names = ['group_scale', 'dq_init', 'saturation', 'ipc', 'superbias', 'refpix', 'linearity', 'persistence', 'dark_current']
+        sequence = []
+        for name in names:
+            if name == 'saturation' and instrument != 'MIRI':
+                func = self.do_saturation
+            elif name == 'refpix':
+                func = self.do_refpix
+            else:
+                func = functools.partial(self.run_step, getattr(self, name))
+            sequence += [(name, func)]
+        
+        return sequence
+    
+    def process_ramp(self,
+                     input,
+                     istep=0):
+        """
+        Run the spaceKLIP JWST stage 1 step sequence on a ramp model.
+        
+        Parameters
+        ----------
+        input : jwst.datamodels.RampModel
+            Input JWST ramp model to be processed.
+        istep : int, optional
+            Index of the first step of the step sequence returned by
+            get_sequence which shall be run. The previous steps must have been
+            run on the input already. The default is 0.
+        
+        Returns
+        -------
+        input : jwst.datamodel
+            Output JWST rate datamodel.
+        ints_model : jwst.datamodel
+            Output JWST rateints datamodel.
+        
+        """
+        
+        # Run steps before jump detection.
+        for name, func in self.get_sequence(input.meta.instrument.name)[istep:]:
+            input = func(input)
         input = self.run_step(self.jump, input)
         
         # Save calibrated ramp data.
@@ -127,13 +189,122 @@ class Coron1Pipeline_spaceKLIP(Detector1Pipeline):
         if ints_model is not None:
             self.gain_scale.suffix = 'rateints'
             ints_model = self.run_step(self.gain_scale, ints_model, save_results=False)
-            if self.save_results:
-                self.save_model(ints_model, suffix='rateints')
         
-        # Setup output file.
-        self.setup_output(input)
+        return input, ints_model
+    
+    def process_chunked(self,
+                        input):
+        """
+        Run the leading steps of the spaceKLIP JWST stage 1 step sequence on
+        an input FITS file in chunks of chunk_nints integrations. Each chunk
+        is read from the FITS file as if it was an exposure segment, so that
+        the peak memory of these steps is proportional to the chunk size. The
+        chunks are then stitched together into a ramp model of all
+        integrations on which process_ramp runs the remaining steps.
+        
+        Only steps which process each integration independently of the other
+        integrations and which do not save their products are run chunked.
+        The jump detection, which can compare integrations, and the ramp
+        fitting, whose Poisson variance is based on the median rate of all
+        integrations, always see the full ramp, so that the output is
+        identical to the unchunked processing. The overall peak memory is
+        therefore still set by the full ramp and the copies made by the jump
+        detection, only the leading steps are bounded by the chunk size.
         
-        return input
+        Parameters
+        ----------
+        input : path
+            Input FITS file to be processed.
+        
+        Returns
+        -------
+        output : jwst.datamodels.RampModel
+            Output JWST ramp model of all integrations.
+        istep : int
+            Index of the first step of the step sequence returned by
+            get_sequence which has not been run yet.
+        
+        """
+        
+        # Find the leading steps which can be run integration-chunked.
+        # Skipped steps do not modify the data.
+        instrument = pyfits.getheader(input, 0)['INSTRUME']
+        if instrument == 'MIRI':
+            chunk_steps = ['group_scale', 'dq_init', 'saturation', 'ipc', 'firstframe', 'lastframe']
+        else:
+            chunk_steps = ['group_scale', 'dq_init', 'saturation', 'ipc', 'superbias', 'refpix', 'linearity', 'dark_current']
+        sequence = self.get_sequence(instrument)
+        istep = 0
+        for name, func in sequence:
+            step_obj = getattr(self, name)
+            if not step_obj.skip and (name not in chunk_steps or step_obj.save_results):
+                break
+            istep += 1
+        if istep == 0:
+            log.info('  --> Coron1Pipeline: no step can be run integration-chunked')
+            return RampModel(input), istep
+        
+        # Loop through chunks of integrations.
+        drifts = []
+        with pyfits.open(input, memmap=False) as hdul:
+            nints = hdul['SCI'].header['NAXIS4']
+            intstart = hdul[0].header.get('INTSTART', 1)
+            for i0 in range(0, nints, self.chunk_nints):
+                i1 = min(i0 + self.chunk_nints, nints)
+                log.info('  --> Coron1Pipeline: processing integrations %.0f-%.0f of %.0f' % (i0 + 1, i1, nints))
+                
+                # Read chunk as exposure segment. Only the required part of
+                # the FITS file is read through the HDU sections, which also
+                # apply the data scaling of the raw data.
+                chunk = pyfits.HDUList()
+                for hdu in hdul:
+                    if isinstance(hdu, pyfits.ImageHDU) and hdu.header['NAXIS'] >= 3 and hdu.header['NAXIS%.0f' % hdu.header['NAXIS']] == nints:
+                        chunk.append(pyfits.ImageHDU(hdu.section[i0:i1], header=hdu.header))
+                    elif isinstance(hdu, pyfits.BinTableHDU) and 'integration_number' in hdu.columns.names:
+                        ww = (hdu.data['integration_number'] >= intstart + i0) & (hdu.data['integration_number'] < intstart + i1)
+                        chunk.append(pyfits.BinTableHDU(hdu.data[ww], header=hdu.header))
+                    else:
+                        chunk.append(hdu.copy())
+                chunk[0].header['INTSTART'] = intstart + i0
+                chunk[0].header['INTEND'] = intstart + i1 - 1
+                
+                # Run chunked steps.
+                res = RampModel(chunk)
+                del chunk
+                self.refpix_drifts = None
+                for name, func in sequence[:istep]:
+                    res = func(res)
+                if self.refpix_drifts is not None:
+                    drifts += [self.refpix_drifts]
+                
+                # Copy chunk into ramp of all integrations. The pixel DQ
+                # array is the same for all chunks.
+                if i0 == 0:
+                    output = res
+                    arrays = {}
+                    for ext in ['data', 'groupdq', 'err', 'zeroframe']:
+                        if ext in res.instance:
+                            arrays[ext] = np.empty((nints,) + getattr(res, ext).shape[1:], dtype=getattr(res, ext).dtype)
+                    tables = {ext: [] for ext in ['group', 'int_times'] if ext in res.instance}
+                    pixeldq = res.pixeldq.copy()
+                for ext in arrays.keys():
+                    arrays[ext][i0:i1] = getattr(res, ext)
+                for ext in tables.keys():
+                    tables[ext] += [getattr(res, ext)]
+                pixeldq |= res.pixeldq
+                del res
+        
+        # Stitch chunks.
+        for ext in arrays.keys():
+            setattr(output, ext, arrays[ext])
+        for ext in tables.keys():
+            setattr(output, ext, np.concatenate(tables[ext]))
+        output.pixeldq = pixeldq
+        output.meta.exposure.integration_start = intstart
+        output.meta.exposure.integration_end = intstart + nints - 1
+        self.refpix_drifts = np.concatenate(drifts) if len(drifts) != 0 else None
+        
+        return output, istep
     
     def run_step(self,
                  step_obj,
@@ -225,31 +396,13 @@ class Coron1Pipeline_spaceKLIP(Detector1Pipeline):
         if self.saturation.grow_diagonal or npix_grow == 0:
             return self.run_step(self.saturation, input, **kwargs)
         
-        # Run step with 1 fewer growth.
+        # Run step with 1 fewer growth and restore original step parameter.
         self.saturation.n_pix_grow_sat = npix_grow - 1
         res = self.run_step(self.saturation, input, **kwargs)
+        self.saturation.n_pix_grow_sat = npix_grow
         
-        # Get saturated pixels and flag 4 neighbors.
-        mask_sat = res.groupdq & dqflags.pixel['SATURATED'] == dqflags.pixel['SATURATED']
-        mask_vp1 = np.roll(mask_sat, +1, axis=-2)
-        mask_vm1 = np.roll(mask_sat, -1, axis=-2)
-        mask_hp1 = np.roll(mask_sat, +1, axis=-1)
-        mask_hm1 = np.roll(mask_sat, -1, axis=-1)
-        
-        # Ignore pixels which rolled around array border.
-        mask_vp1[:, :,  0, :] = 0
-        mask_vm1[:, :, -1, :] = 0
-        mask_hp1[:, :, :,  0] = 0
-        mask_hm1[:, :, :, -1] = 0
-        
-        # Combine saturation masks.
-        mask_sat = mask_sat | mask_vp1 | mask_vm1 | mask_hp1 | mask_hm1
-        
-        # Flag saturated pixels.
-        res.groupdq = res.groupdq | (mask_sat * dqflags.pixel['SATURATED'])
-        
-        # Delete unused masks.
-        del mask_vp1, mask_vm1, mask_hp1, mask_hm1
+        # Flag 4 neighbors of saturated pixels.
+        _grow_saturation(res.groupdq, dqflags.pixel['SATURATED'])
         
         return res
     
@@ -294,9 +447,20 @@ class Coron1Pipeline_spaceKLIP(Detector1Pipeline):
                          input,
                          **kwargs):
         """
-        Do a pseudo reference pixel correction. Therefore, flag the requested
-        edge rows and columns as reference pixels, run the JWST stage 1 refpix
-        step, and unflag the pseudo reference pixels again.
+        Do a pseudo reference pixel correction. Therefore, treat the requested
+        edge rows and columns as reference pixels and subtract their sigma-
+        clipped mean from each group, separately for even and odd columns if
+        the 'odd_even_columns' parameter of the JWST stage 1 refpix step is
+        True. Like in the JWST stage 1 refpix step, the reference pixels are
+        clipped at 3 sigma. This is the subarray reference pixel correction of the JWST
+        stage 1 refpix step, but it is streamed one group at a time through
+        views of the ramp and leaves the pixel DQ array untouched. The drifts
+        subtracted from each group are stored in the refpix_drifts attribute
+        of the pipeline.
+        
+        For MIRI and multi-output exposures, flag the requested edge rows and
+        columns as reference pixels, run the JWST stage 1 refpix step, and
+        unflag the pseudo reference pixels again.
         
         Parameters
         ----------
@@ -319,42 +483,235 @@ class Coron1Pipeline_spaceKLIP(Detector1Pipeline):
         nright = self.refpix.nright
         nrow_off = self.refpix.nrow_off
         ncol_off = self.refpix.ncol_off
-        nupper_off = -nrow_off if nrow_off != 0 else None
-        nright_off = -ncol_off if ncol_off != 0 else None
-        
-        # Flag custom reference pixel rows & columns.
-        self.refpix.log.info(f'Flagging [{nlower}, {nupper}] references rows at [bottom, top] of array')
-        self.refpix.log.info(f'Flagging [{nleft}, {nright}] references columns at [left, right] of array')
-        input.pixeldq[nrow_off:nrow_off + nlower, ncol_off:nright_off] = input.pixeldq[nrow_off:nrow_off + nlower, ncol_off:nright_off] | dqflags.pixel['REFERENCE_PIXEL']
-        input.pixeldq[-nrow_off - nupper:nupper_off, ncol_off:nright_off] = input.pixeldq[-nrow_off - nupper:nupper_off, ncol_off:nright_off] | dqflags.pixel['REFERENCE_PIXEL']
-        input.pixeldq[nrow_off:nupper_off, ncol_off:ncol_off + nleft] = input.pixeldq[nrow_off:nupper_off, ncol_off:ncol_off + nleft] | dqflags.pixel['REFERENCE_PIXEL']
-        input.pixeldq[nrow_off:nupper_off, -ncol_off - nright:nright_off] = input.pixeldq[nrow_off:nupper_off, -ncol_off - nright:nright_off] | dqflags.pixel['REFERENCE_PIXEL']
-        
-        # Save original step parameter.
-        use_side_orig = self.refpix.use_side_ref_pixels
-        if nleft + nright == 0:
-            self.refpix.use_side_ref_pixels = False
+        ny, nx = input.pixeldq.shape
+        edges = [np.s_[nrow_off:nrow_off + nlower, ncol_off:nx - ncol_off],
+                 np.s_[ny - nrow_off - nupper:ny - nrow_off, ncol_off:nx - ncol_off],
+                 np.s_[nrow_off:ny - nrow_off, ncol_off:ncol_off + nleft],
+                 np.s_[nrow_off:ny - nrow_off, nx - ncol_off - nright:nx - ncol_off]]
+        
+        # Run JWST stage 1 refpix step for MIRI and multi-output exposures.
+        self.refpix_drifts = None
+        if self.refpix.skip or input.meta.instrument.name == 'MIRI' or input.meta.exposure.noutputs != 1:
+            
+            # Flag custom reference pixel rows & columns.
+            self.refpix.log.info(f'Flagging [{nlower}, {nupper}] references rows at [bottom, top] of array')
+            self.refpix.log.info(f'Flagging [{nleft}, {nright}] references columns at [left, right] of array')
+            for edge in edges:
+                input.pixeldq[edge] = input.pixeldq[edge] | dqflags.pixel['REFERENCE_PIXEL']
+            
+            # Save original step parameter.
+            use_side_orig = self.refpix.use_side_ref_pixels
+            if nleft + nright == 0:
+                self.refpix.use_side_ref_pixels = False
+            else:
+                self.refpix.use_side_ref_pixels = True
+            
+            # Run step with custom reference pixel rows & columns.
+            res = self.run_step(self.refpix, input, **kwargs)
+            
+            # Apply original step parameter.
+            self.refpix.use_side_ref_pixels = use_side_orig
+            
+            # Unflag custom reference pixel rows & columns.
+            self.refpix.log.info('Removing custom reference pixel flags')
+            for edge in edges:
+                res.pixeldq[edge] = res.pixeldq[edge] & ~dqflags.pixel['REFERENCE_PIXEL']
+            
+            return res
+        
+        # Get custom and existing reference pixels which are not flagged as
+        # do not use.
+        self.refpix.log.info(f'Using [{nlower}, {nupper}] references rows at [bottom, top] of array')
+        self.refpix.log.info(f'Using [{nleft}, {nright}] references columns at [left, right] of array')
+        pixeldq = input.pixeldq
+        mask_ref = pixeldq & dqflags.pixel['REFERENCE_PIXEL'] != 0
+        for edge in edges:
+            mask_ref[edge] = True
+        mask_ref &= pixeldq & dqflags.pixel['DO_NOT_USE'] == 0
+        
+        # Split reference pixels into even and odd columns. The parity of the
+        # columns is the same in science and detector orientation up to a
+        # swap, so that the same pixels are grouped together.
+        if self.refpix.odd_even_columns:
+            mask_ref = [mask_ref.copy(), mask_ref]
+            mask_ref[0][:, 1::2] = False
+            mask_ref[1][:, 0::2] = False
+            slices = [np.s_[:, 0::2], np.s_[:, 1::2]]
         else:
-            self.refpix.use_side_ref_pixels = True
-        
-        # Run step with custom reference pixel rows & columns.
-        res = self.run_step(self.refpix, input, **kwargs)
+            mask_ref = [mask_ref]
+            slices = [np.s_[:, :]]
+        ww_ref = [np.nonzero(mask) for mask in mask_ref]
+        
+        # Subtract reference pixel drifts from each group in place.
+        frames = [input.data[i, j] for i in range(input.data.shape[0]) for j in range(input.data.shape[1])]
+        if input.meta.exposure.zero_frame:
+            frames += [input.zeroframe[i] for i in range(input.zeroframe.shape[0])]
+        drifts = np.full((len(frames), len(slices)), np.nan)
+        for k, frame in enumerate(frames):
+            for l in range(len(slices)):
+                if len(ww_ref[l][0]) != 0:
+                    vals = frame[ww_ref[l]]
+                    if np.std(vals, dtype=np.float64) != 0.:
+                        drifts[k, l] = sigmaclip(vals, 3., 3.)[0].mean()
+                    else:
+                        drifts[k, l] = vals.mean(dtype=np.float64)
+            if np.all(np.isfinite(drifts[k])):
+                for l in range(len(slices)):
+                    frame[slices[l]] -= drifts[k, l]
+        ngroups = input.data.shape[0] * input.data.shape[1]
+        self.refpix_drifts = drifts[:ngroups].reshape(input.data.shape[:2] + (len(slices),))
+        self.refpix.log.info('Reference pixel drifts: median = ' + str(np.nanmedian(self.refpix_drifts, axis=(0, 1))) + ', std = ' + str(np.nanstd(self.refpix_drifts, axis=(0, 1))))
+        res = input
+        res.meta.cal_step.refpix = 'COMPLETE'
         
-        # Apply original step parameter.
-        self.refpix.use_side_ref_pixels = use_side_orig
-        
-        # Unflag custom reference pixel rows & columns.
-        self.refpix.log.info('Removing custom reference pixel flags')
-        res.pixeldq[nrow_off:nrow_off + nlower, ncol_off:nright_off] = res.pixeldq[nrow_off:nrow_off + nlower, ncol_off:nright_off] & ~dqflags.pixel['REFERENCE_PIXEL']
-        res.pixeldq[-nrow_off - nupper:nupper_off, ncol_off:nright_off] = res.pixeldq[-nrow_off - nupper:nupper_off, ncol_off:nright_off] & ~dqflags.pixel['REFERENCE_PIXEL']
-        res.pixeldq[nrow_off:nupper_off, ncol_off:ncol_off + nleft] = res.pixeldq[nrow_off:nupper_off, ncol_off:ncol_off + nleft] & ~dqflags.pixel['REFERENCE_PIXEL']
-        res.pixeldq[nrow_off:nupper_off, -ncol_off - nright:nright_off] = res.pixeldq[nrow_off:nupper_off, -ncol_off - nright:nright_off] & ~dqflags.pixel['REFERENCE_PIXEL']
+        # Save results.
+        if self.refpix.save_results:
+            self.refpix.output_dir = self.output_dir
+            self.save_model(res, suffix=self.refpix.suffix)
         
         return res
 
+def _grow_saturation(groupdq,
+                     sat):
+    """
+    Flag the 4 neighbors of saturated pixels in place. This is done one
+    integration at a time, so that only a single saturation mask of shape
+    (ngroups, ny, nx) is held in memory. The mask is computed before
+    flagging, so that the growth does not propagate.
+    
+    Parameters
+    ----------
+    groupdq : 4D-array
+        Group DQ array of shape (nints, ngroups, ny, nx). Will be updated by
+        the routine.
+    sat : int
+        Saturation DQ flag.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    
+    # Flag 4 neighbors of saturated pixels.
+    for k in range(groupdq.shape[0]):
+        dq = groupdq[k]
+        mask_sat = dq & sat == sat
+        np.bitwise_or(dq[:, 1:, :], sat, out=dq[:, 1:, :], where=mask_sat[:, :-1, :])
+        np.bitwise_or(dq[:, :-1, :], sat, out=dq[:, :-1, :], where=mask_sat[:, 1:, :])
+        np.bitwise_or(dq[:, :, 1:], sat, out=dq[:, :, 1:], where=mask_sat[:, :, :-1])
+        np.bitwise_or(dq[:, :, :-1], sat, out=dq[:, :, :-1], where=mask_sat[:, :, 1:])
+    
+    pass
+
+def _init_worker(maxmem):
+    """
+    Initialize a worker process of the parallel JWST stage 1 detector
+    pipeline by limiting its address space.
+    
+    Parameters
+    ----------
+    maxmem : int or None
+        Maximum memory (bytes) that the worker process may allocate. If None,
+        the memory is not limited.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    
+    # Limit memory.
+    if maxmem is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            maxmem = min(maxmem, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (maxmem, hard))
+    
+    pass
+
+def fetch_references(fitspaths):
+    """
+    Fetch the CRDS reference files required by the JWST stage 1 detector
+    pipeline for a list of FITS files into the local CRDS cache, so that
+    worker processes do not download the same files concurrently.
+    
+    Parameters
+    ----------
+    fitspaths : list of paths
+        Absolute paths of the input FITS files.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    
+    # Fetch reference files.
+    pipeline = Coron1Pipeline_spaceKLIP()
+    for fitspath in fitspaths:
+        pipeline._precache_references(fitspath)
+    
+    pass
+
+def _run_file(fitspath,
+              output_dir,
+              steps,
+              chunk_nints=None):
+    """
+    Run the JWST stage 1 detector pipeline on a single FITS file.
+    
+    Parameters
+    ----------
+    fitspath : path
+        Absolute path of the input FITS file.
+    output_dir : path
+        Path of the directory where the data products shall be saved.
+    steps : dict
+        See run_obs.
+    chunk_nints : int, optional
+        See run_obs. The default is None.
+    
+    Returns
+    -------
+    fitsfile : path
+        Path of the output FITS file.
+    bunit : str
+        Data unit of the output FITS file.
+    
+    """
+    
+    # Initialize Coron1Pipeline.
+    pipeline = Coron1Pipeline_spaceKLIP(output_dir=output_dir)
+    pipeline.save_results = True
+    pipeline.chunk_nints = chunk_nints
+    
+    # Set step parameters.
+    for key1 in steps.keys():
+        for key2 in steps[key1].keys():
+            setattr(getattr(pipeline, key1), key2, steps[key1][key2])
+    
+    # Run Coron1Pipeline.
+    res = pipeline.run(fitspath)
+    if isinstance(res, list):
+        res = res[0]
+    
+    # Get output FITS file. The data unit is taken from the returned data
+    # model, so that the FITS file need not be reopened.
+    fitsfile = os.path.join(output_dir, res.meta.filename)
+    if fitsfile.endswith('rate.fits'):
+        if os.path.isfile(fitsfile.replace('rate.fits', 'rateints.fits')):
+            fitsfile = fitsfile.replace('rate.fits', 'rateints.fits')
+    
+    return fitsfile, res.meta.bunit_data
+
 def run_obs(database,
             steps={},
-            subdir='stage1'):
+            subdir='stage1',
+            n_jobs=1,
+            maxmem=None,
+            crds_path=None,
+            chunk_nints=None):
     """
     Run the JWST stage 1 detector pipeline on the input observations database.
     This customized implementation can:
@@ -394,6 +751,29 @@ def run_obs(database,
     subdir : str, optional
         Name of the directory where the data products shall be saved. The
         default is 'stage1'.
+    n_jobs : int, optional
+        Number of worker processes across which the FITS files shall be
+        spread. If -1, use all available CPUs. The database is always updated
+        in the order of the FITS files. The default is 1.
+    maxmem : int, optional
+        Maximum memory (bytes) that each worker process may allocate. A worker
+        exceeding it fails with a MemoryError instead of pushing the machine
+        into swap. Only used if n_jobs is not 1. If None, the memory is not
+        limited. The default is None.
+    crds_path : path, optional
+        Path of the local CRDS reference file cache shared by all worker
+        processes. If None, the CRDS_PATH environment variable is used. The
+        reference files of all FITS files are fetched into it before the
+        worker processes are started, so that they do not download the same
+        files concurrently. The default is None.
+    chunk_nints : int, optional
+        Run the steps before the jump detection in chunks of this many
+        integrations so that their intermediate products are proportional to
+        the chunk size, see Coron1Pipeline_spaceKLIP.process_chunked. This
+        does not lower the overall peak memory, because the chunks are
+        stitched into the full ramp on which the jump detection and the ramp
+        fitting run. Use maxmem to bound the memory of the worker processes.
+        If None, all integrations are processed at once. The default is None.
     
     Returns
     -------
@@ -406,41 +786,67 @@ def run_obs(database,
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    # Loop through concatenations.
+    # Set shared CRDS reference file cache.
+    if crds_path is not None:
+        os.environ['CRDS_PATH'] = os.path.abspath(crds_path)
+    
+    # Get number of worker processes.
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    
+    # Find stage 0 files.
+    todo = []
     for i, key in enumerate(database.obs.keys()):
-        log.info('--> Concatenation ' + key)
-        
-        # Loop through FITS files.
         nfitsfiles = len(database.obs[key])
         for j in range(nfitsfiles):
-            
-            # Skip non-stage 0 files.
-            head, tail = os.path.split(database.obs[key]['FITSFILE'][j])
-            if database.obs[key]['DATAMODL'][j] != 'STAGE0':
-                log.info('  --> Coron1Pipeline: skipping non-stage 0 file ' + tail)
-                continue
-            log.info('  --> Coron1Pipeline: processing ' + tail)
-            
-            # Initialize Coron1Pipeline.
-            pipeline = Coron1Pipeline_spaceKLIP(output_dir=output_dir)
-            pipeline.save_results = True
-            
-            # Set step parameters.
-            for key1 in steps.keys():
-                for key2 in steps[key1].keys():
-                    setattr(getattr(pipeline, key1), key2, steps[key1][key2])
-            
-            # Run Coron1Pipeline.
+            if database.obs[key]['DATAMODL'][j] == 'STAGE0':
+                todo += [(key, j)]
+    n_jobs = min(n_jobs, len(todo))
+    
+    # Fetch reference files of all stage 0 files.
+    futures = {}
+    if n_jobs > 1:
+        log.info('--> Coron1Pipeline: fetching reference files')
+        fetch_references([os.path.abspath(database.obs[key]['FITSFILE'][j]) for key, j in todo])
+        
+        # Submit all stage 0 files.
+        executor = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(maxmem,))
+        for key, j in todo:
             fitspath = os.path.abspath(database.obs[key]['FITSFILE'][j])
-            res = pipeline.run(fitspath)
-            if isinstance(res, list):
-                res = res[0]
+            futures[(key, j)] = executor.submit(_run_file, fitspath, output_dir, steps, chunk_nints)
+    
+    # Loop through concatenations.
+    try:
+        for i, key in enumerate(database.obs.keys()):
+            log.info('--> Concatenation ' + key)
             
-            # Update spaceKLIP database.
-            fitsfile = os.path.join(output_dir, res.meta.filename)
-            if fitsfile.endswith('rate.fits'):
-                if os.path.isfile(fitsfile.replace('rate.fits', 'rateints.fits')):
-                    fitsfile = fitsfile.replace('rate.fits', 'rateints.fits')
-            database.update_obs(key, j, fitsfile)
+            # Loop through FITS files.
+            nfitsfiles = len(database.obs[key])
+            for j in range(nfitsfiles):
+                
+                # Skip non-stage 0 files.
+                head, tail = os.path.split(database.obs[key]['FITSFILE'][j])
+                if database.obs[key]['DATAMODL'][j] != 'STAGE0':
+                    log.info('  --> Coron1Pipeline: skipping non-stage 0 file ' + tail)
+                    continue
+                log.info('  --> Coron1Pipeline: processing ' + tail)
+                
+                # Run Coron1Pipeline or collect the result of the worker
+                # process.
+                if (key, j) in futures:
+                    fitsfile, bunit = futures[(key, j)].result()
+                else:
+                    fitspath = os.path.abspath(database.obs[key]['FITSFILE'][j])
+                    fitsfile, bunit = _run_file(fitspath, output_dir, steps, chunk_nints)
+                
+                # Update spaceKLIP database.
+                database.update_obs(key, j, fitsfile, bunit=bunit)
+    finally:
+        if n_jobs > 1:
+            executor.shutdown(cancel_futures=True)
+    
+    # Save spaceKLIP database.
+    if database.autosave:
+        database.save()
     
     pass
@@ -20,6 +20,7 @@ from jwst import datamodels
 from jwst.associations.load_as_asn import LoadAsLevel2Asn
 from jwst.outlier_detection.outlier_detection_step import OutlierDetectionStep
 from jwst.pipeline import Detector1Pipeline, Image2Pipeline, Coron3Pipeline
+from stpipe import crds_client
 
 import logging
 log = logging.getLogger(__name__)
@@ -114,13 +115,97 @@ class Coron2Pipeline_spaceKLIP(Image2Pipeline):
         
         return all_res
 
+def _get_references(pipeline,
+                    fitspath):
+    """
+    Resolve the CRDS reference files of all steps of a spaceKLIP JWST stage 2
+    pipeline for an input FITS file with a single CRDS query. The reference
+    files are selected from the same parameters as by the steps themselves.
+    
+    Parameters
+    ----------
+    pipeline : Coron2Pipeline_spaceKLIP
+        SpaceKLIP JWST stage 2 pipeline whose step parameters are set.
+    fitspath : path
+        Absolute path of the input FITS file.
+    
+    Returns
+    -------
+    refs : dict
+        Dictionary of the reference files of all steps which are not skipped
+        and have not been overridden by the user. The keys are the tuples
+        (step name, reference file type).
+    
+    """
+    
+    # Get reference file types of all steps which are not skipped and have
+    # not been overridden by the user.
+    reftypes = []
+    for name in pipeline.step_defs.keys():
+        step = getattr(pipeline, name)
+        if step.skip:
+            continue
+        for reftype in step.reference_file_types:
+            if getattr(step, 'override_' + reftype, None) is None:
+                reftypes += [(name, reftype)]
+    
+    # Resolve reference files.
+    with datamodels.open(fitspath) as model:
+        paths = crds_client.get_multiple_reference_paths(model.get_crds_parameters(), sorted(set([reftype for name, reftype in reftypes])), model.crds_observatory)
+    refs = {}
+    for name, reftype in reftypes:
+        refs[(name, reftype)] = paths[reftype]
+    
+    return refs
+
+def _get_pipeline(output_dir,
+                  steps,
+                  refs={}):
+    """
+    Initialize a spaceKLIP JWST stage 2 pipeline. The provided reference
+    files are set as step overrides, so that the pipeline can be reused for
+    all FITS files with the same reference files.
+    
+    Parameters
+    ----------
+    output_dir : path
+        Path of the directory where the data products shall be saved.
+    steps : dict
+        See run_obs.
+    refs : dict, optional
+        Reference files of the steps, see _get_references. The default is {}.
+    
+    Returns
+    -------
+    pipeline : Coron2Pipeline_spaceKLIP
+        SpaceKLIP JWST stage 2 pipeline.
+    
+    """
+    
+    # Initialize Coron2Pipeline.
+    pipeline = Coron2Pipeline_spaceKLIP(output_dir=output_dir)
+    pipeline.save_results = True
+    
+    # Set step parameters.
+    for key1 in steps.keys():
+        for key2 in steps[key1].keys():
+            setattr(getattr(pipeline, key1), key2, steps[key1][key2])
+    
+    # Set reference files.
+    for (name, reftype), path in refs.items():
+        setattr(getattr(pipeline, name), 'override_' + reftype, path)
+    
+    return pipeline
+
 def run_obs(database,
             steps={},
             subdir='stage2'):
     """
     Run the JWST stage 2 image pipeline on the input observations database.
     This customized implementation will also run the 'outlier_detection' step
-    if not skipped.
+    if not skipped. The CRDS reference files of each FITS file are resolved
+    with a single CRDS query and one pipeline is initialized per set of
+    reference files and reused for all FITS files which share it.
     
     Parameters
     ----------
@@ -149,6 +234,8 @@ def run_obs(database,
         os.makedirs(output_dir)
     
     # Loop through concatenations.
+    template = _get_pipeline(output_dir, steps)
+    pipelines = {}
     for i, key in enumerate(database.obs.keys()):
         log.info('--> Concatenation ' + key)
         
@@ -163,26 +250,32 @@ def run_obs(database,
                 continue
             log.info('  --> Coron2Pipeline: processing ' + tail)
             
-            # Initialize Coron2Pipeline.
-            pipeline = Coron2Pipeline_spaceKLIP(output_dir=output_dir)
-            pipeline.save_results = True
-            
-            # Set step parameters.
-            for key1 in steps.keys():
-                for key2 in steps[key1].keys():
-                    setattr(getattr(pipeline, key1), key2, steps[key1][key2])
+            # Get Coron2Pipeline of the reference files of the FITS file.
+            # The pipelines are reused across all FITS files with the same
+            # reference files.
+            fitspath = os.path.abspath(database.obs[key]['FITSFILE'][j])
+            refs = _get_references(template, fitspath)
+            refkey = tuple(sorted(refs.items()))
+            if refkey not in pipelines.keys():
+                pipelines[refkey] = _get_pipeline(output_dir, steps, refs)
+            pipeline = pipelines[refkey]
+            pipeline.output_file = None
             
             # Run Coron2Pipeline.
-            fitspath = os.path.abspath(database.obs[key]['FITSFILE'][j])
             res = pipeline.run(fitspath)
             if isinstance(res, list):
                 res = res[0]
             
-            # Update spaceKLIP database.
+            # Update spaceKLIP database. The data unit is taken from the
+            # returned data model, so that the FITS file need not be reopened.
             fitsfile = os.path.join(output_dir, res.meta.filename)
             if fitsfile.endswith('cal.fits'):
                 if os.path.isfile(fitsfile.replace('cal.fits', 'calints.fits')):
                     fitsfile = fitsfile.replace('cal.fits', 'calints.fits')
-            database.update_obs(key, j, fitsfile)
+            database.update_obs(key, j, fitsfile, bunit=res.meta.bunit_data)
+    
+    # Save spaceKLIP database.
+    if database.autosave:
+        database.save()
     
     pass
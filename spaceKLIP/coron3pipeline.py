@@ -16,6 +16,9 @@ import astropy.io.fits as pyfits
 import matplotlib.pyplot as plt
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor
+from jwst.associations import asn_from_list
+from jwst.associations.lib.rules_level3_base import DMS_Level3_Base
 from jwst.pipeline import Detector1Pipeline, Image2Pipeline, Coron3Pipeline
 from spaceKLIP.psf import get_transmission
 
@@ -33,11 +36,85 @@ class Coron3Pipeline_spaceKLIP(Coron3Pipeline):
     The spaceKLIP JWST stage 3 pipeline class.
     
     """
+    
+    def save_model(self,
+                   model,
+                   suffix=None,
+                   **kwargs):
+        """
+        Save a data product of the pipeline. The number of KL modes is added
+        to the primary header of the i2d product so that it does not need to
+        be reopened and rewritten afterwards.
+        
+        Parameters
+        ----------
+        model : jwst.datamodel
+            Data model to be saved.
+        suffix : str, optional
+            Suffix of the data product. The default is None.
+        **kwargs : keyword arguments
+            Keyword arguments for stpipe.Step.save_model.
+        
+        Returns
+        -------
+        output_paths : list of path
+            Paths of the saved data products.
+        
+        """
+        
+        # Add extra header keywords.
+        if suffix == 'i2d':
+            extra_fits = model.instance.setdefault('extra_fits', {})
+            header = extra_fits.setdefault('PRIMARY', {}).setdefault('header', [])
+            header += [['KLMODE0', self.klip.truncate, 'Number of KL modes']]
+        
+        return super(Coron3Pipeline_spaceKLIP, self).save_model(model, suffix=suffix, **kwargs)
 
+def _run_asn(asn,
+             output_dir,
+             steps):
+    """
+    Run the JWST stage 3 coronagraphy pipeline on a single concatenation.
+    This function is called by run_obs, either directly or in a worker
+    process.
+    
+    Parameters
+    ----------
+    asn : jwst.associations.Association
+        Association of the concatenation, see make_asn.
+    output_dir : path
+        Path of the directory where the data products shall be saved.
+    steps : dict
+        See run_obs.
+    
+    Returns
+    -------
+    datapath : path
+        Path of the i2d product.
+    
+    """
+    
+    # Initialize Coron3Pipeline.
+    pipeline = Coron3Pipeline_spaceKLIP(output_dir=output_dir)
+    pipeline.save_results = True
+    
+    # Set step parameters.
+    for key1 in steps.keys():
+        for key2 in steps[key1].keys():
+            setattr(getattr(pipeline, key1), key2, steps[key1][key2])
+    
+    # Run Coron3Pipeline.
+    pipeline.run(asn)
+    
+    # Get reduction path.
+    datapath = os.path.join(output_dir, asn['products'][0]['name'] + '_i2d.fits')
+    
+    return datapath
 
 def run_obs(database,
             steps={},
-            subdir='stage3'):
+            subdir='stage3',
+            n_jobs=1):
     """
     Run the JWST stage 3 coronagraphy pipeline on the input observations
     database.
@@ -56,6 +133,10 @@ def run_obs(database,
     subdir : str, optional
         Name of the directory where the data products shall be saved. The
         default is 'stage3'.
+    n_jobs : int, optional
+        Number of worker processes across which the concatenations shall be
+        spread. If -1, use all available CPUs. The database is always updated
+        in the order of the concatenations. The default is 1.
     
     Returns
     -------
@@ -68,56 +149,109 @@ def run_obs(database,
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
+    # Get number of worker processes.
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    n_jobs = min(n_jobs, len(database.obs.keys()))
+    
+    # Make associations of all concatenations.
+    asns = {}
+    for i, key in enumerate(database.obs.keys()):
+        asns[key] = make_asn(database, key)
+    
+    # Submit all concatenations.
+    futures = {}
+    if n_jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+        for i, key in enumerate(database.obs.keys()):
+            futures[key] = executor.submit(_run_asn, asns[key], output_dir, steps)
+    
     # Loop through concatenations.
     datapaths = []
-    for i, key in enumerate(database.obs.keys()):
-        log.info('--> Concatenation ' + key)
-        
-        # Make ASN file.
-        log.info('  --> Coron3Pipeline: processing ' + key)
-        asnpath = make_asn_file(database, key, output_dir)
-        
-        # Initialize Coron1Pipeline.
-        pipeline = Coron3Pipeline_spaceKLIP(output_dir=output_dir)
-        pipeline.save_results = True
-        
-        # Set step parameters.
-        for key1 in steps.keys():
-            for key2 in steps[key1].keys():
-                setattr(getattr(pipeline, key1), key2, steps[key1][key2])
-        
-        # Run Coron3Pipeline.
-        pipeline.run(asnpath)
-        
-        # Get reduction path.
-        datapath = asnpath.replace('asn.json', 'i2d.fits')
-        datapaths += [datapath]
-        
-        # Update reduction header.
-        hdul = pyfits.open(datapath)
-        hdul[0].header['KLMODE0'] = pipeline.klip.truncate
-        hdul.writeto(datapath, output_verify='fix', overwrite=True)
-        hdul.close()
-        
-        # Save corresponding observations database.
-        file = os.path.join(output_dir, key + '.dat')
-        database.obs[key].write(file, format='ascii', overwrite=True)
-        
-        # Compute and save corresponding transmission mask.
-        file = os.path.join(output_dir, key + '_psfmask.fits')
-        mask = get_transmission(database.obs[key])
-        ww_sci = np.where(database.obs[key]['TYPE'] == 'SCI')[0]
-        if mask is not None:
-            hdul = pyfits.open(database.obs[key]['MASKFILE'][ww_sci[0]])
-            hdul[0].data = None
-            hdul['SCI'].data = mask
-            hdul.writeto(file, output_verify='fix', overwrite=True)
+    try:
+        for i, key in enumerate(database.obs.keys()):
+            log.info('--> Concatenation ' + key)
+            
+            # Run Coron3Pipeline or collect the result of the worker process.
+            log.info('  --> Coron3Pipeline: processing ' + key)
+            if key in futures:
+                datapath = futures[key].result()
+            else:
+                datapath = _run_asn(asns[key], output_dir, steps)
+            datapaths += [datapath]
+            
+            # Save corresponding observations database.
+            file = os.path.join(output_dir, key + '.dat')
+            database.obs[key].write(file, format='ascii', overwrite=True)
+            
+            # Compute and save corresponding transmission mask.
+            file = os.path.join(output_dir, key + '_psfmask.fits')
+            mask = get_transmission(database.obs[key])
+            ww_sci = np.where(database.obs[key]['TYPE'] == 'SCI')[0]
+            if mask is not None:
+                hdul = pyfits.open(database.obs[key]['MASKFILE'][ww_sci[0]])
+                hdul[0].data = None
+                hdul['SCI'].data = mask
+                hdul.writeto(file, output_verify='fix', overwrite=True)
+                hdul.close()
+    finally:
+        if n_jobs > 1:
+            executor.shutdown(cancel_futures=True)
     
     # Read reductions into database.
     database.read_jwst_s3_data(datapaths)
     
     pass
 
+def make_asn(database,
+             key):
+    """
+    Make the association required by the JWST stage 3 coronagraphy pipeline
+    for the provided concatenation.
+    
+    Parameters
+    ----------
+    database : spaceKLIP.Database
+        SpaceKLIP database for which the association shall be made.
+    key : str
+        Database key of the concatenation for which the association shall be
+        made.
+    
+    Returns
+    -------
+    asn : jwst.associations.Association
+        Association of the concatenation. It can be passed to the JWST stage
+        3 coronagraphy pipeline directly.
+    
+    """
+    
+    # Find science and reference files.
+    ww_sci = np.where(database.obs[key]['TYPE'] == 'SCI')[0]
+    if len(ww_sci) == 0:
+        raise UserWarning('Concatenation ' + key + ' has no science files')
+    ww_ref = np.where(database.obs[key]['TYPE'] == 'REF')[0]
+    if len(ww_ref) == 0:
+        raise UserWarning('Concatenation ' + key + ' has no reference files')
+    
+    # Make association.
+    pro_id = '00000'
+    asn_id = 'c0000'
+    tar_id = 't000'
+    members = []
+    for i in ww_sci:
+        members += [(os.path.abspath(database.obs[key]['FITSFILE'][i]), 'science')]
+    for i in ww_ref:
+        members += [(os.path.abspath(database.obs[key]['FITSFILE'][i]), 'psf')]
+    asn = asn_from_list.asn_from_list(members, rule=DMS_Level3_Base, product_name=key, with_exptype=True)
+    asn['asn_type'] = 'coron3'
+    asn['asn_rule'] = 'candidate_Asn_Lv3Coron'
+    asn['program'] = pro_id
+    asn['asn_id'] = asn_id
+    asn['target'] = tar_id
+    asn['asn_pool'] = 'jw' + pro_id + '_00000000t000000_pool.csv'
+    
+    return asn
+
 def make_asn_file(database,
                   key,
                   output_dir):
@@ -142,47 +276,13 @@ def make_asn_file(database,
     
     """
     
-    # Find science and reference files.
-    ww_sci = np.where(database.obs[key]['TYPE'] == 'SCI')[0]
-    if len(ww_sci) == 0:
-        raise UserWarning('Concatenation ' + key + ' has no science files')
-    ww_ref = np.where(database.obs[key]['TYPE'] == 'REF')[0]
-    if len(ww_ref) == 0:
-        raise UserWarning('Concatenation ' + key + ' has no reference files')
-    
     # Make ASN file.
-    pro_id = '00000'
-    asn_id = 'c0000'
-    tar_id = 't000'
+    asn = make_asn(database, key)
     asnfile = key + '_asn.json'
     asnpath = os.path.join(output_dir, asnfile)
+    name, serialized = asn.dump(format='json')
     f = open(asnpath, 'w')
-    f.write('{\n')
-    f.write('    "asn_type": "coron3",\n')
-    f.write('    "asn_rule": "candidate_Asn_Lv3Coron",\n')
-    f.write('    "program": "' + pro_id + '",\n')
-    f.write('    "asn_id": "' + asn_id + '",\n')
-    f.write('    "target": "' + tar_id + '",\n')
-    f.write('    "asn_pool": "jw' + pro_id + '_00000000t000000_pool.csv",\n')
-    f.write('    "products": [\n')
-    f.write('        {\n')
-    name = key
-    f.write('            "name": "' + name + '",\n')
-    f.write('            "members": [\n')
-    for i in ww_sci:
-        f.write('                {\n')
-        f.write('                    "expname": "' + os.path.abspath(database.obs[key]['FITSFILE'][i]) + '",\n')
-        f.write('                    "exptype": "science"\n')
-        f.write('                },\n')
-    for i in ww_ref:
-        f.write('                {\n')
-        f.write('                    "expname": "' + os.path.abspath(database.obs[key]['FITSFILE'][i]) + '",\n')
-        f.write('                    "exptype": "psf"\n')
-        f.write('                },\n')
-    f.write('            ]\n')
-    f.write('        }\n')
-    f.write('    ]\n')
-    f.write('}\n')
+    f.write(serialized)
     f.close()
     
     return asnpath
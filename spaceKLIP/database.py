@@ -20,9 +20,12 @@ import copy
 import json
 import webbpsf
 
+from concurrent.futures import ThreadPoolExecutor
+
 from astropy.table import Table
 from astroquery.svo_fps import SvoFps
 from jwst.pipeline import Detector1Pipeline, Image2Pipeline, Coron3Pipeline
+from spaceKLIP import utils as ut
 
 import logging
 log = logging.getLogger(__name__)
@@ -68,6 +71,39 @@ nircam = webbpsf.NIRCam()
 niriss = webbpsf.NIRISS()
 miri = webbpsf.MIRI()
 
+# FITS header keywords read by the Database.read_jwst_s012_data routine.
+pri_keys = ['TELESCOP', 'TARGPROP', 'TARG_RA', 'TARG_DEC', 'INSTRUME', 'DETECTOR', 'FILTER', 'PUPIL', 'CORONMSK', 'EXP_TYPE', 'EXPSTART', 'NINTS', 'EFFINTTM', 'IS_PSF', 'SELFREF', 'SUBARRAY', 'NUMDTHPT', 'XOFFSET', 'YOFFSET', 'APERNAME', 'BLURFWHM']
+sci_keys = ['BUNIT', 'CRPIX1', 'CRPIX2', 'VPARITY', 'V3I_YANG', 'RA_REF', 'DEC_REF', 'ROLL_REF', 'NAXIS', 'NAXIS3']
+
+def read_headers(fitsfile):
+    """
+    Read the primary and SCI header keywords required by the spaceKLIP
+    database from a FITS file without loading any data.
+    
+    Parameters
+    ----------
+    fitsfile : path
+        Path of the input FITS file.
+    
+    Returns
+    -------
+    heads : dict
+        Dictionary with a 'PRI' and a 'SCI' dictionary of the header
+        keywords that are present in the FITS file.
+    
+    """
+    
+    # Read headers. HDUs are loaded lazily, so the data is never read.
+    heads = {'PRI': {}, 'SCI': {}}
+    with pyfits.open(fitsfile) as hdul:
+        for ext, keys in [(0, pri_keys), ('SCI', sci_keys)]:
+            head = hdul[ext].header
+            for key in keys:
+                if key in head and isinstance(head[key], (str, bool, int, float)):
+                    heads['PRI' if ext == 0 else 'SCI'][key] = head[key]
+    
+    return heads
+
 class Database():
     """
     The central spaceKLIP database class.
@@ -90,6 +126,11 @@ class Database():
         
         A non-verbose mode is available by setting Database.verbose = False.
         
+        The database can be saved to and loaded from a FITS file with the
+        Database.save and Database.load routines. Setting Database.autosave =
+        True saves it automatically after each reduction step, so that a data
+        reduction can be resumed from the last completed step.
+        
         Parameters
         ----------
         output_dir : path
@@ -116,16 +157,80 @@ class Database():
         # companions.
         self.src = {}
         
+        # Initialize history dictionary which records for each concatenation
+        # the reduction step that produced each FITS file and PSF mask.
+        self.history = {}
+        
+        # Automatically save the database after each reduction step?
+        self.autosave = False
+        
         # Verbose mode?
         self.verbose = True
         
         pass
     
+    def _read_headers(self,
+                      paths,
+                      use_cache=True):
+        """
+        Read the FITS headers of many files in parallel. The headers are
+        stored in an index file in the output directory, keyed by path, file
+        size, and modification time, so that unchanged files do not have to
+        be opened again.
+        
+        Parameters
+        ----------
+        paths : list of paths
+            List of paths of the input FITS files.
+        use_cache : bool, optional
+            Use and update the header index file? The default is True.
+        
+        Returns
+        -------
+        heads : list of dict
+            Headers of the input FITS files, see read_headers.
+        
+        """
+        
+        # Load header index.
+        indexfile = os.path.join(self.output_dir, 'header_index.json')
+        index = {}
+        if use_cache and os.path.exists(indexfile):
+            try:
+                with open(indexfile, 'r') as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+        
+        # Find files which are not in the index or have changed.
+        stats = [os.stat(path) for path in paths]
+        keys = [os.path.abspath(path) for path in paths]
+        todo = [i for i in range(len(paths)) if keys[i] not in index or index[keys[i]]['SIZE'] != stats[i].st_size or index[keys[i]]['MTIME'] != stats[i].st_mtime]
+        
+        # Read headers of these files in parallel.
+        if len(todo) != 0:
+            with ThreadPoolExecutor() as executor:
+                for i, heads in zip(todo, executor.map(read_headers, [paths[i] for i in todo])):
+                    heads['SIZE'] = stats[i].st_size
+                    heads['MTIME'] = stats[i].st_mtime
+                    index[keys[i]] = heads
+            
+            # Save header index.
+            if use_cache:
+                if not os.path.exists(self.output_dir):
+                    os.makedirs(self.output_dir)
+                with open(indexfile + '.temp', 'w') as f:
+                    json.dump(index, f)
+                os.replace(indexfile + '.temp', indexfile)
+        
+        return [index[key] for key in keys]
+    
     def read_jwst_s012_data(self,
                             datapaths,
                             psflibpaths=None,
                             bgpaths=None,
-                            assoc_using_targname=True):
+                            assoc_using_targname=True,
+                            use_cache=True):
         """
         Read JWST stage 0 (*uncal), 1 (*rate or *rateints), or 2 (*cal or
         *calints) data into the Database.obs dictionary. It contains a table of
@@ -155,6 +260,9 @@ class Database():
             SCI and REF observations based on the target name from the APT
             file. Otherwise, only consider the instrument parameters to
             distinguish between SCI and REF TA/BG. The default is True.
+        use_cache : bool, optional
+            Keep an index of the FITS headers in the output directory so that
+            unchanged files do not have to be read again. The default is True.
         
         Returns
         -------
@@ -220,10 +328,9 @@ class Database():
         else:
             allpaths = np.array(datapaths)
         Nallpaths = len(allpaths)
+        allheads = self._read_headers(list(allpaths), use_cache=use_cache)
         for i in range(Nallpaths):
-            hdul = pyfits.open(allpaths[i])
-            head = hdul[0].header
-            data = hdul['SCI'].data
+            head = allheads[i]['PRI']
             if 'uncal' in allpaths[i]:
                 DATAMODL += ['STAGE0']
             elif 'rate' in allpaths[i] or 'rateints' in allpaths[i]:
@@ -261,7 +368,7 @@ class Database():
             CORONMSK += [head.get('CORONMSK', 'NONE')]
             EXP_TYPE += [head.get('EXP_TYPE', 'UNKNOWN')]
             EXPSTART += [head.get('EXPSTART', np.nan)]
-            NINTS += [head.get('NINTS', data.shape[0] if data.ndim == 3 else 1)]
+            NINTS += [head.get('NINTS', allheads[i]['SCI']['NAXIS3'] if allheads[i]['SCI'].get('NAXIS', 0) == 3 else 1)]
             EFFINTTM += [head.get('EFFINTTM', np.nan)]
             IS_PSF += [str(head.get('IS_PSF', 'NONE'))]
             SELFREF += [str(head.get('SELFREF', 'NONE'))]
@@ -285,7 +392,7 @@ class Database():
             else:
                 raise UserWarning('Data originates from unknown telescope')
             BLURFWHM += [head.get('BLURFWHM', np.nan)]
-            head = hdul['SCI'].header
+            head = allheads[i]['SCI']
             BUNIT += [head.get('BUNIT', 'NONE')]
             CRPIX1 += [head.get('CRPIX1', np.nan)]
             CRPIX2 += [head.get('CRPIX2', np.nan)]
@@ -295,7 +402,6 @@ class Database():
             DEC_REF += [head.get('DEC_REF', np.nan)]
             ROLL_REF += [head.get('ROLL_REF', 0.)]
             HASH += [TELESCOP[-1] + '_' + INSTRUME[-1] + '_' + DETECTOR[-1] + '_' + FILTER[-1] + '_' + PUPIL[-1] + '_' + CORONMSK[-1] + '_' + SUBARRAY[-1]]
-            hdul.close()
         DATAMODL = np.array(DATAMODL)
         TELESCOP = np.array(TELESCOP)
         TARGPROP = np.array(TARGPROP)
@@ -331,47 +437,63 @@ class Database():
         BLURFWHM = np.array(BLURFWHM)
         HASH = np.array(HASH)
         
-        # Find unique concatenations.
-        HASH_unique = np.unique(HASH)
-        NHASH_unique = len(HASH_unique)
-        
-        # Associate TA files with science or reference files.
-        ww = []
-        for i in range(NHASH_unique):
-            if 'MASKRND_NONE' in HASH_unique[i] or 'MASKBAR_NONE' in HASH_unique[i] or 'NONE_MASK1065' in HASH_unique[i] or 'NONE_MASK1140' in HASH_unique[i] or 'NONE_MASK1550' in HASH_unique[i] or 'NONE_MASKLYOT' in HASH_unique[i]:
-                ww += [-1]
-                HASH_i_split = HASH_unique[i].split('_')
-                for j in range(NHASH_unique):
-                    HASH_j_split = HASH_unique[j].split('_')
-                    if HASH_j_split[0] == HASH_i_split[0] and HASH_j_split[1] == HASH_i_split[1] and HASH_j_split[2] == HASH_i_split[2] and HASH_j_split[4] == HASH_i_split[4] and HASH_j_split[5] != 'NONE' and HASH_j_split[6][-4:] in HASH_i_split[6]:
-                        ww[-1] = i
+        # Index files by concatenation. Keep the concatenations as structured
+        # tuples of (telescope, instrument, detector, filter, pupil mask,
+        # image mask, subarray) for the association below.
+        index = {}
+        config = {}
+        for k in range(Nallpaths):
+            if HASH[k] not in index:
+                index[HASH[k]] = []
+                config[HASH[k]] = (TELESCOP[k], INSTRUME[k], DETECTOR[k], FILTER[k], PUPIL[k], CORONMSK[k], SUBARRAY[k])
+            index[HASH[k]] += [k]
+        HASH_unique = sorted(index.keys())
+        
+        # Associate TA files with science or reference files. Candidates must
+        # have the same telescope, instrument, detector, and pupil mask, an
+        # image mask, and a subarray that matches the TA subarray.
+        candidates = {}
+        for key_hash in HASH_unique:
+            tel, inst, det, filt, pupil, coronmsk, subarray = config[key_hash]
+            if coronmsk != 'NONE':
+                candidates.setdefault((tel, inst, det, pupil), []).append(key_hash)
+        for key_hash in HASH_unique:
+            tel, inst, det, filt, pupil, coronmsk, subarray = config[key_hash]
+            if coronmsk == 'NONE' and (pupil in ['MASKRND', 'MASKBAR'] or subarray in ['MASK1065', 'MASK1140', 'MASK1550', 'MASKLYOT']):
+                for hash_match in candidates.get((tel, inst, det, pupil), []):
+                    if config[hash_match][6][-4:] in subarray:
                         break
-                if ww[-1] != -1:
-                    HASH[HASH == HASH_unique[i]] = HASH_unique[j]
                 else:
                     raise UserWarning('Could not associate TA files with science or reference files')
-        HASH_unique = np.delete(HASH_unique, ww)
+                index[hash_match] = sorted(index[hash_match] + index.pop(key_hash))
+        HASH_unique = [key_hash for key_hash in HASH_unique if key_hash in index]
         NHASH_unique = len(HASH_unique)
         
         # Get PSF mask directory.
         maskbase = os.path.split(os.path.abspath(__file__))[0]
         maskbase = os.path.join(maskbase, 'resources/transmissions/')
         
+        # Use sets for fast membership tests.
+        if psflibpaths is not None:
+            psflibset = set(psflibpaths)
+        if bgpaths is not None:
+            bgset = set(bgpaths)
+        
         # Loop through concatenations.
         for i in range(NHASH_unique):
-            ww = HASH == HASH_unique[i]
+            ww = np.array(index[HASH_unique[i]])
             
             # Find science and reference files.
             if psflibpaths is not None:
                 ww_sci = []
                 ww_ref = []
-                for j in range(len(allpaths[ww])):
-                    if allpaths[ww][j] in psflibpaths:
+                for j in range(len(ww)):
+                    if allpaths[ww[j]] in psflibset:
                         ww_ref += [j]
                     else:
                         ww_sci += [j]
-                ww_sci = np.array(ww_sci)
-                ww_ref = np.array(ww_ref)
+                ww_sci = np.array(ww_sci, dtype=int)
+                ww_ref = np.array(ww_ref, dtype=int)
             else:
                 is_psf = IS_PSF[ww]
                 exp_type = EXP_TYPE[ww]
@@ -392,8 +514,91 @@ class Database():
                         log.warning('  --> Could not identify science and reference files based on dither pattern')
                         raise UserWarning('Please use psflibpaths to specify reference files')
             
-            # Make Astropy tables for concatenations.
-            tab = Table(names=('TYPE',
+            # Collect rows of Astropy table for concatenation.
+            rows = []
+            ww_sci_set = set(ww_sci)
+            for j in np.append(ww_sci, ww_ref).astype(int):
+                k = ww[j]
+                if j in ww_sci_set:
+                    sci = True
+                else:
+                    sci = False
+                if 'TA' in EXP_TYPE[k]:
+                    if sci:
+                        tt = 'SCI_TA'
+                    else:
+                        tt = 'REF_TA'
+                elif 'BG' in TARGPROP[k].upper() or 'BACK' in TARGPROP[k].upper() or 'BACKGROUND' in TARGPROP[k].upper():
+                    if sci:
+                        tt = 'SCI_BG'
+                    else:
+                        tt = 'REF_BG'
+                else:
+                    if sci:
+                        tt = 'SCI'
+                    else:
+                        tt = 'REF'
+                if bgpaths is not None:
+                    if allpaths[k] in bgset:
+                        if sci:
+                            tt = 'SCI_BG'
+                        else:
+                            tt = 'REF_BG'
+                maskfile = allpaths[k].replace('.fits', '_psfmask.fits')
+                if not os.path.exists(maskfile):    
+                    if EXP_TYPE[k] == 'NRC_CORON':
+                        maskpath = APERNAME[k] + '_' + FILTER[k] + '.fits'
+                        maskfile = os.path.join(maskbase, maskpath)
+                        if not os.path.exists(maskfile):
+                            maskfile = 'NONE'
+                    elif EXP_TYPE[k] == 'MIR_4QPM' or EXP_TYPE[k] == 'MIR_LYOT':
+                        if APERNAME[k] == 'MIRIM_MASK1065':
+                            maskpath = 'JWST_MIRI_F1065C_transmission_webbpsf-ext_v2.fits'
+                        elif APERNAME[k] == 'MIRIM_MASK1140':
+                            maskpath = 'JWST_MIRI_F1140C_transmission_webbpsf-ext_v2.fits'
+                        elif APERNAME[k] == 'MIRIM_MASK1550':
+                            maskpath = 'JWST_MIRI_F1550C_transmission_webbpsf-ext_v2.fits'
+                        elif APERNAME[k] == 'MIRIM_MASKLYOT':
+                            maskpath = 'jwst_miri_psfmask_0009.fits'  # FIXME!
+                        maskfile = os.path.join(maskbase, maskpath)
+                    else:
+                        maskfile = 'NONE'
+                rows += [(tt,
+                          EXP_TYPE[k],
+                          DATAMODL[k],
+                          TELESCOP[k],
+                          TARGPROP[k],
+                          TARG_RA[k],
+                          TARG_DEC[k],
+                          INSTRUME[k],
+                          DETECTOR[k],
+                          FILTER[k],
+                          CWAVEL[k],
+                          DWAVEL[k],
+                          PUPIL[k],
+                          CORONMSK[k],
+                          EXPSTART[k],
+                          NINTS[k],
+                          EFFINTTM[k],
+                          SUBARRAY[k],
+                          NUMDTHPT[k],
+                          XOFFSET[k],
+                          YOFFSET[k],
+                          APERNAME[k],
+                          PIXSCALE[k],
+                          BUNIT[k],
+                          CRPIX1[k],
+                          CRPIX2[k],
+                          RA_REF[k],
+                          DEC_REF[k],
+                          ROLL_REF[k] - V3I_YANG[k] * VPARITY[k],
+                          BLURFWHM[k],
+                          allpaths[k],
+                          maskfile)]
+            
+            # Make Astropy table for concatenation in one go.
+            tab = Table(rows=rows,
+                        names=('TYPE',
                                'EXP_TYPE',
                                'DATAMODL',
                                'TELESCOP',
@@ -457,126 +662,52 @@ class Database():
                                'float',
                                'object',
                                'object'))
-            for j in np.append(ww_sci, ww_ref):
-                if j in ww_sci:
-                    sci = True
-                else:
-                    sci = False
-                if 'TA' in EXP_TYPE[ww][j]:
-                    if sci:
-                        tt = 'SCI_TA'
-                    else:
-                        tt = 'REF_TA'
-                elif 'BG' in TARGPROP[ww][j].upper() or 'BACK' in TARGPROP[ww][j].upper() or 'BACKGROUND' in TARGPROP[ww][j].upper():
-                    if sci:
-                        tt = 'SCI_BG'
-                    else:
-                        tt = 'REF_BG'
-                else:
-                    if sci:
-                        tt = 'SCI'
-                    else:
-                        tt = 'REF'
-                if bgpaths is not None:
-                    if allpaths[ww][j] in bgpaths:
-                        if sci:
-                            tt = 'SCI_BG'
-                        else:
-                            tt = 'REF_BG'
-                maskfile = allpaths[ww][j].replace('.fits', '_psfmask.fits')
-                if not os.path.exists(maskfile):    
-                    if EXP_TYPE[ww][j] == 'NRC_CORON':
-                        maskpath = APERNAME[ww][j] + '_' + FILTER[ww][j] + '.fits'
-                        maskfile = os.path.join(maskbase, maskpath)
-                        if not os.path.exists(maskfile):
-                            maskfile = 'NONE'
-                    elif EXP_TYPE[ww][j] == 'MIR_4QPM' or EXP_TYPE[ww][j] == 'MIR_LYOT':
-                        if APERNAME[ww][j] == 'MIRIM_MASK1065':
-                            maskpath = 'JWST_MIRI_F1065C_transmission_webbpsf-ext_v2.fits'
-                        elif APERNAME[ww][j] == 'MIRIM_MASK1140':
-                            maskpath = 'JWST_MIRI_F1140C_transmission_webbpsf-ext_v2.fits'
-                        elif APERNAME[ww][j] == 'MIRIM_MASK1550':
-                            maskpath = 'JWST_MIRI_F1550C_transmission_webbpsf-ext_v2.fits'
-                        elif APERNAME[ww][j] == 'MIRIM_MASKLYOT':
-                            maskpath = 'jwst_miri_psfmask_0009.fits'  # FIXME!
-                        maskfile = os.path.join(maskbase, maskpath)
-                    else:
-                        maskfile = 'NONE'
-                tab.add_row((tt,
-                             EXP_TYPE[ww][j],
-                             DATAMODL[ww][j],
-                             TELESCOP[ww][j],
-                             TARGPROP[ww][j],
-                             TARG_RA[ww][j],
-                             TARG_DEC[ww][j],
-                             INSTRUME[ww][j],
-                             DETECTOR[ww][j],
-                             FILTER[ww][j],
-                             CWAVEL[ww][j],
-                             DWAVEL[ww][j],
-                             PUPIL[ww][j],
-                             CORONMSK[ww][j],
-                             EXPSTART[ww][j],
-                             NINTS[ww][j],
-                             EFFINTTM[ww][j],
-                             SUBARRAY[ww][j],
-                             NUMDTHPT[ww][j],
-                             XOFFSET[ww][j],
-                             YOFFSET[ww][j],
-                             APERNAME[ww][j],
-                             PIXSCALE[ww][j],
-                             BUNIT[ww][j],
-                             CRPIX1[ww][j],
-                             CRPIX2[ww][j],
-                             RA_REF[ww][j],
-                             DEC_REF[ww][j],
-                             ROLL_REF[ww][j] - V3I_YANG[ww][j] * VPARITY[ww][j],
-                             BLURFWHM[ww][j],
-                             allpaths[ww][j],
-                             maskfile))
-            self.obs[HASH_unique[i]] = tab.copy()
-            del tab
+            self.obs[HASH_unique[i]] = tab
+            self.history[HASH_unique[i]] = [(j, 'INPUT', tab['FITSFILE'][j], tab['MASKFILE'][j]) for j in range(len(tab))]
             
             # Associate background files with science or reference files.
-            for j in range(len(self.obs[HASH_unique[i]])):
-                if self.obs[HASH_unique[i]]['TYPE'][j] == 'SCI_BG':
-                    if (self.obs[HASH_unique[i]]['EFFINTTM'][j] not in self.obs[HASH_unique[i]]['EFFINTTM'][self.obs[HASH_unique[i]]['TYPE'] == 'SCI']) or (self.obs[HASH_unique[i]]['NINTS'][j] not in self.obs[HASH_unique[i]]['NINTS'][self.obs[HASH_unique[i]]['TYPE'] == 'SCI']):
-                        if (self.obs[HASH_unique[i]]['EFFINTTM'][j] in self.obs[HASH_unique[i]]['EFFINTTM'][self.obs[HASH_unique[i]]['TYPE'] == 'REF']) and (self.obs[HASH_unique[i]]['NINTS'][j] in self.obs[HASH_unique[i]]['NINTS'][self.obs[HASH_unique[i]]['TYPE'] == 'REF']):
-                            self.obs[HASH_unique[i]]['TYPE'][j] = 'REF_BG'
+            obs = self.obs[HASH_unique[i]]
+            sci_effinttm = set(obs['EFFINTTM'][obs['TYPE'] == 'SCI'])
+            sci_nints = set(obs['NINTS'][obs['TYPE'] == 'SCI'])
+            ref_effinttm = set(obs['EFFINTTM'][obs['TYPE'] == 'REF'])
+            ref_nints = set(obs['NINTS'][obs['TYPE'] == 'REF'])
+            for j in range(len(obs)):
+                if obs['TYPE'][j] == 'SCI_BG':
+                    if (obs['EFFINTTM'][j] not in sci_effinttm) or (obs['NINTS'][j] not in sci_nints):
+                        if (obs['EFFINTTM'][j] in ref_effinttm) and (obs['NINTS'][j] in ref_nints):
+                            obs['TYPE'][j] = 'REF_BG'
                         else:
-                            raise UserWarning('Background exposure ' + self.obs[HASH_unique[i]]['FITSFILE'][j] + ' could not be matched with PSF')
-                elif self.obs[HASH_unique[i]]['TYPE'][j] == 'REF_BG':
-                    if (self.obs[HASH_unique[i]]['EFFINTTM'][j] not in self.obs[HASH_unique[i]]['EFFINTTM'][self.obs[HASH_unique[i]]['TYPE'] == 'REF']) or (self.obs[HASH_unique[i]]['NINTS'][j] not in self.obs[HASH_unique[i]]['NINTS'][self.obs[HASH_unique[i]]['TYPE'] == 'REF']):
-                        if (self.obs[HASH_unique[i]]['EFFINTTM'][j] in self.obs[HASH_unique[i]]['EFFINTTM'][self.obs[HASH_unique[i]]['TYPE'] == 'SCI']) and (self.obs[HASH_unique[i]]['NINTS'][j] in self.obs[HASH_unique[i]]['NINTS'][self.obs[HASH_unique[i]]['TYPE'] == 'SCI']):
-                            self.obs[HASH_unique[i]]['TYPE'][j] = 'SCI_BG'
+                            raise UserWarning('Background exposure ' + obs['FITSFILE'][j] + ' could not be matched with PSF')
+                elif obs['TYPE'][j] == 'REF_BG':
+                    if (obs['EFFINTTM'][j] not in ref_effinttm) or (obs['NINTS'][j] not in ref_nints):
+                        if (obs['EFFINTTM'][j] in sci_effinttm) and (obs['NINTS'][j] in sci_nints):
+                            obs['TYPE'][j] = 'SCI_BG'
                         else:
-                            raise UserWarning('Background exposure ' + self.obs[HASH_unique[i]]['FITSFILE'][j] + ' could not be matched with PSF')
+                            raise UserWarning('Background exposure ' + obs['FITSFILE'][j] + ' could not be matched with PSF')
             
             # Reassociate TA and background files with science or reference
             # files based on target name.
             if assoc_using_targname:
-                for j in range(len(self.obs[HASH_unique[i]])):
-                    if self.obs[HASH_unique[i]]['TYPE'][j] in ['SCI_TA', 'SCI_BG']:
-                        targprop = self.obs[HASH_unique[i]]['TARGPROP'][self.obs[HASH_unique[i]]['TYPE'] == 'SCI']
-                        ww = np.array([s in self.obs[HASH_unique[i]]['TARGPROP'][j] for s in targprop])
-                        if np.sum(ww) == 0:
-                            targprop = self.obs[HASH_unique[i]]['TARGPROP'][self.obs[HASH_unique[i]]['TYPE'] == 'REF']
-                            ww = np.array([s in self.obs[HASH_unique[i]]['TARGPROP'][j] for s in targprop])
-                            if np.sum(ww) != 0:
-                                self.obs[HASH_unique[i]]['TYPE'][j] = self.obs[HASH_unique[i]]['TYPE'][j].replace('SCI', 'REF')
-                    if self.obs[HASH_unique[i]]['TYPE'][j] in ['REF_TA', 'REF_BG']:
-                        targprop = self.obs[HASH_unique[i]]['TARGPROP'][self.obs[HASH_unique[i]]['TYPE'] == 'REF']
-                        ww = np.array([s in self.obs[HASH_unique[i]]['TARGPROP'][j] for s in targprop])
-                        if np.sum(ww) == 0:
-                            targprop = self.obs[HASH_unique[i]]['TARGPROP'][self.obs[HASH_unique[i]]['TYPE'] == 'SCI']
-                            ww = np.array([s in self.obs[HASH_unique[i]]['TARGPROP'][j] for s in targprop])
-                            if np.sum(ww) != 0:
-                                self.obs[HASH_unique[i]]['TYPE'][j] = self.obs[HASH_unique[i]]['TYPE'][j].replace('REF', 'SCI')
+                sci_targprop = set(obs['TARGPROP'][obs['TYPE'] == 'SCI'])
+                ref_targprop = set(obs['TARGPROP'][obs['TYPE'] == 'REF'])
+                for j in range(len(obs)):
+                    if obs['TYPE'][j] in ['SCI_TA', 'SCI_BG']:
+                        if not any(s in obs['TARGPROP'][j] for s in sci_targprop):
+                            if any(s in obs['TARGPROP'][j] for s in ref_targprop):
+                                obs['TYPE'][j] = obs['TYPE'][j].replace('SCI', 'REF')
+                    if obs['TYPE'][j] in ['REF_TA', 'REF_BG']:
+                        if not any(s in obs['TARGPROP'][j] for s in ref_targprop):
+                            if any(s in obs['TARGPROP'][j] for s in sci_targprop):
+                                obs['TYPE'][j] = obs['TYPE'][j].replace('REF', 'SCI')
         
         # Print Astropy tables for concatenations.
         if self.verbose:
             self.print_obs()
         
+        # Save spaceKLIP database.
+        if self.autosave:
+            self.save()
+        
         pass
     
     def read_jwst_s3_data(self,
@@ -873,6 +1004,10 @@ class Database():
         if self.verbose:
             self.print_red()
         
+        # Save spaceKLIP database.
+        if self.autosave:
+            self.save()
+        
         pass
     
     def read_jwst_s4_data(self,
@@ -981,6 +1116,10 @@ class Database():
         if self.verbose:
             self.print_src()
         
+        # Save spaceKLIP database.
+        if self.autosave:
+            self.save()
+        
         pass
     
     def print_obs(self,
@@ -1090,7 +1229,8 @@ class Database():
                    yoffset=None,
                    crpix1=None,
                    crpix2=None,
-                   blurfwhm=None):
+                   blurfwhm=None,
+                   bunit=None):
         """
         Update the content of the observations database.
         
@@ -1126,6 +1266,12 @@ class Database():
         blurfwhm : float, optional
             New FWHM for the Gaussian filter blurring (pix) for the observation
             to be updated. The default is None.
+        bunit : str, optional
+            New data unit for the observation to be updated. Callers which
+            have just written the new FITS file should pass the data unit of
+            its SCI header. If None, it will be read from the SCI header of
+            the new FITS file through the spaceKLIP.utils.get_header cache,
+            which requires the file to exist on disk. The default is None.
         
         Returns
         -------
@@ -1142,13 +1288,14 @@ class Database():
             DATAMODL = 'STAGE2'
         else:
             raise UserWarning('File name must contain one of the following: uncal, rate, rateints, cal, calints')
-        hdul = pyfits.open(fitsfile)
+        if bunit is None:
+            bunit = ut.get_header(fitsfile, 'SCI')['BUNIT']
         self.obs[key]['DATAMODL'][index] = DATAMODL
         if nints is not None:
             self.obs[key]['NINTS'][index] = nints
         if effinttm is not None:
             self.obs[key]['EFFINTTM'][index] = effinttm
-        self.obs[key]['BUNIT'][index] = hdul['SCI'].header['BUNIT']
+        self.obs[key]['BUNIT'][index] = bunit
         if xoffset is not None:
             self.obs[key]['XOFFSET'][index] = xoffset
         if yoffset is not None:
@@ -1162,7 +1309,11 @@ class Database():
         self.obs[key]['FITSFILE'][index] = fitsfile
         if maskfile is not None:
             self.obs[key]['MASKFILE'][index] = maskfile
-        hdul.close()
+        
+        # Record provenance. The reduction step is identified by the name of
+        # the directory to which it has written its data products.
+        step = os.path.split(os.path.split(os.path.abspath(fitsfile))[0])[1]
+        self.history.setdefault(key, []).append((index, step, fitsfile, self.obs[key]['MASKFILE'][index]))
         
         pass
     
@@ -1201,6 +1352,151 @@ class Database():
         
         pass
     
+    def save(self,
+             path=None):
+        """
+        Save the observations, reductions, and source databases together with
+        the provenance of each FITS file and PSF mask to a FITS file with one
+        binary table extension per concatenation. The file is first written
+        to a temporary file which then replaces the existing one, so that an
+        interrupted save never corrupts the previous state.
+        
+        Parameters
+        ----------
+        path : path, optional
+            Path of the output FITS file. If None, it will be saved as
+            'database.fits' in the output directory. The default is None.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Set output path.
+        if path is None:
+            if not os.path.exists(self.output_dir):
+                os.makedirs(self.output_dir)
+            path = os.path.join(self.output_dir, 'database.fits')
+        
+        # Convert Astropy tables to binary table extensions. Object columns
+        # cannot be written to FITS files and are saved as strings. Their None
+        # cells are recorded in an additional boolean column.
+        def table_hdu(tab, extname, key, index=None):
+            tab = Table(tab, copy=False)
+            for name in tab.colnames:
+                if tab[name].dtype == object:
+                    isnone = np.array([val is None for val in tab[name]], dtype=bool)
+                    tab[name] = np.array(['' if val is None else str(val) for val in tab[name]], dtype=str)
+                    if np.any(isnone):
+                        tab['NONE_' + name] = isnone
+            hdu = pyfits.table_to_hdu(tab)
+            hdu.header['EXTNAME'] = extname
+            hdu.header['DBKEY'] = key
+            if index is not None:
+                hdu.header['SRCINDEX'] = index
+            return hdu
+        
+        # Make FITS file.
+        hdul = pyfits.HDUList([pyfits.PrimaryHDU()])
+        hdul[0].header['OUTDIR'] = self.output_dir
+        for key in self.obs.keys():
+            hdul += [table_hdu(self.obs[key], 'OBS', key)]
+            if key in self.history.keys():
+                hist = Table(rows=self.history[key],
+                             names=('INDEX',
+                                    'STEP',
+                                    'FITSFILE',
+                                    'MASKFILE'),
+                             dtype=('int',
+                                    'object',
+                                    'object',
+                                    'object'))
+                hdul += [table_hdu(hist, 'HISTORY', key)]
+        for key in self.red.keys():
+            hdul += [table_hdu(self.red[key], 'RED', key)]
+        for key in self.src.keys():
+            for j in range(len(self.src[key])):
+                if self.src[key][j] is not None:
+                    hdul += [table_hdu(self.src[key][j], 'SRC', key, j)]
+        
+        # Write FITS file.
+        hdul.writeto(path + '.temp', output_verify='fix', overwrite=True)
+        os.replace(path + '.temp', path)
+        
+        pass
+    
+    def load(self,
+             path=None):
+        """
+        Load the observations, reductions, and source databases together with
+        the provenance of each FITS file and PSF mask from a FITS file written
+        by Database.save. This replaces the current content of the database,
+        so that a data reduction can be resumed from the last completed step.
+        
+        Parameters
+        ----------
+        path : path, optional
+            Path of the input FITS file. If None, it will be loaded from
+            'database.fits' in the output directory. The default is None.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Set input path.
+        if path is None:
+            path = os.path.join(self.output_dir, 'database.fits')
+        if not os.path.exists(path):
+            raise UserWarning('Database file ' + path + ' not found')
+        
+        # Read FITS file.
+        self.obs = {}
+        self.red = {}
+        self.src = {}
+        self.history = {}
+        with pyfits.open(path) as hdul:
+            for hdu in hdul[1:]:
+                
+                # Convert binary table extensions to Astropy tables. String
+                # columns are converted back to object columns, including
+                # their None cells, and numerical columns to native byte
+                # order.
+                tab = Table.read(hdu, mask_invalid=False)
+                tab.meta = {}
+                for name in tab.colnames:
+                    if name.startswith('NONE_'):
+                        continue
+                    if tab[name].dtype.kind == 'U':
+                        tab[name] = np.array(tab[name], dtype=object)
+                        if 'NONE_' + name in tab.colnames:
+                            tab[name][np.array(tab['NONE_' + name], dtype=bool)] = None
+                            tab.remove_column('NONE_' + name)
+                    else:
+                        tab[name] = np.array(tab[name], dtype=tab[name].dtype.newbyteorder('='))
+                key = hdu.header['DBKEY']
+                extname = hdu.header['EXTNAME']
+                if extname == 'OBS':
+                    self.obs[key] = tab
+                elif extname == 'HISTORY':
+                    self.history[key] = [(int(row[0]),) + tuple(row[1:]) for row in tab.iterrows()]
+                elif extname == 'RED':
+                    self.red[key] = tab
+                elif extname == 'SRC':
+                    self.update_src(key, hdu.header['SRCINDEX'], tab)
+        
+        # Print Astropy tables for concatenations.
+        if self.verbose:
+            self.print_obs()
+            if len(self.red) != 0:
+                self.print_red()
+            if len(self.src) != 0:
+                self.print_src()
+        
+        pass
+    
     def summarize(self):
         """
         Succinctly summarize the contents of the observations database, i.e.,
@@ -16,11 +16,13 @@ import astropy.io.fits as pyfits
 import matplotlib.pyplot as plt
 import numpy as np
 
+import hashlib
 import json
 import pysiaf
 import webbpsf_ext
 
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy, deepcopy
 from jwst.pipeline import Detector1Pipeline, Image2Pipeline, Coron3Pipeline
 from scipy.ndimage import gaussian_filter, median_filter
 from scipy.ndimage import shift as spline_shift
@@ -54,14 +56,93 @@ file = open(path, 'r')
 filter_shifts_jarron = json.load(file)
 file.close()
 
+class _RecordHandler(logging.Handler):
+    """
+    Logging handler that stores the log records of a worker process so that
+    they can be emitted in order by the main process.
+    
+    """
+    
+    def __init__(self):
+        super(_RecordHandler, self).__init__()
+        self.records = []
+    
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records += [record]
+
+def _run_file(tools,
+              func,
+              key,
+              j,
+              output_dir,
+              args):
+    """
+    Run a per-file image manipulation step in a worker process.
+    
+    Parameters
+    ----------
+    tools : spaceKLIP.ImageTools
+        Image manipulation tools class on which the step shall be run. Only
+        contains the observation to be processed, see ImageTools._file_tools.
+    func : str
+        Name of the per-file image manipulation step.
+    key : str
+        Database key of the observation to be processed.
+    j : int
+        Database index of the observation to be processed.
+    output_dir : path
+        Path of the directory where the data products shall be saved.
+    args : tuple
+        Positional arguments for the per-file image manipulation step.
+    
+    Returns
+    -------
+    update : dict
+        Keyword arguments for spaceKLIP.Database.update_obs.
+    resident : tuple of dict
+        New resident observation and PSF mask of the in-memory session.
+    records : list of logging.LogRecord
+        Log records of the worker process.
+    
+    """
+    
+    # Capture the log records of the worker process.
+    logger = logging.getLogger('spaceKLIP')
+    handler = _RecordHandler()
+    propagate = logger.propagate
+    logger.addHandler(handler)
+    logger.propagate = False
+    
+    # Run per-file image manipulation step.
+    try:
+        update = getattr(tools, func)(key, j, output_dir, *args)
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = propagate
+    
+    return update, (tools._resident_obs, tools._resident_msk), handler.records
+
 class ImageTools():
     """
     The spaceKLIP image manipulation tools class.
     
+    In the in-memory session mode, the data products of each step are kept
+    resident instead of being written to FITS files. The spaceKLIP database is
+    updated as usual, i.e., it points to the FITS files that would have been
+    written by each step, but these files are only written to disk when the
+    'checkpoint' routine is called. Make sure to call it before running any
+    routine outside of the image manipulation tools on the data.
+    
     """
     
     def __init__(self,
-                 database):
+                 database,
+                 inmemory=False,
+                 n_jobs=1,
+                 use_cache=False):
         """
         Initialize the spaceKLIP image manipulation tools class.
         
@@ -70,6 +151,22 @@ class ImageTools():
         database : spaceKLIP.Database
             SpaceKLIP database on which the image manipulation steps shall be
             run.
+        inmemory : bool, optional
+            Keep the data products resident in memory across steps and only
+            write them to FITS files when the 'checkpoint' routine is called?
+            The default is False.
+        n_jobs : int, optional
+            Number of worker processes across which the per-file image
+            manipulation steps shall be spread. If -1, use all available CPUs.
+            The default is 1.
+        use_cache : bool, optional
+            Skip the per-file image manipulation steps if their data products
+            already exist in the output directory and were computed from the
+            same input files with the same parameters? Files are identified by
+            their path, size, and modification time. Cached data products are
+            recorded in a 'step_cache.json' file in each output directory and
+            can be invalidated with the 'clear_cache' routine. The cache is not
+            used in the in-memory session mode. The default is False.
         
         Returns
         -------
@@ -80,6 +177,601 @@ class ImageTools():
         # Make an internal alias of the spaceKLIP database class.
         self.database = database
         
+        # Set up the in-memory session.
+        self.inmemory = inmemory
+        self._resident_obs = {}
+        self._resident_msk = {}
+        
+        # Set number of worker processes.
+        self.n_jobs = n_jobs
+        
+        # Set up the step cache.
+        self.use_cache = use_cache
+        
+        pass
+    
+    
+    def _file_tools(self,
+                    key,
+                    j):
+        """
+        Make a copy of the image manipulation tools class which only contains
+        a single observation, so that only the data of this observation needs
+        to be sent to a worker process.
+        
+        Parameters
+        ----------
+        key : str
+            Database key of the observation.
+        j : int
+            Database index of the observation. In the copy, the observation
+            has the database index 0.
+        
+        Returns
+        -------
+        tools : spaceKLIP.ImageTools
+            Image manipulation tools class which only contains the
+            observation and its resident data products.
+        
+        """
+        
+        # Make single observation database.
+        database = copy(self.database)
+        database.obs = {key: self.database.obs[key][j:j + 1].copy()}
+        database.red = {}
+        database.src = {}
+        database.history = {}
+        
+        # Make single observation image manipulation tools class.
+        tools = copy(self)
+        tools.database = database
+        tools.n_jobs = 1
+        tools.use_cache = False
+        fitsfile = self.database.obs[key]['FITSFILE'][j]
+        maskfile = self.database.obs[key]['MASKFILE'][j]
+        tools._resident_obs = {}
+        if fitsfile in self._resident_obs:
+            tools._resident_obs[fitsfile] = self._resident_obs[fitsfile]
+        tools._resident_msk = {}
+        if maskfile in self._resident_msk:
+            tools._resident_msk[maskfile] = self._resident_msk[maskfile]
+        
+        return tools
+    
+    def _run_files(self,
+                   func,
+                   output_dir,
+                   *args):
+        """
+        Run a per-file image manipulation step on all FITS files of all
+        concatenations, either serially or spread across a pool of worker
+        processes. The spaceKLIP database is always updated by the main
+        process in the order of the FITS files and the log records of each
+        FITS file are emitted in the same order. FITS files whose data
+        products are found in the step cache are not processed again.
+        
+        Parameters
+        ----------
+        func : str
+            Name of the per-file image manipulation step. It must take the
+            database key and index of the observation to be processed and the
+            output directory followed by the positional arguments 'args', and
+            it must return the keyword arguments for
+            spaceKLIP.Database.update_obs.
+        output_dir : path
+            Path of the directory where the data products shall be saved.
+        *args : tuple
+            Positional arguments for the per-file image manipulation step.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Get number of worker processes.
+        n_jobs = self.n_jobs
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count()
+        
+        # Load step cache.
+        cache = self._load_cache(output_dir)
+        
+        # Run serially.
+        if n_jobs == 1:
+            for i, key in enumerate(self.database.obs.keys()):
+                log.info('--> Concatenation ' + key)
+                nfitsfiles = len(self.database.obs[key])
+                for j in range(nfitsfiles):
+                    ckey, update = self._lookup_cache(cache, func, key, j, output_dir, args)
+                    if update is None:
+                        update = getattr(self, func)(key, j, output_dir, *args)
+                        self._store_cache(cache, ckey, update)
+                    self.database.update_obs(key, j, **update)
+        
+        # Run in parallel.
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                
+                # Submit all FITS files of all concatenations which are not
+                # in the step cache.
+                futures = {}
+                cached = {}
+                for i, key in enumerate(self.database.obs.keys()):
+                    nfitsfiles = len(self.database.obs[key])
+                    for j in range(nfitsfiles):
+                        cached[(key, j)] = self._lookup_cache(cache, func, key, j, output_dir, args)
+                        if cached[(key, j)][1] is not None:
+                            continue
+                        futures[(key, j)] = executor.submit(_run_file, self._file_tools(key, j), func, key, 0, output_dir, args)
+                
+                # Collect results in order.
+                for i, key in enumerate(self.database.obs.keys()):
+                    log.info('--> Concatenation ' + key)
+                    nfitsfiles = len(self.database.obs[key])
+                    for j in range(nfitsfiles):
+                        ckey, update = cached[(key, j)]
+                        if update is None:
+                            update, (resident_obs, resident_msk), records = futures[(key, j)].result()
+                            for record in records:
+                                logging.getLogger(record.name).handle(record)
+                            self._store_cache(cache, ckey, update)
+                            
+                            # Merge in-memory session.
+                            self._resident_obs.pop(self.database.obs[key]['FITSFILE'][j], None)
+                            self._resident_obs.update(resident_obs)
+                            self._resident_msk.pop(self.database.obs[key]['MASKFILE'][j], None)
+                            self._resident_msk.update(resident_msk)
+                        
+                        # Update spaceKLIP database.
+                        self.database.update_obs(key, j, **update)
+        
+        # Save step cache.
+        self._save_cache(cache, output_dir)
+        
+        # Save spaceKLIP database.
+        self._save_database()
+        
+        pass
+    
+    def _file_stamp(self,
+                    path):
+        """
+        Get the stamp by which the step cache identifies a file. The file
+        content is not read.
+        
+        Parameters
+        ----------
+        path : path
+            Path of the input file.
+        
+        Returns
+        -------
+        stamp : list
+            Absolute path, size (bytes), and modification time (ns) of the
+            file.
+        
+        """
+        
+        # Get file stamp.
+        stat = os.stat(path)
+        
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    
+    def _cache_param(self,
+                     val):
+        """
+        Get the JSON representation of a step parameter which json cannot
+        serialize for the step cache key. Arrays are represented by a hash of
+        their full content, because their string representation is
+        abbreviated for large arrays.
+        
+        Parameters
+        ----------
+        val : object
+            Step parameter.
+        
+        Returns
+        -------
+        param : str or list
+            JSON representation of the step parameter.
+        
+        """
+        
+        # Hash array content.
+        if isinstance(val, (np.ndarray, np.generic)):
+            temp = hashlib.sha256(np.ascontiguousarray(val).tobytes())
+            return ['ndarray', str(val.dtype), list(np.shape(val)), temp.hexdigest()]
+        
+        return str(val)
+    
+    def _load_cache(self,
+                    output_dir):
+        """
+        Load the step cache of an output directory.
+        
+        Parameters
+        ----------
+        output_dir : path
+            Path of the directory where the data products shall be saved.
+        
+        Returns
+        -------
+        cache : dict or None
+            Step cache which maps the cache keys to the spaceKLIP database
+            updates and the hashes of the data products. None if the step
+            cache is not used.
+        
+        """
+        
+        # Load step cache.
+        if not self.use_cache or self.inmemory:
+            return None
+        cache = {}
+        cachefile = os.path.join(output_dir, 'step_cache.json')
+        if os.path.exists(cachefile):
+            try:
+                with open(cachefile, 'r') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+        
+        return cache
+    
+    def _save_cache(self,
+                    cache,
+                    output_dir):
+        """
+        Save the step cache of an output directory.
+        
+        Parameters
+        ----------
+        cache : dict or None
+            Step cache, see _load_cache.
+        output_dir : path
+            Path of the directory where the data products shall be saved.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Save step cache.
+        if cache is not None:
+            cachefile = os.path.join(output_dir, 'step_cache.json')
+            with open(cachefile + '.temp', 'w') as f:
+                json.dump(cache, f)
+            os.replace(cachefile + '.temp', cachefile)
+        
+        pass
+    
+    def _lookup_cache(self,
+                      cache,
+                      func,
+                      key,
+                      j,
+                      output_dir,
+                      args):
+        """
+        Look up a per-file image manipulation step in the step cache. The
+        cache key is computed from the name of the step, its parameters, the
+        stamps (path, size, and modification time) of the input FITS file and
+        PSF mask, and the metadata of the observation in the spaceKLIP
+        database. A cached data product is only used if it still exists and
+        its stamp has not changed since it has been written.
+        
+        Parameters
+        ----------
+        cache : dict or None
+            Step cache, see _load_cache.
+        func : str
+            Name of the per-file image manipulation step.
+        key : str
+            Database key of the observation to be processed.
+        j : int
+            Database index of the observation to be processed.
+        output_dir : path
+            Path of the directory where the data products shall be saved.
+        args : tuple
+            Positional arguments for the per-file image manipulation step.
+        
+        Returns
+        -------
+        ckey : str or None
+            Cache key. None if the step cache is not used.
+        update : dict or None
+            Cached keyword arguments for spaceKLIP.Database.update_obs. None
+            if the step is not in the step cache.
+        
+        """
+        
+        # Compute cache key.
+        if cache is None:
+            return None, None
+        obs = self.database.obs[key]
+        fitsfile = obs['FITSFILE'][j]
+        maskfile = obs['MASKFILE'][j]
+        params = {'func': func,
+                  'output_dir': os.path.abspath(output_dir),
+                  'args': args,
+                  'row': {name: str(obs[name][j]) for name in obs.colnames if name not in ['FITSFILE', 'MASKFILE']},
+                  'fitsfile': self._file_stamp(fitsfile),
+                  'maskfile': 'NONE' if maskfile == 'NONE' else self._file_stamp(maskfile)}
+        ckey = hashlib.sha256(json.dumps(params, sort_keys=True, default=self._cache_param).encode()).hexdigest()
+        
+        # Look up cached data products.
+        if ckey in cache:
+            try:
+                if all(self._file_stamp(path) == stamp for path, stamp in cache[ckey]['stamps'].items()):
+                    head, tail = os.path.split(fitsfile)
+                    log.info('  --> Step cache: skipping ' + func.strip('_').replace('_file', '') + ' for ' + tail + ', using cached ' + os.path.split(cache[ckey]['update']['fitsfile'])[1])
+                    return ckey, cache[ckey]['update']
+            except (KeyError, OSError):
+                pass
+        
+        return ckey, None
+    
+    def _store_cache(self,
+                     cache,
+                     ckey,
+                     update):
+        """
+        Store a per-file image manipulation step in the step cache.
+        
+        Parameters
+        ----------
+        cache : dict or None
+            Step cache, see _load_cache.
+        ckey : str or None
+            Cache key, see _lookup_cache.
+        update : dict
+            Keyword arguments for spaceKLIP.Database.update_obs.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Store data products.
+        if cache is not None:
+            update = {name: val.item() if isinstance(val, np.generic) else val for name, val in update.items()}
+            paths = [update['fitsfile']]
+            if update.get('maskfile', 'NONE') not in [None, 'NONE']:
+                paths += [update['maskfile']]
+            cache[ckey] = {'update': update,
+                           'stamps': {path: self._file_stamp(path) for path in paths}}
+        
+        pass
+    
+    def clear_cache(self,
+                    subdir=None):
+        """
+        Invalidate the step cache so that the next run of the per-file image
+        manipulation steps recomputes their data products. The data products
+        themselves are not deleted. Alternatively, set ImageTools.use_cache =
+        False to force a rerun without invalidating the cache.
+        
+        Parameters
+        ----------
+        subdir : str, optional
+            Name of the output directory whose step cache shall be cleared. If
+            None, the step caches of all output directories are cleared. The
+            default is None.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Clear step cache.
+        if subdir is None:
+            subdirs = [subdir for subdir in os.listdir(self.database.output_dir) if os.path.isdir(os.path.join(self.database.output_dir, subdir))]
+        else:
+            subdirs = [subdir]
+        for subdir in subdirs:
+            cachefile = os.path.join(self.database.output_dir, subdir, 'step_cache.json')
+            if os.path.exists(cachefile):
+                os.remove(cachefile)
+        
+        pass
+    
+    def _save_database(self):
+        """
+        Save the spaceKLIP database after an image manipulation step if its
+        autosave mode is enabled. In the in-memory session mode, the database
+        is only saved by the 'checkpoint' routine because it points to FITS
+        files which have not been written yet.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Save spaceKLIP database.
+        if self.database.autosave and not self.inmemory:
+            self.database.save()
+        
+        pass
+    
+    def _read_obs(self,
+                  fitsfile):
+        """
+        Read an observation from the in-memory session or from its FITS file.
+        
+        Parameters
+        ----------
+        fitsfile : path
+            Path of input FITS file.
+        
+        Returns
+        -------
+        See spaceKLIP.utils.read_obs.
+        
+        """
+        
+        # Read observation.
+        if fitsfile in self._resident_obs:
+            obs = self._resident_obs[fitsfile]
+            return obs['data'], obs['erro'], obs['pxdq'], obs['head_pri'], obs['head_sci'], obs['is2d'], obs['imshifts'], obs['maskoffs']
+        else:
+            return ut.read_obs(fitsfile)
+    
+    def _write_obs(self,
+                   fitsfile,
+                   output_dir,
+                   data,
+                   erro,
+                   pxdq,
+                   head_pri,
+                   head_sci,
+                   is2d,
+                   imshifts=None,
+                   maskoffs=None):
+        """
+        Write an observation to the in-memory session or to a FITS file. The
+        headers have been read from existing FITS files and are not verified
+        again.
+        
+        Parameters
+        ----------
+        See spaceKLIP.utils.write_obs.
+        
+        Returns
+        -------
+        fitsfile : path
+            Path of output FITS file. In the in-memory session mode, this file
+            is only written to disk by the 'checkpoint' routine.
+        
+        """
+        
+        # Write observation.
+        if self.inmemory:
+            try:
+                srcfile = self._resident_obs.pop(fitsfile)['srcfile']
+            except KeyError:
+                srcfile = fitsfile
+            fitsfile = os.path.join(output_dir, os.path.split(fitsfile)[1])
+            self._resident_obs[fitsfile] = {'data': data,
+                                            'erro': erro,
+                                            'pxdq': pxdq,
+                                            'head_pri': head_pri,
+                                            'head_sci': head_sci,
+                                            'is2d': is2d,
+                                            'imshifts': imshifts,
+                                            'maskoffs': maskoffs,
+                                            'srcfile': srcfile}
+            return fitsfile
+        else:
+            return ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs, output_verify='ignore')
+    
+    def _read_msk(self,
+                  maskfile):
+        """
+        Read a PSF mask from the in-memory session or from its FITS file.
+        
+        Parameters
+        ----------
+        maskfile : path
+            Path of input PSF mask.
+        
+        Returns
+        -------
+        See spaceKLIP.utils.read_msk.
+        
+        """
+        
+        # Read PSF mask.
+        if maskfile in self._resident_msk:
+            return self._resident_msk[maskfile]['mask']
+        else:
+            return ut.read_msk(maskfile)
+    
+    def _write_msk(self,
+                   maskfile,
+                   mask,
+                   fitsfile):
+        """
+        Write a PSF mask to the in-memory session or to a FITS file.
+        
+        Parameters
+        ----------
+        See spaceKLIP.utils.write_msk.
+        
+        Returns
+        -------
+        maskfile : path
+            Path of output PSF mask. In the in-memory session mode, this file
+            is only written to disk by the 'checkpoint' routine.
+        
+        """
+        
+        # Write PSF mask.
+        if self.inmemory:
+            if mask is None:
+                return 'NONE'
+            try:
+                srcfile = self._resident_msk.pop(maskfile)['srcfile']
+            except KeyError:
+                srcfile = maskfile
+            maskfile = fitsfile.replace('.fits', '_psfmask.fits')
+            self._resident_msk[maskfile] = {'mask': mask,
+                                            'fitsfile': fitsfile,
+                                            'srcfile': srcfile}
+            return maskfile
+        else:
+            return ut.write_msk(maskfile, mask, fitsfile, output_verify='ignore')
+    
+    def checkpoint(self,
+                   release=False):
+        """
+        Write all observations and PSF masks of the in-memory session to FITS
+        files. The output paths are those recorded in the spaceKLIP database
+        by the steps that produced the data.
+        
+        Parameters
+        ----------
+        release : bool, optional
+            Release the resident data after writing them to FITS files? If
+            False, the following steps will continue to use the resident data.
+            The default is False.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Write observations.
+        for fitsfile in self._resident_obs.keys():
+            obs = self._resident_obs[fitsfile]
+            if obs['srcfile'] == fitsfile:
+                continue
+            head, tail = os.path.split(fitsfile)
+            log.info('  --> Checkpoint: ' + tail)
+            ut.write_obs(obs['srcfile'], head, obs['data'], obs['erro'], obs['pxdq'], obs['head_pri'], obs['head_sci'], obs['is2d'], obs['imshifts'], obs['maskoffs'], output_verify='ignore')
+            obs['srcfile'] = fitsfile
+        
+        # Write PSF masks.
+        for maskfile in self._resident_msk.keys():
+            msk = self._resident_msk[maskfile]
+            if msk['srcfile'] == maskfile:
+                continue
+            ut.write_msk(msk['srcfile'], msk['mask'], msk['fitsfile'], output_verify='ignore')
+            msk['srcfile'] = maskfile
+        
+        # Release resident data.
+        if release:
+            self._resident_obs = {}
+            self._resident_msk = {}
+        
+        # Save spaceKLIP database. Its FITS files now exist on disk.
+        if self.database.autosave:
+            self.database.save()
+        
         pass
     
     def remove_frames(self,
@@ -133,9 +825,9 @@ class ImageTools():
                 
                 # Read FITS file and PSF mask.
                 fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
+                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
                 maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
+                mask = self._read_msk(maskfile)
                 nints = self.database.obs[key]['NINTS'][j]
                 
                 # Skip file types that are not in the list of types.
@@ -160,11 +852,14 @@ class ImageTools():
                 
                 # Write FITS file and PSF mask.
                 head_pri['NINTS'] = nints
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
+                fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+                maskfile = self._write_msk(maskfile, mask, fitsfile)
                 
                 # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile, nints=nints)
+                self.database.update_obs(key, j, fitsfile, maskfile, nints=nints, bunit=head_sci['BUNIT'])
+        
+        # Save spaceKLIP database.
+        self._save_database()
         
         pass
     
@@ -206,49 +901,60 @@ class ImageTools():
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         
-        # Loop through concatenations.
-        for i, key in enumerate(self.database.obs.keys()):
-            log.info('--> Concatenation ' + key)
-            
-            # Loop through FITS files.
-            nfitsfiles = len(self.database.obs[key])
-            for j in range(nfitsfiles):
-                
-                # Read FITS file and PSF mask.
-                fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
-                maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
-                crpix1 = self.database.obs[key]['CRPIX1'][j]
-                crpix2 = self.database.obs[key]['CRPIX2'][j]
-                
-                # Skip file types that are not in the list of types.
-                if self.database.obs[key]['TYPE'][j] in types:
-                    
-                    # Crop frames.
-                    head, tail = os.path.split(fitsfile)
-                    log.info('  --> Frame cropping: ' + tail)
-                    sh = data.shape
-                    data = data[:, npix[2]:-npix[3], npix[0]:-npix[1]]
-                    erro = erro[:, npix[2]:-npix[3], npix[0]:-npix[1]]
-                    pxdq = pxdq[:, npix[2]:-npix[3], npix[0]:-npix[1]]
-                    if mask is not None:
-                        mask = mask[npix[2]:-npix[3], npix[0]:-npix[1]]
-                    crpix1 -= npix[0]
-                    crpix2 -= npix[2]
-                    log.info('  --> Frame cropping: old shape = ' + str(sh[1:]) + ', new shape = ' + str(data.shape[1:]))
-                
-                # Write FITS file and PSF mask.
-                head_sci['CRPIX1'] = crpix1
-                head_sci['CRPIX2'] = crpix2
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
-                
-                # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile, crpix1=crpix1, crpix2=crpix2)
+        # Loop through concatenations and FITS files.
+        self._run_files('_crop_frames_file', output_dir, npix, types)
         
         pass
     
+    def _crop_frames_file(self,
+                          key,
+                          j,
+                          output_dir,
+                          npix,
+                          types):
+        """
+        Crop all frames of a single observation. See crop_frames for details.
+        
+        Returns
+        -------
+        update : dict
+            Keyword arguments for spaceKLIP.Database.update_obs.
+        
+        """
+        
+        # Read FITS file and PSF mask.
+        fitsfile = self.database.obs[key]['FITSFILE'][j]
+        data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
+        maskfile = self.database.obs[key]['MASKFILE'][j]
+        mask = self._read_msk(maskfile)
+        crpix1 = self.database.obs[key]['CRPIX1'][j]
+        crpix2 = self.database.obs[key]['CRPIX2'][j]
+        
+        # Skip file types that are not in the list of types.
+        if self.database.obs[key]['TYPE'][j] in types:
+            
+            # Crop frames.
+            head, tail = os.path.split(fitsfile)
+            log.info('  --> Frame cropping: ' + tail)
+            sh = data.shape
+            data = data[:, npix[2]:-npix[3], npix[0]:-npix[1]]
+            erro = erro[:, npix[2]:-npix[3], npix[0]:-npix[1]]
+            pxdq = pxdq[:, npix[2]:-npix[3], npix[0]:-npix[1]]
+            if mask is not None:
+                mask = mask[npix[2]:-npix[3], npix[0]:-npix[1]]
+            crpix1 -= npix[0]
+            crpix2 -= npix[2]
+            log.info('  --> Frame cropping: old shape = ' + str(sh[1:]) + ', new shape = ' + str(data.shape[1:]))
+        
+        # Write FITS file and PSF mask.
+        head_sci['CRPIX1'] = crpix1
+        head_sci['CRPIX2'] = crpix2
+        fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+        maskfile = self._write_msk(maskfile, mask, fitsfile)
+        
+        # Return spaceKLIP database update.
+        return {'fitsfile': fitsfile, 'maskfile': maskfile, 'crpix1': crpix1, 'crpix2': crpix2, 'bunit': head_sci['BUNIT']}
+    
     def pad_frames(self,
                    npix=1,
                    cval=np.nan,
@@ -300,9 +1006,9 @@ class ImageTools():
                 
                 # Read FITS file and PSF mask.
                 fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
+                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
                 maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
+                mask = self._read_msk(maskfile)
                 crpix1 = self.database.obs[key]['CRPIX1'][j]
                 crpix2 = self.database.obs[key]['CRPIX2'][j]
                 
@@ -325,11 +1031,14 @@ class ImageTools():
                 # Write FITS file and PSF mask.
                 head_sci['CRPIX1'] = crpix1
                 head_sci['CRPIX2'] = crpix2
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
+                fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+                maskfile = self._write_msk(maskfile, mask, fitsfile)
                 
                 # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile, crpix1=crpix1, crpix2=crpix2)
+                self.database.update_obs(key, j, fitsfile, maskfile, crpix1=crpix1, crpix2=crpix2, bunit=head_sci['BUNIT'])
+        
+        # Save spaceKLIP database.
+        self._save_database()
         
         pass
     
@@ -362,64 +1071,72 @@ class ImageTools():
         output_dir = os.path.join(self.database.output_dir, subdir)
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
-
-        # The starting value.
-        nframes0 = nframes
         
-        # Loop through concatenations.
-        for i, key in enumerate(self.database.obs.keys()):
-            log.info('--> Concatenation ' + key)
-            
-            # Loop through FITS files.
-            nfitsfiles = len(self.database.obs[key])
-            for j in range(nfitsfiles):
-                
-                # Read FITS file and PSF mask.
-                fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
-                maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
-                nints = self.database.obs[key]['NINTS'][j]
-                effinttm = self.database.obs[key]['EFFINTTM'][j]
-                
-                # If nframes is not provided, collapse everything.
-                if nframes0 is None:
-                    nframes = nints
-                
-                # Skip file types that are not in the list of types.
-                if self.database.obs[key]['TYPE'][j] in types:
-                    
-                    # Coadd frames.
-                    head, tail = os.path.split(fitsfile)
-                    log.info('  --> Frame coadding: ' + tail)
-                    ncoadds = data.shape[0] // nframes
-                    data = np.nanmedian(data[:nframes * ncoadds].reshape((nframes, ncoadds, data.shape[-2], data.shape[-1])), axis=0)
-                    erro_reshape = erro[:nframes * ncoadds].reshape((nframes, ncoadds, erro.shape[-2], erro.shape[-1]))
-                    nsample = np.sum(np.logical_not(np.isnan(erro_reshape)), axis=0)
-                    erro = np.true_divide(np.sqrt(np.nansum(erro_reshape**2, axis=0)), nsample)
-                    pxdq_temp = pxdq[:nframes * ncoadds].reshape((nframes, ncoadds, pxdq.shape[-2], pxdq.shape[-1]))
-                    pxdq = pxdq_temp[0]
-                    for k in range(1, nframes):
-                        pxdq = np.bitwise_or(pxdq, pxdq_temp[k])
-                    if imshifts is not None:
-                        imshifts = np.mean(imshifts[:nframes * ncoadds].reshape((nframes, ncoadds, imshifts.shape[-1])), axis=0)
-                    if maskoffs is not None:
-                        maskoffs = np.mean(maskoffs[:nframes * ncoadds].reshape((nframes, ncoadds, maskoffs.shape[-1])), axis=0)
-                    nints = data.shape[0]
-                    effinttm *= nframes
-                    log.info('  --> Frame coadding: %.0f coadd(s) of %.0f frame(s)' % (ncoadds, nframes))
-                
-                # Write FITS file and PSF mask.
-                head_pri['NINTS'] = nints
-                head_pri['EFFINTTM'] = effinttm
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
-                
-                # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile, nints=nints, effinttm=effinttm)
+        # Loop through concatenations and FITS files.
+        self._run_files('_coadd_frames_file', output_dir, nframes, types)
         
         pass
     
+    def _coadd_frames_file(self,
+                           key,
+                           j,
+                           output_dir,
+                           nframes,
+                           types):
+        """
+        Coadd frames of a single observation. See coadd_frames for details.
+        
+        Returns
+        -------
+        update : dict
+            Keyword arguments for spaceKLIP.Database.update_obs.
+        
+        """
+        
+        # Read FITS file and PSF mask.
+        fitsfile = self.database.obs[key]['FITSFILE'][j]
+        data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
+        maskfile = self.database.obs[key]['MASKFILE'][j]
+        mask = self._read_msk(maskfile)
+        nints = self.database.obs[key]['NINTS'][j]
+        effinttm = self.database.obs[key]['EFFINTTM'][j]
+        
+        # If nframes is not provided, collapse everything.
+        if nframes is None:
+            nframes = nints
+        
+        # Skip file types that are not in the list of types.
+        if self.database.obs[key]['TYPE'][j] in types:
+            
+            # Coadd frames.
+            head, tail = os.path.split(fitsfile)
+            log.info('  --> Frame coadding: ' + tail)
+            ncoadds = data.shape[0] // nframes
+            data = ut.temporal_median(data[:nframes * ncoadds].reshape((nframes, ncoadds, data.shape[-2], data.shape[-1])))
+            erro_reshape = erro[:nframes * ncoadds].reshape((nframes, ncoadds, erro.shape[-2], erro.shape[-1]))
+            nsample = np.sum(np.logical_not(np.isnan(erro_reshape)), axis=0)
+            erro = np.true_divide(np.sqrt(np.nansum(erro_reshape**2, axis=0)), nsample)
+            pxdq_temp = pxdq[:nframes * ncoadds].reshape((nframes, ncoadds, pxdq.shape[-2], pxdq.shape[-1]))
+            pxdq = pxdq_temp[0]
+            for k in range(1, nframes):
+                pxdq = np.bitwise_or(pxdq, pxdq_temp[k])
+            if imshifts is not None:
+                imshifts = np.mean(imshifts[:nframes * ncoadds].reshape((nframes, ncoadds, imshifts.shape[-1])), axis=0)
+            if maskoffs is not None:
+                maskoffs = np.mean(maskoffs[:nframes * ncoadds].reshape((nframes, ncoadds, maskoffs.shape[-1])), axis=0)
+            nints = data.shape[0]
+            effinttm *= nframes
+            log.info('  --> Frame coadding: %.0f coadd(s) of %.0f frame(s)' % (ncoadds, nframes))
+        
+        # Write FITS file and PSF mask.
+        head_pri['NINTS'] = nints
+        head_pri['EFFINTTM'] = effinttm
+        fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+        maskfile = self._write_msk(maskfile, mask, fitsfile)
+        
+        # Return spaceKLIP database update.
+        return {'fitsfile': fitsfile, 'maskfile': maskfile, 'nints': nints, 'effinttm': effinttm, 'bunit': head_sci['BUNIT']}
+    
     def subtract_median(self,
                         types=['SCI', 'SCI_TA', 'SCI_BG', 'REF', 'REF_TA', 'REF_BG'],
                         subdir='medsub'):
@@ -448,46 +1165,59 @@ class ImageTools():
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         
-        # Loop through concatenations.
-        for i, key in enumerate(self.database.obs.keys()):
-            log.info('--> Concatenation ' + key)
+        # Loop through concatenations and FITS files.
+        self._run_files('_subtract_median_file', output_dir, types)
+        
+        pass
+    
+    def _subtract_median_file(self,
+                              key,
+                              j,
+                              output_dir,
+                              types):
+        """
+        Subtract the median from each frame of a single observation. See
+        subtract_median for details.
+        
+        Returns
+        -------
+        update : dict
+            Keyword arguments for spaceKLIP.Database.update_obs.
+        
+        """
+        
+        # Read FITS file and PSF mask.
+        fitsfile = self.database.obs[key]['FITSFILE'][j]
+        data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
+        maskfile = self.database.obs[key]['MASKFILE'][j]
+        mask = self._read_msk(maskfile)
+        
+        # Skip file types that are not in the list of types.
+        if self.database.obs[key]['TYPE'][j] in types:
             
-            # Loop through FITS files.
-            nfitsfiles = len(self.database.obs[key])
-            for j in range(nfitsfiles):
-                
-                # Read FITS file and PSF mask.
-                fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
-                maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
-                
-                # Skip file types that are not in the list of types.
-                if self.database.obs[key]['TYPE'][j] in types:
-                    
-                    # Subtract median.
-                    head, tail = os.path.split(fitsfile)
-                    log.info('  --> Median subtraction: ' + tail)
-                    data_temp = data.copy()
-                    # if self.database.obs[key]['TELESCOP'][j] == 'JWST' and self.database.obs[key]['INSTRUME'][j] == 'NIRCAM':
-                    # data_temp[pxdq != 0] = np.nan
-                    data_temp[pxdq & 1 == 1] = np.nan
-                    # else:
-                    #     data_temp[pxdq & 1 == 1] = np.nan
-                    bg_med = np.nanmedian(data_temp, axis=(1, 2), keepdims=True)
-                    bg_std = robust.medabsdev(data_temp, axis=(1, 2), keepdims=True)
-                    bg_ind = data_temp > (bg_med + 5. * bg_std)  # clip bright PSFs for final calculation
-                    data_temp[bg_ind] = np.nan
-                    bg_med = np.nanmedian(data_temp, axis=(1, 2), keepdims=True)
-                    data -= bg_med
-                    log.info('  --> Median subtraction: mean of frame median = %.2f' % np.mean(bg_med))
-                
-                # Write FITS file and PSF mask.
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
-                
-                # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile)
+            # Subtract median.
+            head, tail = os.path.split(fitsfile)
+            log.info('  --> Median subtraction: ' + tail)
+            data_temp = data.copy()
+            # if self.database.obs[key]['TELESCOP'][j] == 'JWST' and self.database.obs[key]['INSTRUME'][j] == 'NIRCAM':
+            # data_temp[pxdq != 0] = np.nan
+            data_temp[pxdq & 1 == 1] = np.nan
+            # else:
+            #     data_temp[pxdq & 1 == 1] = np.nan
+            bg_med = np.nanmedian(data_temp, axis=(1, 2), keepdims=True)
+            bg_std = robust.medabsdev(data_temp, axis=(1, 2), keepdims=True)
+            bg_ind = data_temp > (bg_med + 5. * bg_std)  # clip bright PSFs for final calculation
+            data_temp[bg_ind] = np.nan
+            bg_med = np.nanmedian(data_temp, axis=(1, 2), keepdims=True)
+            data -= bg_med
+            log.info('  --> Median subtraction: mean of frame median = %.2f' % np.mean(bg_med))
+        
+        # Write FITS file and PSF mask.
+        fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+        maskfile = self._write_msk(maskfile, mask, fitsfile)
+        
+        # Return spaceKLIP database update.
+        return {'fitsfile': fitsfile, 'maskfile': maskfile, 'bunit': head_sci['BUNIT']}
     
     def subtract_background(self,
                             nsplit=1,
@@ -536,7 +1266,7 @@ class ImageTools():
                     
                     # Read science background file.
                     fitsfile = self.database.obs[key]['FITSFILE'][j]
-                    data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
+                    data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
                     
                     # Compute median science background.
                     sci_bg_data += [data]
@@ -565,7 +1295,7 @@ class ImageTools():
                     
                     # Read reference background file.
                     fitsfile = self.database.obs[key]['FITSFILE'][j]
-                    data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
+                    data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
                     
                     # Compute median reference background.
                     ref_bg_data += [data]
@@ -598,9 +1328,9 @@ class ImageTools():
                 
                 # Read FITS file and PSF mask.
                 fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
+                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
                 maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
+                mask = self._read_msk(maskfile)
                 
                 # Subtract background.
                 head, tail = os.path.split(fitsfile)
@@ -675,11 +1405,14 @@ class ImageTools():
                     pxdq = np.concatenate(pxdq_split, axis=0)
                 
                 # Write FITS file and PSF mask.
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
+                fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+                maskfile = self._write_msk(maskfile, mask, fitsfile)
                 
                 # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile)
+                self.database.update_obs(key, j, fitsfile, maskfile, bunit=head_sci['BUNIT'])
+        
+        # Save spaceKLIP database.
+        self._save_database()
         
         pass
     
@@ -762,66 +1495,83 @@ class ImageTools():
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         
-        # Loop through concatenations.
-        for i, key in enumerate(self.database.obs.keys()):
-            log.info('--> Concatenation ' + key)
-            
-            # Loop through FITS files.
-            nfitsfiles = len(self.database.obs[key])
-            for j in range(nfitsfiles):
-                
-                # Read FITS file and PSF mask.
-                fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
-                maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
-                
-                # Skip file types that are not in the list of types.
-                if self.database.obs[key]['TYPE'][j] in types:
-                    
-                    # Call bad pixel cleaning routines.
-                    pxdq_temp = pxdq.copy()
-                    # if self.database.obs[key]['TELESCOP'][j] == 'JWST' and self.database.obs[key]['INSTRUME'][j] == 'NIRCAM':
-                    #     pxdq_temp = (pxdq_temp != 0) & np.logical_not(pxdq_temp & 512 == 512)
-                    # else:
-                    pxdq_temp = (np.isnan(data) | (pxdq_temp & 1 == 1)) & np.logical_not(pxdq_temp & 512 == 512)
-                    method_split = method.split('+')
-                    for k in range(len(method_split)):
-                        head, tail = os.path.split(fitsfile)
-                        if method_split[k] == 'bpclean':
-                            log.info('  --> Method ' + method_split[k] + ': ' + tail)
-                            self.find_bad_pixels_bpclean(data, erro, pxdq_temp, pxdq & 512 == 512, bpclean_kwargs)
-                        elif method_split[k] == 'custom':
-                            log.info('  --> Method ' + method_split[k] + ': ' + tail)
-                            if self.database.obs[key]['TYPE'][j] not in ['SCI_TA', 'REF_TA']:
-                                self.find_bad_pixels_custom(data, erro, pxdq_temp, key, custom_kwargs)
-                            else:
-                                log.info('  --> Method ' + method_split[k] + ': skipped because TA file')
-                        elif method_split[k] == 'timemed':
-                            log.info('  --> Method ' + method_split[k] + ': ' + tail)
-                            self.fix_bad_pixels_timemed(data, erro, pxdq_temp, timemed_kwargs)
-                        elif method_split[k] == 'dqmed':
-                            log.info('  --> Method ' + method_split[k] + ': ' + tail)
-                            self.fix_bad_pixels_dqmed(data, erro, pxdq_temp, dqmed_kwargs)
-                        elif method_split[k] == 'medfilt':
-                            log.info('  --> Method ' + method_split[k] + ': ' + tail)
-                            self.fix_bad_pixels_medfilt(data, erro, pxdq_temp, medfilt_kwargs)
-                        else:
-                            log.info('  --> Unknown method ' + method_split[k] + ': skipped')
-                    # if self.database.obs[key]['TELESCOP'][j] == 'JWST' and self.database.obs[key]['INSTRUME'][j] == 'NIRCAM':
-                    #     pxdq[(pxdq != 0) & np.logical_not(pxdq & 512 == 512) & (pxdq_temp == 0)] = 0
-                    # else:
-                    # pxdq[(pxdq & 1 == 1) & np.logical_not(pxdq & 512 == 512) & (pxdq_temp == 0)] = 0
-                
-                # Write FITS file and PSF mask.
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
-                
-                # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile)
+        # Loop through concatenations and FITS files.
+        self._run_files('_fix_bad_pixels_file', output_dir, method, bpclean_kwargs, custom_kwargs, timemed_kwargs, dqmed_kwargs, medfilt_kwargs, types)
         
         pass
     
+    def _fix_bad_pixels_file(self,
+                             key,
+                             j,
+                             output_dir,
+                             method,
+                             bpclean_kwargs,
+                             custom_kwargs,
+                             timemed_kwargs,
+                             dqmed_kwargs,
+                             medfilt_kwargs,
+                             types):
+        """
+        Identify and fix bad pixels of a single observation. See fix_bad_pixels
+        for details.
+        
+        Returns
+        -------
+        update : dict
+            Keyword arguments for spaceKLIP.Database.update_obs.
+        
+        """
+        
+        # Read FITS file and PSF mask.
+        fitsfile = self.database.obs[key]['FITSFILE'][j]
+        data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
+        maskfile = self.database.obs[key]['MASKFILE'][j]
+        mask = self._read_msk(maskfile)
+        
+        # Skip file types that are not in the list of types.
+        if self.database.obs[key]['TYPE'][j] in types:
+            
+            # Call bad pixel cleaning routines.
+            pxdq_temp = pxdq.copy()
+            # if self.database.obs[key]['TELESCOP'][j] == 'JWST' and self.database.obs[key]['INSTRUME'][j] == 'NIRCAM':
+            #     pxdq_temp = (pxdq_temp != 0) & np.logical_not(pxdq_temp & 512 == 512)
+            # else:
+            pxdq_temp = (np.isnan(data) | (pxdq_temp & 1 == 1)) & np.logical_not(pxdq_temp & 512 == 512)
+            method_split = method.split('+')
+            for k in range(len(method_split)):
+                head, tail = os.path.split(fitsfile)
+                if method_split[k] == 'bpclean':
+                    log.info('  --> Method ' + method_split[k] + ': ' + tail)
+                    self.find_bad_pixels_bpclean(data, erro, pxdq_temp, pxdq & 512 == 512, bpclean_kwargs)
+                elif method_split[k] == 'custom':
+                    log.info('  --> Method ' + method_split[k] + ': ' + tail)
+                    if self.database.obs[key]['TYPE'][j] not in ['SCI_TA', 'REF_TA']:
+                        self.find_bad_pixels_custom(data, erro, pxdq_temp, key, custom_kwargs)
+                    else:
+                        log.info('  --> Method ' + method_split[k] + ': skipped because TA file')
+                elif method_split[k] == 'timemed':
+                    log.info('  --> Method ' + method_split[k] + ': ' + tail)
+                    self.fix_bad_pixels_timemed(data, erro, pxdq_temp, timemed_kwargs)
+                elif method_split[k] == 'dqmed':
+                    log.info('  --> Method ' + method_split[k] + ': ' + tail)
+                    self.fix_bad_pixels_dqmed(data, erro, pxdq_temp, dqmed_kwargs)
+                elif method_split[k] == 'medfilt':
+                    log.info('  --> Method ' + method_split[k] + ': ' + tail)
+                    self.fix_bad_pixels_medfilt(data, erro, pxdq_temp, medfilt_kwargs)
+                else:
+                    log.info('  --> Unknown method ' + method_split[k] + ': skipped')
+            # if self.database.obs[key]['TELESCOP'][j] == 'JWST' and self.database.obs[key]['INSTRUME'][j] == 'NIRCAM':
+            #     pxdq[(pxdq != 0) & np.logical_not(pxdq & 512 == 512) & (pxdq_temp == 0)] = 0
+            # else:
+            # pxdq[(pxdq & 1 == 1) & np.logical_not(pxdq & 512 == 512) & (pxdq_temp == 0)] = 0
+        
+        # Write FITS file and PSF mask.
+        fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+        maskfile = self._write_msk(maskfile, mask, fitsfile)
+        
+        # Return spaceKLIP database update.
+        return {'fitsfile': fitsfile, 'maskfile': maskfile, 'bunit': head_sci['BUNIT']}
+    
     def find_bad_pixels_bpclean(self,
                                 data,
                                 erro,
@@ -874,72 +1624,43 @@ class ImageTools():
         if 0 not in bpclean_kwargs['shift_y']:
             bpclean_kwargs['shift_y'] += [0]
         
-        # Pad data.
-        pad_left = np.abs(np.min(bpclean_kwargs['shift_x']))
-        pad_right = np.abs(np.max(bpclean_kwargs['shift_x']))
-        if pad_right == 0:
-            right = None
-        else:
-            right = -pad_right
-        pad_bottom = np.abs(np.min(bpclean_kwargs['shift_y']))
-        pad_top = np.abs(np.max(bpclean_kwargs['shift_y']))
-        if pad_top == 0:
-            top = None
-        else:
-            top = -pad_top
-        pad_vals = ((pad_bottom, pad_top), (pad_left, pad_right))
-        
         # Find bad pixels using median of neighbors.
         pxdq_orig = pxdq.copy()
         ww = pxdq != 0
         data_temp = data.copy()
         data_temp[ww] = np.nan
-        erro_temp = erro.copy()
-        erro_temp[ww] = np.nan
-        for i in range(ww.shape[0]):
-            
-            # Get median background and standard deviation.
-            bg_med = np.nanmedian(data_temp[i])
-            bg_std = robust.medabsdev(data_temp[i])
-            bg_ind = data[i] < (bg_med + 10. * bg_std)  # clip bright PSFs for final calculation
-            bg_med = np.nanmedian(data_temp[i][bg_ind])
-            bg_std = robust.medabsdev(data_temp[i][bg_ind])
-            
-            # Create initial mask of large negative values.
-            ww[i] = ww[i] | (data[i] < bg_med - bpclean_kwargs['sigclip'] * bg_std)
+        
+        # Get median background and standard deviation.
+        bg_med = np.nanmedian(data_temp, axis=(1, 2), keepdims=True)
+        bg_std = robust.medabsdev(data_temp, axis=(1, 2), keepdims=True)
+        bg_ind = data < (bg_med + 10. * bg_std)  # clip bright PSFs for final calculation
+        data_bg = np.where(bg_ind, data_temp, np.nan)
+        bg_med = np.nanmedian(data_bg, axis=(1, 2), keepdims=True)
+        bg_std = robust.medabsdev(data_bg, axis=(1, 2), keepdims=True)
+        del data_bg
+        
+        # Create initial mask of large negative values.
+        ww = ww | (data < bg_med - bpclean_kwargs['sigclip'] * bg_std)
+        
+        # Loop through max 10 iterations. Frames without newly identified bad
+        # pixels are not iterated any further.
+        active = np.arange(ww.shape[0])
+        for it in range(10):
+            data_temp[ww] = np.nan
             
-            # Loop through max 10 iterations.
-            for it in range(10):
-                data_temp[i][ww[i]] = np.nan
-                erro_temp[i][ww[i]] = np.nan
-                
-                # Shift data. 
-                pad_data = np.pad(data_temp[i], pad_vals, mode='edge')
-                pad_erro = np.pad(erro_temp[i], pad_vals, mode='edge')
-                data_arr = []
-                erro_arr = []
-                for ix in bpclean_kwargs['shift_x']:
-                    for iy in bpclean_kwargs['shift_y']:
-                        if ix != 0 or iy != 0:
-                            data_arr += [np.roll(pad_data, (iy, ix), axis=(0, 1))]
-                            erro_arr += [np.roll(pad_erro, (iy, ix), axis=(0, 1))]
-                data_arr = np.array(data_arr)
-                data_arr = data_arr[:, pad_bottom:top, pad_left:right]
-                data_med = np.nanmedian(data_arr, axis=0)
-                diff = data[i] - data_med
-                data_std = np.nanstd(data_arr, axis=0)
-                # data_std = robust.medabsdev(data_arr, axis=0)
-                mask_new = diff > bpclean_kwargs['sigclip'] * data_std
-                nmask_new = np.sum(mask_new & np.logical_not(ww[i]))
-                # print('Iteration %.0f: %.0f bad pixels identified, %.0f are new' % (it + 1, np.sum(mask_new), nmask_new))
-                sys.stdout.write('\rFrame %.0f/%.0f, iteration %.0f' % (i + 1, ww.shape[0], it + 1))
-                sys.stdout.flush()
-                if it > 0 and nmask_new == 0:
+            # Compare each pixel to its neighbors.
+            data_med, data_std = ut.neighbor_median(data_temp[active], bpclean_kwargs['shift_x'], bpclean_kwargs['shift_y'], return_std=True)
+            diff = data[active] - data_med
+            mask_new = diff > bpclean_kwargs['sigclip'] * data_std
+            nmask_new = np.sum(mask_new & np.logical_not(ww[active]), axis=(1, 2))
+            log.info('  --> Method bpclean: iteration %.0f, %.0f frame(s)' % (it + 1, len(active)))
+            ww[active] = ww[active] | mask_new
+            if it > 0:
+                active = active[nmask_new != 0]
+                if len(active) == 0:
                     break
-                ww[i] = ww[i] | mask_new
-            ww[i][NON_SCIENCE[i]] = 0
-            pxdq[i][ww[i]] = 1
-        print('')
+        ww[NON_SCIENCE] = 0
+        pxdq[ww] = 1
         log.info('  --> Method bpclean: identified %.0f additional bad pixel(s) -- %.2f%%' % (np.sum(pxdq) - np.sum(pxdq_orig), 100. * (np.sum(pxdq) - np.sum(pxdq_orig)) / np.prod(pxdq.shape)))
         
         pass
@@ -1005,7 +1726,9 @@ class ImageTools():
             the routine to exclude the fixed bad pixels.
         timemed_kwargs : dict, optional
             Keyword arguments for the 'timemed' method. Available keywords are:
-            - n/a
+            - maxmem : int, optional
+                Maximum number of bytes used for the temporary arrays when
+                computing the time median. The default is 2**30.
             The default is {}.
         
         Returns
@@ -1014,15 +1737,20 @@ class ImageTools():
         
         """
         
-        # Fix bad pixels using time median.
+        # Check input.
+        if 'maxmem' not in timemed_kwargs.keys():
+            timemed_kwargs['maxmem'] = 2**30
+        
+        # Fix bad pixels using time median. Only compute the time median for
+        # pixels which are bad in some frames.
         ww = pxdq != 0
-        ww_all_bad = np.array([np.sum(ww, axis=0) == ww.shape[0]] * ww.shape[0])
-        ww_not_all_bad = ww & np.logical_not(ww_all_bad)
+        ww_not_all_bad = ww & np.logical_not(np.all(ww, axis=0))
         log.info('  --> Method timemed: fixing %.0f bad pixel(s) -- %.2f%%' % (np.sum(ww_not_all_bad), 100. * np.sum(ww_not_all_bad) / np.prod(ww_not_all_bad.shape)))
+        pixmask = np.any(ww_not_all_bad, axis=0)
         data[ww_not_all_bad] = np.nan
-        data[ww_not_all_bad] = np.array([np.nanmedian(data, axis=0)] * data.shape[0])[ww_not_all_bad]
+        data[ww_not_all_bad] = np.broadcast_to(ut.temporal_median(data, pixmask, timemed_kwargs['maxmem']), data.shape)[ww_not_all_bad]
         erro[ww_not_all_bad] = np.nan
-        erro[ww_not_all_bad] = np.array([np.nanmedian(erro, axis=0)] * erro.shape[0])[ww_not_all_bad]
+        erro[ww_not_all_bad] = np.broadcast_to(ut.temporal_median(erro, pixmask, timemed_kwargs['maxmem']), erro.shape)[ww_not_all_bad]
         pxdq[ww_not_all_bad] = 0
         
         pass
@@ -1071,47 +1799,22 @@ class ImageTools():
         if 0 not in dqmed_kwargs['shift_y']:
             dqmed_kwargs['shift_y'] += [0]
         
-        # Pad data.
-        pad_left = np.abs(np.min(dqmed_kwargs['shift_x']))
-        pad_right = np.abs(np.max(dqmed_kwargs['shift_x']))
-        if pad_right == 0:
-            right = None
-        else:
-            right = -pad_right
-        pad_bottom = np.abs(np.min(dqmed_kwargs['shift_y']))
-        pad_top = np.abs(np.max(dqmed_kwargs['shift_y']))
-        if pad_top == 0:
-            top = None
-        else:
-            top = -pad_top
-        pad_vals = ((0, 0), (pad_bottom, pad_top), (pad_left, pad_right))
-        
         # Fix bad pixels using median of neighbors.
         ww = pxdq != 0
         data_temp = data.copy()
         data_temp[ww] = np.nan
-        pad_data = np.pad(data_temp, pad_vals, mode='edge')
         erro_temp = erro.copy()
         erro_temp[ww] = np.nan
-        pad_erro = np.pad(erro_temp, pad_vals, mode='edge')
-        for i in range(ww.shape[0]):
-            data_arr = []
-            erro_arr = []
-            for ix in dqmed_kwargs['shift_x']:
-                for iy in dqmed_kwargs['shift_y']:
-                    if ix != 0 or iy != 0:
-                        data_arr += [np.roll(pad_data[i], (iy, ix), axis=(0, 1))]
-                        erro_arr += [np.roll(pad_erro[i], (iy, ix), axis=(0, 1))]
-            data_arr = np.array(data_arr)
-            data_arr = data_arr[:, pad_bottom:top, pad_left:right]
-            data_med = np.nanmedian(data_arr, axis=0)
-            ww[i][np.isnan(data_med)] = 0
-            data[i][ww[i]] = data_med[ww[i]]
-            erro_arr = np.array(erro_arr)
-            erro_arr = erro_arr[:, pad_bottom:top, pad_left:right]
-            erro_med = np.nanmedian(erro_arr, axis=0)
-            erro[i][ww[i]] = erro_med[ww[i]]
-            pxdq[i][ww[i]] = 0
+        index = np.nonzero(ww)
+        data_med = ut.neighbor_median(data_temp, dqmed_kwargs['shift_x'], dqmed_kwargs['shift_y'], index=index)
+        erro_med = ut.neighbor_median(erro_temp, dqmed_kwargs['shift_x'], dqmed_kwargs['shift_y'], index=index)
+        good = np.logical_not(np.isnan(data_med))
+        index = tuple(ind[good] for ind in index)
+        ww[:] = 0
+        ww[index] = 1
+        data[index] = data_med[good]
+        erro[index] = erro_med[good]
+        pxdq[index] = 0
         log.info('  --> Method dqmed: fixing %.0f bad pixel(s) -- %.2f%%' % (np.sum(ww), 100. * np.sum(ww) / np.prod(ww.shape)))
         
         pass
@@ -1192,39 +1895,51 @@ class ImageTools():
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         
-        # Loop through concatenations.
-        for i, key in enumerate(self.database.obs.keys()):
-            log.info('--> Concatenation ' + key)
-            
-            # Loop through FITS files.
-            nfitsfiles = len(self.database.obs[key])
-            for j in range(nfitsfiles):
-                
-                # Read FITS file and PSF mask.
-                fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
-                maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
-                
-                # Skip file types that are not in the list of types.
-                if self.database.obs[key]['TYPE'][j] in types:
-                    
-                    # Replace nans.
-                    head, tail = os.path.split(fitsfile)
-                    log.info('  --> Nan replacement: ' + tail)
-                    ww = np.isnan(data)
-                    data[ww] = cval
-                    log.info('  --> Nan replacement: replaced %.0f nan pixel(s) with value ' % (np.sum(ww)) + str(cval) + ' -- %.2f%%' % (100. * np.sum(ww)/np.prod(ww.shape)))
-                
-                # Write FITS file and PSF mask.
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
-                
-                # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile)
+        # Loop through concatenations and FITS files.
+        self._run_files('_replace_nans_file', output_dir, cval, types)
         
         pass
     
+    def _replace_nans_file(self,
+                           key,
+                           j,
+                           output_dir,
+                           cval,
+                           types):
+        """
+        Replace all nans in the data of a single observation. See replace_nans
+        for details.
+        
+        Returns
+        -------
+        update : dict
+            Keyword arguments for spaceKLIP.Database.update_obs.
+        
+        """
+        
+        # Read FITS file and PSF mask.
+        fitsfile = self.database.obs[key]['FITSFILE'][j]
+        data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
+        maskfile = self.database.obs[key]['MASKFILE'][j]
+        mask = self._read_msk(maskfile)
+        
+        # Skip file types that are not in the list of types.
+        if self.database.obs[key]['TYPE'][j] in types:
+            
+            # Replace nans.
+            head, tail = os.path.split(fitsfile)
+            log.info('  --> Nan replacement: ' + tail)
+            ww = np.isnan(data)
+            data[ww] = cval
+            log.info('  --> Nan replacement: replaced %.0f nan pixel(s) with value ' % (np.sum(ww)) + str(cval) + ' -- %.2f%%' % (100. * np.sum(ww)/np.prod(ww.shape)))
+        
+        # Write FITS file and PSF mask.
+        fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+        maskfile = self._write_msk(maskfile, mask, fitsfile)
+        
+        # Return spaceKLIP database update.
+        return {'fitsfile': fitsfile, 'maskfile': maskfile, 'bunit': head_sci['BUNIT']}
+    
     def blur_frames(self,
                     fact='auto',
                     types=['SCI', 'SCI_BG', 'REF', 'REF_BG'],
@@ -1262,68 +1977,81 @@ class ImageTools():
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         
-        # Loop through concatenations.
-        for i, key in enumerate(self.database.obs.keys()):
-            log.info('--> Concatenation ' + key)
+        # Loop through concatenations and FITS files.
+        self._run_files('_blur_frames_file', output_dir, fact, types)
+        
+        pass
+    
+    def _blur_frames_file(self,
+                          key,
+                          j,
+                          output_dir,
+                          fact,
+                          types):
+        """
+        Blur frames of a single observation with a Gaussian filter. See
+        blur_frames for details.
+        
+        Returns
+        -------
+        update : dict
+            Keyword arguments for spaceKLIP.Database.update_obs.
+        
+        """
+        
+        # Read FITS file.
+        fitsfile = self.database.obs[key]['FITSFILE'][j]
+        data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
+        maskfile = self.database.obs[key]['MASKFILE'][j]
+        mask = self._read_msk(maskfile)
+        
+        # Skip file types that are not in the list of types.
+        fact_temp = None
+        if self.database.obs[key]['TYPE'][j] in types:
             
-            # Loop through FITS files.
-            Nfitsfiles = len(self.database.obs[key])
-            for j in range(Nfitsfiles):
-                
-                # Read FITS file.
-                fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
-                maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
-                
-                # Skip file types that are not in the list of types.
-                fact_temp = None
-                if self.database.obs[key]['TYPE'][j] in types:
-                    
-                    # Blur frames.
-                    head, tail = os.path.split(fitsfile)
-                    log.info('  --> Frame blurring: ' + tail)
-                    try:
-                        fact_temp = fact[key][j]
-                    except:
-                        fact_temp = fact
-                    if self.database.obs[key]['TELESCOP'][j] == 'JWST':
-                        if self.database.obs[key]['EXP_TYPE'][j] in ['NRC_CORON']:
-                            diam = 5.2
-                        else:
-                            diam = 6.5
-                    else:
-                        raise UserWarning('Data originates from unknown telescope')
-                    if fact_temp is not None:
-                        if str(fact_temp) == 'auto':
-                            wave_min = self.database.obs[key]['CWAVEL'][j] - self.database.obs[key]['DWAVEL'][j]
-                            nyquist = wave_min * 1e-6 / diam * 180. / np.pi * 3600. * 1000. / 2.3  # see, e.g., Pawley 2006
-                            fact_temp = self.database.obs[key]['PIXSCALE'][j] / nyquist
-                            fact_temp /= np.sqrt(8. * np.log(2.))  # fix from Marshall
-                        log.info('  --> Frame blurring: factor = %.3f' % fact_temp)
-                        for k in range(data.shape[0]):
-                            data[k] = gaussian_filter(data[k], fact_temp)
-                            erro[k] = gaussian_filter(erro[k], fact_temp)
-                        if mask is not None:
-                            mask = gaussian_filter(mask, fact_temp)
-                    else:
-                        log.info('  --> Frame blurring: skipped')
-                
-                # Write FITS file.
-                if fact_temp is None:
-                    pass
+            # Blur frames.
+            head, tail = os.path.split(fitsfile)
+            log.info('  --> Frame blurring: ' + tail)
+            try:
+                fact_temp = fact[key][j]
+            except:
+                fact_temp = fact
+            if self.database.obs[key]['TELESCOP'][j] == 'JWST':
+                if self.database.obs[key]['EXP_TYPE'][j] in ['NRC_CORON']:
+                    diam = 5.2
                 else:
-                    head_pri['BLURFWHM'] = fact_temp
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
-                
-                # Update spaceKLIP database.
-                if fact_temp is None:
-                    self.database.update_obs(key, j, fitsfile, maskfile, blurfwhm=np.nan)
-                else:
-                    self.database.update_obs(key, j, fitsfile, maskfile, blurfwhm=fact_temp)
+                    diam = 6.5
+            else:
+                raise UserWarning('Data originates from unknown telescope')
+            if fact_temp is not None:
+                if str(fact_temp) == 'auto':
+                    wave_min = self.database.obs[key]['CWAVEL'][j] - self.database.obs[key]['DWAVEL'][j]
+                    nyquist = wave_min * 1e-6 / diam * 180. / np.pi * 3600. * 1000. / 2.3  # see, e.g., Pawley 2006
+                    fact_temp = self.database.obs[key]['PIXSCALE'][j] / nyquist
+                    fact_temp /= np.sqrt(8. * np.log(2.))  # fix from Marshall
+                log.info('  --> Frame blurring: factor = %.3f' % fact_temp)
+                for k in range(data.shape[0]):
+                    data[k] = gaussian_filter(data[k], fact_temp)
+                    erro[k] = gaussian_filter(erro[k], fact_temp)
+                if mask is not None:
+                    mask = gaussian_filter(mask, fact_temp)
+            else:
+                log.info('  --> Frame blurring: skipped')
         
-        pass
+        # Write FITS file.
+        if fact_temp is None:
+            pass
+        else:
+            head_pri['BLURFWHM'] = fact_temp
+        fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+        maskfile = self._write_msk(maskfile, mask, fitsfile)
+        
+        # Return spaceKLIP database update.
+        if fact_temp is None:
+            blurfwhm = np.nan
+        else:
+            blurfwhm = fact_temp
+        return {'fitsfile': fitsfile, 'maskfile': maskfile, 'blurfwhm': blurfwhm, 'bunit': head_sci['BUNIT']}
     
     def hpf(self,
             size='auto',
@@ -1372,9 +2100,9 @@ class ImageTools():
                 
                 # Read FITS file.
                 fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
+                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
                 maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
+                mask = self._read_msk(maskfile)
                 
                 # Skip file types that are not in the list of types.
                 fact_temp = None
@@ -1409,11 +2137,14 @@ class ImageTools():
                     pass
                 else:
                     head_pri['HPFSIZE'] = fact_temp
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
+                fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+                maskfile = self._write_msk(maskfile, mask, fitsfile)
                 
                 # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile)
+                self.database.update_obs(key, j, fitsfile, maskfile, bunit=head_sci['BUNIT'])
+        
+        # Save spaceKLIP database.
+        self._save_database()
         
         pass
     
@@ -1442,9 +2173,9 @@ class ImageTools():
                     
                     # Read FITS file and PSF mask.
                     fitsfile = self.database.obs[key]['FITSFILE'][j]
-                    data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
+                    data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
                     maskfile = self.database.obs[key]['MASKFILE'][j]
-                    mask = ut.read_msk(maskfile)
+                    mask = self._read_msk(maskfile)
                     
                     # Update current reference pixel position.
                     head, tail = os.path.split(fitsfile)
@@ -1483,7 +2214,10 @@ class ImageTools():
                     crpix2 += yoff
                     
                     # Update spaceKLIP database.
-                    self.database.update_obs(key, j, fitsfile, maskfile, crpix1=crpix1, crpix2=crpix2)
+                    self.database.update_obs(key, j, fitsfile, maskfile, crpix1=crpix1, crpix2=crpix2, bunit=head_sci['BUNIT'])
+        
+        # Save spaceKLIP database.
+        self._save_database()
         
         pass
     
@@ -1557,9 +2291,9 @@ class ImageTools():
                 
                 # Read FITS file and PSF mask.
                 fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
+                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
                 maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
+                mask = self._read_msk(maskfile)
                 
                 # Recenter frames. Use different algorithms based on data type.
                 head, tail = os.path.split(fitsfile)
@@ -1590,8 +2324,7 @@ class ImageTools():
                             # Apply the same shift to all SCI and REF frames.
                             shifts += [np.array([-(xc - data.shape[-1]//2), -(yc - data.shape[-2]//2)])]
                             maskoffs_temp += [np.array([xshift, yshift])]
-                            data[k] = ut.imshift(data[k], [shifts[k][0], shifts[k][1]], method=method, kwargs=kwargs)
-                            erro[k] = ut.imshift(erro[k], [shifts[k][0], shifts[k][1]], method=method, kwargs=kwargs)
+                        data[:], erro[:] = ut.imshift_cube(np.array([data, erro]), np.array(shifts), method=method, kwargs=kwargs)
                         if mask is not None:
                             # mask = ut.imshift(mask, [shifts[k][0], shifts[k][1]], method=method, kwargs=kwargs)
                             mask = spline_shift(mask, [shifts[k][1], shifts[k][0]], order=0, mode='constant', cval=np.nanmedian(mask))
@@ -1615,6 +2348,7 @@ class ImageTools():
                     
                     # Other data types.
                     else:
+                        ww_subpix = []
                         for k in range(data.shape[0]):
                             
                             # Recenter SCI and REF frames to subpixel precision
@@ -1624,19 +2358,21 @@ class ImageTools():
                                 pp = core.determine_origin(data[k], algo='BCEN')
                                 shifts += [np.array([-(pp[0] - data.shape[-1]//2), -(pp[1] - data.shape[-2]//2)])]
                                 maskoffs_temp += [np.array([0., 0.])]
-                                data[k] = ut.imshift(data[k], [shifts[k][0], shifts[k][1]], method=method, kwargs=kwargs)
-                                erro[k] = ut.imshift(erro[k], [shifts[k][0], shifts[k][1]], method=method, kwargs=kwargs)
+                                ww_subpix += [k]
                             else:
                                 shifts += [np.array([0., 0.])]
                                 maskoffs_temp += [np.array([0., 0.])]
+                        if len(ww_subpix) != 0:
+                            data[ww_subpix], erro[ww_subpix] = ut.imshift_cube(np.array([data[ww_subpix], erro[ww_subpix]]), np.array(shifts)[ww_subpix], method=method, kwargs=kwargs)
+                        for k in range(data.shape[0]):
                             
                             # Recenter SCI and REF frames to integer pixel
                             # precision by rolling the image.
                             ww_max = np.unravel_index(np.argmax(data[k]), data[k].shape)
                             if ww_max != (data.shape[-2]//2, data.shape[-1]//2):
                                 dx, dy = data.shape[-1]//2 - ww_max[1], data.shape[-2]//2 - ww_max[0]
-                                shifts[-1][0] += dx
-                                shifts[-1][1] += dy
+                                shifts[k][0] += dx
+                                shifts[k][1] += dy
                                 data[k] = np.roll(np.roll(data[k], dx, axis=1), dy, axis=0)
                                 erro[k] = np.roll(np.roll(erro[k], dx, axis=1), dy, axis=0)
                         xoffset = 0.  # mas
@@ -1658,16 +2394,16 @@ class ImageTools():
                                       args=(data[k], method, kwargs))['x']
                         shifts += [np.array([pp[0], pp[1]])]
                         maskoffs_temp += [np.array([0., 0.])]
-                        data[k] = ut.imshift(data[k], [shifts[k][0], shifts[k][1]], method=method, kwargs=kwargs)
-                        erro[k] = ut.imshift(erro[k], [shifts[k][0], shifts[k][1]], method=method, kwargs=kwargs)
+                    data[:], erro[:] = ut.imshift_cube(np.array([data, erro]), np.array(shifts), method=method, kwargs=kwargs)
+                    for k in range(data.shape[0]):
                         
                         # Recenter TA frames to integer pixel precision by
                         # rolling the image.
                         ww_max = np.unravel_index(np.argmax(data[k]), data[k].shape)
                         if ww_max != (data.shape[-2]//2, data.shape[-1]//2):
                             dx, dy = data.shape[-1]//2 - ww_max[1], data.shape[-2]//2 - ww_max[0]
-                            shifts[-1][0] += dx
-                            shifts[-1][1] += dy
+                            shifts[k][0] += dx
+                            shifts[k][1] += dy
                             data[k] = np.roll(np.roll(data[k], dx, axis=1), dy, axis=0)
                             erro[k] = np.roll(np.roll(erro[k], dx, axis=1), dy, axis=0)
                     xoffset = 0.  # mas
@@ -1698,11 +2434,14 @@ class ImageTools():
                 head_pri['YOFFSET'] = yoffset
                 head_sci['CRPIX1'] = crpix1
                 head_sci['CRPIX2'] = crpix2
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
+                fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+                maskfile = self._write_msk(maskfile, mask, fitsfile)
                 
                 # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile, xoffset=xoffset, yoffset=yoffset, crpix1=crpix1, crpix2=crpix2)
+                self.database.update_obs(key, j, fitsfile, maskfile, xoffset=xoffset, yoffset=yoffset, crpix1=crpix1, crpix2=crpix2, bunit=head_sci['BUNIT'])
+        
+        # Save spaceKLIP database.
+        self._save_database()
         
         pass
     
@@ -1776,7 +2515,7 @@ class ImageTools():
                   'date': date,
                   'use_coeff': use_coeff,
                   'sp': spectrum}
-        psf = JWST_PSF(INSTRUME, FILTER, CORONMSK, fov_pix, **kwargs)
+        psf = JWST_PSF.get(INSTRUME, FILTER, CORONMSK, fov_pix, **kwargs)
         
         # Get SIAF reference pixel position.
         apsiaf = psf.inst_on.siaf[self.database.obs[key]['APERNAME'][j]]
@@ -1872,8 +2611,11 @@ class ImageTools():
         ----------
         method : 'fourier' or 'spline' (not recommended), optional
             Method for shifting the frames. The default is 'fourier'.
-        align_algo : 'leastsq' or 'header'
+        align_algo : 'leastsq', 'fastlsq', or 'header'
             Algorithm to determine the alignment offsets. Default is 'leastsq',
+            'fastlsq' seeds the same least squares fit with an upsampled DFT
+            cross-correlation and solves it for all frames at once with
+            analytic Fourier-space Jacobians (always uses Fourier shifts),
             'header' assumes perfect header offsets. 
         kwargs : dict, optional
             Keyword arguments for the scipy.ndimage.shift routine. The default
@@ -1911,9 +2653,9 @@ class ImageTools():
                 
                 # Read FITS file and PSF mask.
                 fitsfile = self.database.obs[key]['FITSFILE'][j]
-                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile)
+                data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = self._read_obs(fitsfile)
                 maskfile = self.database.obs[key]['MASKFILE'][j]
-                mask = ut.read_msk(maskfile)
+                mask = self._read_msk(maskfile)
                 
                 # Align frames.
                 head, tail = os.path.split(fitsfile)
@@ -1945,14 +2687,25 @@ class ImageTools():
                         elif align_algo == 'header':
                             # Just assume the header values are correct
                             pp = p0
+                        elif align_algo == 'fastlsq':
+                            # Fit all frames at once below
+                            pp = p0
+                        else:
+                            raise UserWarning('Alignment algorithm "' + align_algo + '" is not known')
 
-                    # Append shifts to array and apply shift to image
-                    # using defined method. 
+                    # Append shifts to array.
                     shifts += [np.array([pp[0], pp[1], pp[2]])]
-                    if j != ww_sci[0] or k != 0:
-                        data[k] = ut.imshift(data[k], [shifts[k][0], shifts[k][1]], method=method, kwargs=kwargs)
-                        erro[k] = ut.imshift(erro[k], [shifts[k][0], shifts[k][1]], method=method, kwargs=kwargs)
                 shifts = np.array(shifts)
+                ww_shift = np.arange(data.shape[0])
+                if j == ww_sci[0]:
+                    ww_shift = ww_shift[1:]
+                if align_algo == 'fastlsq' and len(ww_shift) != 0:
+                    shifts[ww_shift] = ut.alignfast(data[ww_shift], ref_image, mask)
+                
+                # Apply shifts to images using defined method. The reference
+                # frame is not shifted.
+                if len(ww_shift) != 0:
+                    data[ww_shift], erro[ww_shift] = ut.imshift_cube(np.array([data[ww_shift], erro[ww_shift]]), shifts[ww_shift, :2], method=method, kwargs=kwargs)
                 if mask is not None:
                     if j != ww_sci[0]:
                         temp = np.median(shifts, axis=0)
@@ -1990,11 +2743,11 @@ class ImageTools():
                 head_pri['YOFFSET'] = yoffset
                 head_sci['CRPIX1'] = crpix1
                 head_sci['CRPIX2'] = crpix2
-                fitsfile = ut.write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
-                maskfile = ut.write_msk(maskfile, mask, fitsfile)
+                fitsfile = self._write_obs(fitsfile, output_dir, data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs)
+                maskfile = self._write_msk(maskfile, mask, fitsfile)
                 
                 # Update spaceKLIP database.
-                self.database.update_obs(key, j, fitsfile, maskfile, xoffset=xoffset, yoffset=yoffset, crpix1=crpix1, crpix2=crpix2)
+                self.database.update_obs(key, j, fitsfile, maskfile, xoffset=xoffset, yoffset=yoffset, crpix1=crpix1, crpix2=crpix2, bunit=head_sci['BUNIT'])
             
             # Plot science frame alignment.
             colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
@@ -2062,4 +2815,7 @@ class ImageTools():
             plt.savefig(output_file)
             plt.close()
         
+        # Save spaceKLIP database.
+        self._save_database()
+        
         pass
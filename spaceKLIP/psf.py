@@ -12,6 +12,13 @@ import os
 import pdb
 import sys
 
+import functools
+import hashlib
+import json
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 import astropy.io.fits as pyfits
 import matplotlib.pyplot as plt
 import numpy as np
@@ -24,7 +31,7 @@ from scipy.ndimage import rotate
 from scipy.ndimage import shift as spline_shift
 from scipy.optimize import minimize
 from spaceKLIP import utils as ut
-from tqdm import tqdm
+from webbpsf.mast_wss import get_opd_at_time
 from webbpsf_ext import NIRCam_ext, MIRI_ext
 from webbpsf_ext.coords import rtheta_to_xy
 from webbpsf_ext.image_manip import fourier_imshift, frebin, pad_or_cut_to_size
@@ -39,10 +46,332 @@ log.setLevel(logging.INFO)
 # MAIN
 # =============================================================================
 
+class PSFCache():
+    
+    def __init__(self,
+                 cache_dir=None,
+                 max_size=None):
+        """
+        Initialize the persistent on-disk cache of model PSFs. Each PSF is
+        stored as a NumPy file whose name is the hash of all parameters that
+        define it. The least recently used PSFs are evicted once the total
+        size of the cache exceeds its maximum size.
+        
+        Parameters
+        ----------
+        cache_dir : path, optional
+            Path of the cache directory. If None, it is read from the
+            SPACEKLIP_PSF_CACHE environment variable. The cache is disabled
+            unless a cache directory is configured. The default is None.
+        max_size : int, optional
+            Maximum size of the cache in bytes. If None, it is read from the
+            SPACEKLIP_PSF_CACHE_SIZE environment variable and defaults to
+            2**31. The default is None.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Set cache directory and size.
+        if cache_dir is None:
+            cache_dir = os.environ.get('SPACEKLIP_PSF_CACHE', '')
+        if max_size is None:
+            max_size = int(float(os.environ.get('SPACEKLIP_PSF_CACHE_SIZE', 2**31)))
+        if cache_dir.strip().lower() in ['', 'none']:
+            self.cache_dir = None
+        else:
+            self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        
+        pass
+    
+    @property
+    def enabled(self):
+        return self.cache_dir is not None
+    
+    def key(self,
+            **params):
+        """
+        Compute the cache key of a model PSF.
+        
+        Parameters
+        ----------
+        **params : keyword arguments
+            All parameters that define the model PSF. Arrays are converted to
+            lists and other objects to their string representation. The
+            WebbPSF and WebbPSF_ext versions are always included.
+        
+        Returns
+        -------
+        key : str
+            Cache key of the model PSF.
+        
+        """
+        
+        # Hash JSON representation of the parameters.
+        params['webbpsf_version'] = webbpsf.__version__
+        params['webbpsf_ext_version'] = webbpsf_ext.__version__
+        temp = json.dumps(params, sort_keys=True, default=lambda x: x.tolist() if hasattr(x, 'tolist') else str(x))
+        
+        return hashlib.sha256(temp.encode()).hexdigest()
+    
+    def get(self,
+            key):
+        """
+        Get a model PSF from the cache.
+        
+        Parameters
+        ----------
+        key : str
+            Cache key of the model PSF.
+        
+        Returns
+        -------
+        psf : array
+            Cached model PSF or None if it is not in the cache.
+        
+        """
+        
+        if not self.enabled:
+            return None
+        
+        # Load PSF and mark it as recently used.
+        path = os.path.join(self.cache_dir, key + '.npy')
+        try:
+            psf = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        log.info('  --> Using cached model PSF ' + key[:12])
+        
+        return psf
+    
+    def put(self,
+            key,
+            psf):
+        """
+        Store a model PSF in the cache and evict the least recently used
+        model PSFs if the cache exceeds its maximum size.
+        
+        Parameters
+        ----------
+        key : str
+            Cache key of the model PSF.
+        psf : array
+            Model PSF.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        if not self.enabled:
+            return
+        
+        # Write PSF to a temporary file first so that concurrent processes
+        # never read a partially written file.
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, key + '.npy')
+        temp = path + '.%d.temp' % os.getpid()
+        with open(temp, 'wb') as f:
+            np.save(f, np.asarray(psf))
+        os.replace(temp, path)
+        
+        # Evict least recently used PSFs.
+        files = []
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, file))
+                except OSError:
+                    continue
+                files += [(stat.st_mtime, stat.st_size, file)]
+        files.sort()
+        size = np.sum([file[1] for file in files])
+        for file in files[:-1]:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, file[2]))
+            except OSError:
+                pass
+            size -= file[1]
+        
+        pass
+    
+    def clear(self):
+        """
+        Remove all model PSFs from the cache.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        if not self.enabled or not os.path.exists(self.cache_dir):
+            return
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.npy'):
+                os.remove(os.path.join(self.cache_dir, file))
+        
+        pass
+
+def hash_spectrum(sp):
+    """
+    Compute a hash of a pysynphot or synphot spectrum for the model PSF
+    cache keys.
+    
+    Parameters
+    ----------
+    sp : pysynphot or synphot spectrum
+        Input spectrum.
+    
+    Returns
+    -------
+    hash : str
+        Hash of the wavelength and flux arrays of the spectrum or None if
+        the spectrum is None.
+    
+    """
+    
+    if sp is None:
+        return None
+    try:
+        wave, flux = (sp.wave, sp.flux)
+    except AttributeError:
+        wave = sp.waveset.value
+        flux = sp(sp.waveset).value
+    temp = hashlib.sha256()
+    temp.update(np.ascontiguousarray(wave, dtype=float).tobytes())
+    temp.update(np.ascontiguousarray(flux, dtype=float).tobytes())
+    
+    return temp.hexdigest()
+
+# Model PSF cache shared by all routines. Enable it by setting the
+# SPACEKLIP_PSF_CACHE environment variable or by assigning a new PSFCache
+# with a cache directory.
+psf_cache = PSFCache()
+
+@functools.lru_cache(maxsize=64)
+def get_opd_file(date,
+                 choice='closest'):
+    """
+    Get the name of the wavefront sensing OPD file that WebbPSF uses for a
+    given date. The model PSF cache keys contain this file name rather than
+    the date, so that all dates which resolve to the same OPD share their
+    cached model PSFs.
+    
+    Parameters
+    ----------
+    date : str
+        Date time in UTC as ISO-format string, a la 2022-07-01T07:20:00.
+    choice : 'closest', 'before', or 'after', optional
+        Which wavefront measurement shall be used relative to the date. The
+        default is 'closest'.
+    
+    Returns
+    -------
+    opd_file : str
+        Name of the OPD file or None if the date is None.
+    
+    """
+    
+    if date is None:
+        return None
+    
+    return get_opd_at_time(date, choice=choice, verbose=False)
+
+def get_psf_njobs(n_jobs=None):
+    """
+    Get the number of worker processes for PSF synthesis.
+    
+    Parameters
+    ----------
+    n_jobs : int, optional
+        Requested number of worker processes. If None, it is read from the
+        SPACEKLIP_PSF_NJOBS environment variable and defaults to 1. Values < 1
+        use all available CPU cores. The default is None.
+    
+    Returns
+    -------
+    n_jobs : int
+        Number of worker processes.
+    
+    """
+    
+    if n_jobs is None:
+        n_jobs = int(os.environ.get('SPACEKLIP_PSF_NJOBS', 1))
+    if n_jobs < 1:
+        n_jobs = os.cpu_count()
+    
+    return n_jobs
+
+# Instrument object of a PSF worker process, set once by the pool initializer.
+_worker_inst = None
+
+def _init_psf_worker(inst):
+    global _worker_inst
+    _worker_inst = inst
+
+def _calc_psf_worker(use_coeff, kwargs):
+    if use_coeff:
+        return _worker_inst.calc_psf_from_coeff(**kwargs)
+    else:
+        return _worker_inst.calc_psf(**kwargs)
+
+def calc_psfs(inst, use_coeff, kwargs_list, n_jobs=None):
+    """
+    Compute several PSFs with the same instrument object, in parallel if
+    more than one worker process is requested. The instrument object is only
+    sent once to each worker process and then reused for all of its PSFs.
+    
+    Parameters
+    ----------
+    inst : webbpsf_ext instrument
+        Instrument object (e.g., NIRCam_ext).
+    use_coeff : bool
+        Use calc_psf_from_coeff instead of calc_psf?
+    kwargs_list : list of dict
+        Keyword arguments of each PSF calculation.
+    n_jobs : int, optional
+        Number of worker processes, see get_psf_njobs. The default is None.
+    
+    Returns
+    -------
+    psfs : list of array
+        Computed PSFs in the order of kwargs_list.
+    
+    """
+    
+    # Serial calculation.
+    n_jobs = min(get_psf_njobs(n_jobs), len(kwargs_list))
+    if n_jobs <= 1:
+        _init_psf_worker(inst)
+        try:
+            return [_calc_psf_worker(use_coeff, kwargs) for kwargs in kwargs_list]
+        finally:
+            _init_psf_worker(None)
+    
+    # Parallel calculation.
+    log.info('  --> Computing %.0f PSFs with %.0f processes' % (len(kwargs_list), n_jobs))
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_psf_worker, initargs=(inst,)) as executor:
+        psfs = list(executor.map(_calc_psf_worker, [use_coeff] * len(kwargs_list), kwargs_list))
+    
+    return psfs
+
 class JWST_PSF():
     
+    # In-memory LRU of fully initialized instances, see JWST_PSF.get
+    _instances = OrderedDict()
+    max_instances = 8
+    
     def __init__(self, inst, filt, image_mask, fov_pix, oversample=2, 
-                 sp=None, use_coeff=True, date=None, **kwargs): 
+                 sp=None, use_coeff=True, date=None, n_jobs=None, **kwargs): 
         """
         Class to generate off-axis coronagraphic PSF.
         
@@ -86,6 +415,11 @@ class JWST_PSF():
         date : str or None
             Date time in UTC as ISO-format string, a la 2022-07-01T07:20:00.
             If not set, then default webbpsf OPD is used (e.g., RevAA).
+        n_jobs : int or None
+            Number of worker processes for computing PSFs at several positions
+            (bar mask sampling, PSF grids, multi-roll forward-model PSFs). If
+            None, read from the SPACEKLIP_PSF_NJOBS environment variable
+            (default 1). Values < 1 use all available CPU cores.
         
         Returns
         -------
@@ -115,10 +449,12 @@ class JWST_PSF():
         inst_off = self.inst_ext(filter=filt, image_mask=None, pupil_mask=pupil_mask,
                                   fov_pix=fov_pix, oversample=oversample, **kwargs)
         
-        # Load date-specific OPD files?
-        if date is not None:
-            inst_on.load_wss_opd_by_date(date=date, choice='closest', verbose=False, plot=False)
-            inst_off.load_wss_opd_by_date(date=date, choice='closest', verbose=False, plot=False)
+        # Load date-specific OPD files? The date is only resolved once and
+        # each instrument loads its own copy of the resolved OPD file.
+        opd_file = get_opd_file(date, choice='closest')
+        if opd_file is not None:
+            inst_on.load_wss_opd(opd_file, verbose=False, plot=False)
+            inst_off.load_wss_opd(opd_file, verbose=False, plot=False)
         
         # Generating initial PSFs...
         # print('Generating initial PSFs...')
@@ -149,37 +485,93 @@ class JWST_PSF():
                 sp = S.ArraySpectrum(sp.waveset.value, sp(sp.waveset).value, wunit, funit, name=sp.meta['name'])
                 sp = sp.renorm(1, 'counts', inst_on.bandpass)
         
+        # Store instrument classes
+        self.inst_on  = inst_on
+        self.inst_off = inst_off
+        
+        # PSF generation functions for later use
+        self._use_coeff = use_coeff
+        self._func_on  = func_on
+        self._func_off = func_off
+        self.n_jobs = n_jobs
+        
+        # Parameters defining the PSFs for the cache keys
+        self._cache_params = {'inst': inst.upper(), 'filter': filt, 'image_mask': image_mask,
+                              'pupil_mask': pupil_mask, 'fov_pix': fov_pix, 'oversample': oversample,
+                              'opd': None if opd_file is None else os.path.basename(opd_file), 'use_coeff': use_coeff, 'jitter': inst_on.options.get('jitter_sigma'),
+                              'kwargs': kwargs}
+        sp_hash = hash_spectrum(sp)
+        
         # On axis PSF
         if image_mask[-1] == 'B':
             # Need an array of PSFs along bar center
             xvals = np.linspace(-8,8,9)
             self.psf_bar_xvals = xvals
-            
-            psf_bar_arr = []
-            for xv in tqdm(xvals, desc='Bar PSFs', leave=False):
-                psf = func_on(sp=sp, return_oversample=True, return_hdul=False, 
-                              coord_vals=(xv,0), coord_frame='idl')
-                psf_bar_arr.append(psf)
-            self.psf_on = np.array(psf_bar_arr)
+            self.psf_on = self._calc_psfs_on([(xv,0) for xv in xvals], 'idl', sp)
         else:
-            self.psf_on = func_on(sp=sp, return_oversample=True, return_hdul=False)
+            key = psf_cache.key(kind='on', sp=sp_hash, **self._cache_params)
+            self.psf_on = psf_cache.get(key)
+            if self.psf_on is None:
+                self.psf_on = func_on(sp=sp, return_oversample=True, return_hdul=False)
+                psf_cache.put(key, self.psf_on)
         
         # Off axis PSF
-        self.psf_off = func_off(sp=sp, return_oversample=True, return_hdul=False)
+        key = psf_cache.key(kind='off', sp=sp_hash, **self._cache_params)
+        self.psf_off = psf_cache.get(key)
+        if self.psf_off is None:
+            self.psf_off = func_off(sp=sp, return_oversample=True, return_hdul=False)
+            psf_cache.put(key, self.psf_off)
         
         # Center PSFs
         self._recenter_psfs()
         
-        # Store instrument classes
-        self.inst_on  = inst_on
-        self.inst_off = inst_off
+        self.sp = sp
         
-        # PSF generation functions for later use
-        self._use_coeff = use_coeff
-        self._func_on  = func_on
-        self._func_off = func_off
+        # Field-dependent PSF grids (keyed by spectrum hash) and bar
+        # interpolation function, built on demand
+        self._psf_grids = {}
+        self._bar_interp = None
+    
+    @classmethod
+    def get(cls, inst, filt, image_mask, fov_pix, oversample=2, 
+            sp=None, use_coeff=True, date=None, n_jobs=None, **kwargs):
+        """
+        Get a memoised JWST_PSF instance.
         
-        self.sp = sp
+        Fully initialized instances are kept in a process-wide LRU keyed by
+        their constructor arguments, so that repeated calls with the same
+        arguments do not have to reload OPDs, regenerate coefficients, and
+        recompute the on-axis and off-axis PSFs. The returned instance is
+        shared between callers and must not be modified (e.g., via
+        `_shift_psfs`); construct a JWST_PSF directly if that is required.
+        
+        Parameters
+        ----------
+        Same as for JWST_PSF.
+        
+        Returns
+        -------
+        psf : JWST_PSF
+            JWST_PSF instance.
+        
+        """
+        
+        # Look up instance
+        key = psf_cache.key(inst=inst.upper(), filter=filt, image_mask=image_mask, fov_pix=fov_pix,
+                            oversample=oversample, sp=hash_spectrum(sp), use_coeff=use_coeff,
+                            date=date, kwargs=kwargs)
+        if key in cls._instances:
+            cls._instances.move_to_end(key)
+            return cls._instances[key]
+        
+        # Initialize new instance and evict least recently used ones
+        psf = cls(inst, filt, image_mask, fov_pix, oversample=oversample, 
+                  sp=sp, use_coeff=use_coeff, date=date, n_jobs=n_jobs, **kwargs)
+        cls._instances[key] = psf
+        while len(cls._instances) > cls.max_instances:
+            cls._instances.popitem(last=False)
+        
+        return psf
     
     @property
     def fov_pix(self):
@@ -286,6 +678,7 @@ class JWST_PSF():
         self.psf_off = fourier_imshift(self.psf_off, xoff, yoff, pad=True)
         self.xoff = xoff
         self.yoff = yoff
+        self._bar_interp = None
     
     def rth_to_xy(self, r, th, PA_V3=0, frame_out='idl', addV3Yidl=True):
         """
@@ -332,8 +725,170 @@ class JWST_PSF():
         else:
             return self.inst_on.siaf_ap.convert(xidl, yidl, 'idl', frame_out)
     
+    def _calc_psfs_on(self, coord_list, coord_frame='idl', sp=None):
+        """
+        Compute on-mask PSFs at several positions with the full calculation.
+        
+        Each PSF is looked up in the model PSF cache first, the missing ones
+        are computed in parallel (see `calc_psfs`) and added to the cache.
+        
+        Parameters
+        ----------
+        coord_list : list of tuple or None
+            Coordinates (in arcsec or pixels) of each PSF. None gives the PSF
+            at the mask center.
+        coord_frame : str
+            Type of input coordinates. Default is 'idl'.
+        sp : pysynphot spectrum
+            Spectrum for the wavelength weighting. If not set, defaults to ``self.sp``.
+        
+        Returns
+        -------
+        psfs : ndarray
+            Oversampled PSFs, not yet recentered.
+        
+        """
+        
+        sp = self.sp if sp is None and hasattr(self, 'sp') else sp
+        sp_hash = hash_spectrum(sp)
+        
+        # Look up cached PSFs
+        psfs = []
+        keys = []
+        for coord_vals in coord_list:
+            if coord_vals is None:
+                key = psf_cache.key(kind='on', sp=sp_hash, **self._cache_params)
+            else:
+                coord_vals = (float(coord_vals[0]), float(coord_vals[1]))
+                key = psf_cache.key(kind='on', sp=sp_hash, coord_vals=coord_vals,
+                                    coord_frame=coord_frame, **self._cache_params)
+            psfs.append(psf_cache.get(key))
+            keys.append(key)
+        
+        # Compute missing PSFs
+        todo = [i for i, psf in enumerate(psfs) if psf is None]
+        kwargs_list = []
+        for i in todo:
+            kwargs = {'sp': sp, 'return_oversample': True, 'return_hdul': False}
+            if coord_list[i] is not None:
+                kwargs['coord_vals'] = coord_list[i]
+                kwargs['coord_frame'] = coord_frame
+            kwargs_list.append(kwargs)
+        for i, psf in zip(todo, calc_psfs(self.inst_on, self._use_coeff, kwargs_list, n_jobs=self.n_jobs)):
+            psfs[i] = psf
+            psf_cache.put(keys[i], psf)
+        
+        return np.array(psfs)
+    
+    def build_psf_grid(self, rvals=None, thvals=None, xvals=None, yvals=None, sp=None):
+        """
+        Build a grid of field-dependent PSFs for fast interpolation.
+        
+        The grid PSFs are computed with the full calculation (``quick=False``)
+        and persisted in the model PSF cache, so that the grid only has to be
+        computed once per configuration. Round masks are sampled in (r,th) and
+        bar masks in (x,y) in the idl frame. Lookups use linear interpolation
+        between the grid PSFs, see `gen_psf_idl` with ``grid=True``. A separate
+        grid is kept for each spectrum.
+        
+        Parameters
+        ----------
+        rvals : ndarray or None
+            Radial offsets (arcsec) from mask center for round masks.
+        thvals : ndarray or None
+            Position angles (deg) in the idl frame for round masks, within [0,360).
+        xvals : ndarray or None
+            Offsets (arcsec) along the bar for bar masks. Defaults to `psf_bar_xvals`.
+        yvals : ndarray or None
+            Offsets (arcsec) perpendicular to the bar for bar masks.
+        sp : pysynphot spectrum
+            Spectrum for the wavelength weighting. If not set, defaults to ``self.sp``.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        from scipy.interpolate import RegularGridInterpolator
+        
+        osamp = self.inst_on.oversample
+        ny = nx = self.fov_pix * osamp
+        
+        # Grid positions in idl frame
+        if self.image_mask[-1] == 'B':
+            xvals = self.psf_bar_xvals if xvals is None else np.asarray(xvals)
+            yvals = np.array([-2, -1, -0.6, -0.3, -0.15, 0, 0.15, 0.3, 0.6, 1, 2]) if yvals is None else np.asarray(yvals)
+            axes = (xvals, yvals)
+            xg, yg = np.meshgrid(xvals, yvals, indexing='ij')
+        else:
+            rvals = np.array([0, 0.1, 0.2, 0.3, 0.45, 0.6, 0.8, 1.0, 1.4, 2.0, 3.0]) if rvals is None else np.asarray(rvals)
+            thvals = np.arange(0, 360, 45) if thvals is None else np.asarray(thvals)
+            axes = (rvals, np.append(thvals, thvals[0] + 360))
+            rg, tg = np.meshgrid(rvals, thvals, indexing='ij')
+            xg = rg * np.cos(np.deg2rad(tg))
+            yg = rg * np.sin(np.deg2rad(tg))
+        
+        # Only compute unique positions (e.g., r = 0 for all th)
+        xy = np.round(np.array([xg.ravel(), yg.ravel()]).T, 10)
+        xy_uniq, ind = np.unique(xy, axis=0, return_inverse=True)
+        psfs = self.gen_psf_idl((xy_uniq[:,0], xy_uniq[:,1]), coord_frame='idl', quick=False,
+                                sp=sp, return_oversample=True)
+        psfs = psfs.reshape([-1,ny,nx])[np.ravel(ind)].reshape(xg.shape + (ny,nx))
+        
+        # Wrap around in position angle
+        if self.image_mask[-1] != 'B':
+            psfs = np.concatenate([psfs, psfs[:,:1]], axis=1)
+        
+        self._psf_grids[hash_spectrum(sp)] = RegularGridInterpolator(axes, psfs, method='linear')
+    
+    def _interp_psf_grid(self, coord_vals, coord_frame='idl', sp=None):
+        """
+        Interpolate the field-dependent PSF grid of a spectrum.
+        
+        Parameters
+        ----------
+        coord_vals : tuple
+            Coordinates (in arcsec or pixels) of the PSFs.
+        coord_frame : str
+            Type of input coordinates. Default is 'idl'.
+        sp : pysynphot spectrum
+            Spectrum for the wavelength weighting. If not set, defaults to ``self.sp``.
+            The grid of this spectrum is built if it does not exist yet.
+        
+        Returns
+        -------
+        psfs : ndarray
+            Oversampled PSFs centered in the image.
+        
+        """
+        
+        sp_hash = hash_spectrum(sp)
+        if sp_hash not in self._psf_grids:
+            self.build_psf_grid(sp=sp)
+        psf_grid = self._psf_grids[sp_hash]
+        
+        # Get offsets in idl frame
+        if coord_frame=='idl':
+            xidl, yidl = coord_vals
+        else:
+            xidl, yidl = self.inst_on.siaf_ap.convert(coord_vals[0], coord_vals[1], coord_frame, 'idl')
+        xidl = np.ravel(xidl)
+        yidl = np.ravel(yidl)
+        
+        # Clip to grid, PSFs are nearly constant beyond its edges
+        axes = psf_grid.grid
+        if self.image_mask[-1] == 'B':
+            pts = np.array([np.clip(xidl, axes[0][0], axes[0][-1]), np.clip(yidl, axes[1][0], axes[1][-1])]).T
+        else:
+            rvals = np.clip(np.sqrt(xidl**2 + yidl**2), axes[0][0], axes[0][-1])
+            thvals = (np.rad2deg(np.arctan2(yidl, xidl)) - axes[1][0]) % 360 + axes[1][0]
+            pts = np.array([rvals, thvals]).T
+        
+        return psf_grid(pts)
+    
     def gen_psf_idl(self, coord_vals, coord_frame='idl', quick=True, sp=None,
-                    return_oversample=False, do_shift=False):
+                    return_oversample=False, do_shift=False, grid=False):
         """
         Generate offset PSF in detector frame.
         
@@ -357,12 +912,18 @@ class JWST_PSF():
             or on-the-fly calcs w/ webbpsf (10 s).
         sp : pysynphot spectrum
             Manually specify spectrum to get a desired wavelength weighting. 
-            Only applicable if ``quick=False``. If not set, defaults to ``self.sp``.
+            Only applicable if ``quick=False`` or ``grid=True``. If not set, defaults
+            to ``self.sp``.
         return_oversample : bool
             Return the oversampled version of the PSF?
         do_shift : bool
             If True, will return the PSF offset from center. 
             Otherwise, returns PSF in center of image.
+        grid : bool
+            Only applicable if ``quick=True``. Instead of the linear combination
+            of on-axis and off-axis PSFs, interpolate a precomputed grid of
+            field-dependent PSFs (see `build_psf_grid`). Nearly as fast, but
+            close to the fidelity of the full calculation.
         
         Returns
         -------
@@ -378,10 +939,15 @@ class JWST_PSF():
         ny = nx = self.fov_pix * osamp
         
         # Renormalize spectrum to have 1 e-/sec within bandpass to obtain normalized PSFs
+        # The PSF grids are keyed by the spectrum as provided
+        sp_in = sp
         if sp is not None:
             sp = sp.renorm(1, 'counts', self.bandpass)
         
-        if quick:
+        if quick and grid:
+            psfs = self._interp_psf_grid(coord_vals, coord_frame, sp=sp_in)
+        
+        elif quick:
             t_temp, cx_idl, cy_idl = _transmission_map(self.inst_on, coord_vals, coord_frame)
             trans = t_temp**2
             
@@ -391,11 +957,12 @@ class JWST_PSF():
             bvals = 1 - avals
             
             if self.image_mask[-1]=='B':
-                # Interpolation function
-                xvals = self.psf_bar_xvals
-                psf_arr = self.psf_on
-                finterp = interp1d(xvals, psf_arr, kind='linear', fill_value='extrapolate', axis=0)
-                psf_on = finterp(cx_idl)
+                # Interpolation function, only built once
+                if self._bar_interp is None:
+                    xvals = self.psf_bar_xvals
+                    psf_arr = self.psf_on
+                    self._bar_interp = interp1d(xvals, psf_arr, kind='linear', fill_value='extrapolate', axis=0)
+                psf_on = self._bar_interp(cx_idl)
             else:
                 psf_on = self.psf_on
             psf_off = self.psf_off
@@ -404,10 +971,12 @@ class JWST_PSF():
                  + bvals.reshape([-1,1,1]) * psf_on.reshape([1,ny,nx])
         
         else:
-            calc_psf = self._func_on
             sp = self.sp if sp is None else sp
-            psfs = calc_psf(sp=sp, coord_vals=coord_vals, coord_frame=coord_frame,
-                            return_oversample=True, return_hdul=False)
+            if coord_vals is None:
+                coord_list = [None]
+            else:
+                coord_list = list(zip(np.ravel(coord_vals[0]), np.ravel(coord_vals[1])))
+            psfs = self._calc_psfs_on(coord_list, coord_frame, sp)
             
             # Ensure 3D cube
             psfs = psfs.reshape([-1,ny,nx])
@@ -428,11 +997,8 @@ class JWST_PSF():
             dx_pix = np.array([osamp * xidl / siaf_ap.XSciScale]).ravel()
             dy_pix = np.array([osamp * yidl / siaf_ap.YSciScale]).ravel()
             
-            psfs_sh = []
-            for i, im in enumerate(psfs):
-                psf = fourier_imshift(im, dx_pix[i], dy_pix[i], pad=True)
-                psfs_sh.append(psf)
-            psfs = np.asarray(psfs_sh)
+            # Shift all PSFs with one batched FFT
+            psfs = ut.imshift_cube(psfs.reshape([-1,ny,nx]), np.array([dx_pix, dy_pix]).T, pad=True)
         
         # Resample to detector pixels?
         if not return_oversample:
@@ -440,23 +1006,33 @@ class JWST_PSF():
         
         return psfs.squeeze()
     
-    def gen_psf(self, loc, mode='xy', PA_V3=0, return_oversample=False, do_shift=True, addV3Yidl=True, normalize=False, **kwargs):
+    def gen_psf(self, loc, mode='xy', PA_V3=0, return_oversample=False, do_shift=True, addV3Yidl=True, normalize=False, 
+                maxmem=2**30, **kwargs):
         """
         Generate offset PSF rotated by PA to N-E orientation.
         
         Generate a PSF for some (x,y) detector position in N-E sky orientation.
+        Multiple positions can be requested at once by passing arrays, in which
+        case the PSFs are shifted, rotated, and rebinned in batches.
         
         Parameters
         ----------
         loc : float or ndarray
             (x,y) or (r,th) location (in arcsec) offset from center of mask.
-        PA_V3 : float
-            V3 PA of ref point N over E (e.g. 'ROLL_REF').
+            Can also be a tuple of arrays for multiple positions.
+        PA_V3 : float or ndarray
+            V3 PA of ref point N over E (e.g. 'ROLL_REF'). Can also be an
+            array; must match size of the `loc` arrays.
         return_oversample : bool
             Return the oversampled version of the PSF?
         do_shift : bool
             If True, will offset PSF by appropriate amount from center. Otherwise,
             returns PSF in center of image.
+        normalize : bool
+            Normalize each PSF to a total intensity of 1?
+        maxmem : int
+            Maximum number of bytes of oversampled PSFs to process at once.
+            Multiple positions are processed in chunks to bound the peak memory.
         
         Keyword Args
         ------------
@@ -467,11 +1043,13 @@ class JWST_PSF():
             or on-the-fly calcs w/ webbpsf (10 s).
         sp : pysynphot spectrum
             Manually specify spectrum to get a desired wavelength weighting. 
-            Only applicable if ``quick=False``. If not set, defaults to ``self.sp``.
+            Only applicable if ``quick=False`` or ``grid=True``. If not set, defaults
+            to ``self.sp``.
         
         Returns
         -------
-        None.
+        psf : ndarray
+            PSF image, or (npos, ny, nx) cube if multiple positions were given.
         
         """
         
@@ -486,26 +1064,40 @@ class JWST_PSF():
             xidl, yidl = self.rth_to_xy(r, th, PA_V3=PA_V3, frame_out='idl', addV3Yidl=addV3Yidl)
         elif mode == 'xy':
             xidl, yidl = loc
-        
-        # Perform shift in idl frame then rotate to sky coords
-        psf = self.gen_psf_idl((xidl, yidl), coord_frame='idl', do_shift=do_shift, 
-                                return_oversample=True, **kwargs)
-        
-        if do_shift:
-            # Shifting PSF, means rotate such that North is up
+        single = np.ndim(xidl) == 0
+        xidl, yidl, PA_V3 = np.broadcast_arrays(np.ravel(xidl), np.ravel(yidl), np.ravel(PA_V3))
+        
+        # Process positions in chunks to bound the peak memory. Shifting needs
+        # padded complex copies of the oversampled PSFs.
+        npos = len(xidl)
+        nchunk = max(1, int(maxmem // (16 * 8 * ny * nx)))
+        psfs = []
+        for k in range(0, npos, nchunk):
+            
+            # Perform shift in idl frame then rotate to sky coords
+            psf = self.gen_psf_idl((xidl[k:k + nchunk], yidl[k:k + nchunk]), coord_frame='idl', do_shift=do_shift, 
+                                   return_oversample=True, **kwargs)
             psf = psf.reshape([-1,ny,nx])
-            # Get aperture position angle
-            PA_ap = PA_V3 + siaf_ap.V3IdlYAngle
-            psf = rotate(psf, -PA_ap, reshape=False, mode='constant', cval=0, axes=(-1,-2))
-        
-        # Resample to detector pixels?
-        if not return_oversample:
-            psf = frebin(psf, scale=1/osamp)
+            
+            if do_shift:
+                # Shifting PSF, means rotate such that North is up
+                # Get aperture position angle and rotate PSFs with the same angle together
+                PA_ap = PA_V3[k:k + nchunk] + siaf_ap.V3IdlYAngle
+                for pa in np.unique(PA_ap):
+                    ww = PA_ap == pa
+                    psf[ww] = rotate(psf[ww], -pa, reshape=False, mode='constant', cval=0, axes=(-1,-2))
+            
+            # Resample to detector pixels?
+            if not return_oversample:
+                psf = frebin(psf, scale=1/osamp)
+            psfs.append(psf)
+        psf = np.concatenate(psfs)
         
         # Normalize to 1
-        psf = psf.squeeze()
         if normalize == True:
-            psf = psf / np.sum(psf)
+            psf = psf / np.sum(psf, axis=(-2,-1), keepdims=True)
+        if single:
+            psf = psf[0]
         
         return psf
 
@@ -695,15 +1287,32 @@ def gen_offsetpsf(obs,
         webbpsf_inst.options['source_offset_x'] = xyoff[0]
         webbpsf_inst.options['source_offset_y'] = xyoff[1]
     
+    # Check if the offset PSF is already cached.
+    opd_file = get_opd_file(date, choice='before')
+    key = psf_cache.key(kind='offset',
+                        inst=webbpsf_inst.name,
+                        filter=webbpsf_inst.filter,
+                        image_mask=webbpsf_inst.image_mask,
+                        pupil_mask=webbpsf_inst.pupil_mask,
+                        options=dict(webbpsf_inst.options),
+                        opd=None if opd_file is None else os.path.basename(opd_file),
+                        source=hash_spectrum(source),
+                        fov_pix=65,
+                        oversample=1)
+    offsetpsf = psf_cache.get(key)
+    if offsetpsf is not None:
+        return offsetpsf
+    
     # If a date is provided, use date-specific OPD files.
     log.info('  --> Generating WebbPSF model')
-    if date is not None:
+    if opd_file is not None:
         log.info('  --> Using date-specific OPD files')
-        webbpsf_inst.load_wss_opd_by_date(date=date, choice='before', verbose=False, plot=False)
+        webbpsf_inst.load_wss_opd(opd_file, verbose=False, plot=False)
     
     # Generate offset PSF.
     hdul = webbpsf_inst.calc_psf(oversample=1, fov_pixels=65, normalize='last', source=source)
     offsetpsf = hdul[0].data
+    psf_cache.put(key, offsetpsf)
     
     return offsetpsf
 
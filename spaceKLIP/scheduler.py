@@ -0,0 +1,317 @@
+from __future__ import division
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import copy
+import os
+import pdb
+import sys
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from spaceKLIP import coron1pipeline, coron2pipeline
+from spaceKLIP.imagetools import ImageTools
+
+import logging
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+# Tasks which only depend on a single exposure and can therefore be streamed
+# through the scheduler one exposure at a time.
+perfile_tasks = ['coron1',
+                 'coron2',
+                 'crop_frames',
+                 'pad_frames',
+                 'coadd_frames',
+                 'subtract_median',
+                 'fix_bad_pixels',
+                 'replace_nans',
+                 'blur_frames']
+
+def _sub_database(database,
+                  key,
+                  j):
+    """
+    Make a spaceKLIP database which only contains a single exposure.
+    
+    Parameters
+    ----------
+    database : spaceKLIP.Database
+        SpaceKLIP database from which the exposure shall be taken.
+    key : str
+        Database key of the exposure.
+    j : int
+        Database index of the exposure.
+    
+    Returns
+    -------
+    sub : spaceKLIP.Database
+        SpaceKLIP database which only contains the exposure. It is neither
+        verbose nor saved automatically.
+    
+    """
+    
+    # Make single exposure database.
+    sub = copy.copy(database)
+    sub.obs = {key: database.obs[key][j:j + 1].copy()}
+    sub.red = {}
+    sub.src = {}
+    sub.history = {}
+    sub.autosave = False
+    sub.verbose = False
+    
+    return sub
+
+def _run_exposure(database,
+                  key,
+                  tasks):
+    """
+    Run a sequence of per-file tasks on a single exposure.
+    
+    Parameters
+    ----------
+    database : spaceKLIP.Database
+        SpaceKLIP database which only contains the exposure, see
+        _sub_database.
+    key : str
+        Database key of the exposure.
+    tasks : list of tuple
+        List of per-file tasks and their keyword arguments.
+    
+    Returns
+    -------
+    row : astropy.table.Table
+        Updated database row of the exposure.
+    history : list of tuple
+        Provenance recorded by the tasks, see spaceKLIP.Database.history.
+    
+    """
+    
+    # Run per-file tasks.
+    for task, kwargs in tasks:
+        if task == 'coron1':
+            coron1pipeline.run_obs(database, **kwargs)
+        elif task == 'coron2':
+            coron2pipeline.run_obs(database, **kwargs)
+        else:
+            getattr(ImageTools(database), task)(**kwargs)
+    
+    return database.obs[key], database.history.get(key, [])
+
+class Scheduler():
+    """
+    The spaceKLIP exposure-level scheduler class.
+    
+    The scheduler runs a sequence of tasks on a spaceKLIP database. The tasks
+    are split into stages at the tasks which need all exposures at once
+    (e.g., background subtraction, frame alignment, or PSF subtraction). In
+    between these barriers, each exposure is streamed through all per-file
+    tasks (JWST stage 1 and 2 pipelines and per-file image manipulation
+    steps) as soon as a worker process is available, without waiting for the
+    other exposures. The spaceKLIP database is only updated by the main
+    process and saved once after each stage.
+    
+    """
+    
+    def __init__(self,
+                 database,
+                 n_jobs=1):
+        """
+        Initialize the spaceKLIP exposure-level scheduler class.
+        
+        Parameters
+        ----------
+        database : spaceKLIP.Database
+            SpaceKLIP database on which the tasks shall be run.
+        n_jobs : int, optional
+            Number of worker processes across which the exposures shall be
+            spread. If -1, use all available CPUs. The default is 1.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Make an internal alias of the spaceKLIP database class.
+        self.database = database
+        
+        # Set number of worker processes.
+        self.n_jobs = n_jobs
+        
+        # Initialize task list.
+        self.tasks = []
+        
+        pass
+    
+    def add(self,
+            task,
+            **kwargs):
+        """
+        Add a task to the scheduler.
+        
+        Parameters
+        ----------
+        task : str or callable
+            Task to be run. Either 'coron1' or 'coron2' for the JWST stage 1
+            or 2 pipelines, the name of a spaceKLIP.ImageTools routine, or a
+            function which takes the spaceKLIP database as first argument
+            (e.g., spaceKLIP.pyklippipeline.run_obs). Only the tasks in
+            spaceKLIP.scheduler.perfile_tasks are streamed, all other tasks
+            are barriers which are run on all exposures at once.
+        **kwargs : keyword arguments
+            Keyword arguments for the task.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Check input.
+        if isinstance(task, str):
+            if task not in perfile_tasks and (task.startswith('_') or not callable(getattr(ImageTools, task, None))):
+                raise UserWarning('Task ' + task + ' is not known')
+        elif not callable(task):
+            raise UserWarning('Task must be a string or a function')
+        
+        # Add task.
+        self.tasks += [(task, kwargs)]
+        
+        pass
+    
+    def run(self):
+        """
+        Run all tasks of the scheduler.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Split tasks into streamed stages and barriers.
+        stages = []
+        for task, kwargs in self.tasks:
+            if isinstance(task, str) and task in perfile_tasks:
+                if len(stages) == 0 or not isinstance(stages[-1], list):
+                    stages += [[]]
+                stages[-1] += [(task, kwargs)]
+            else:
+                stages += [(task, kwargs)]
+        
+        # Run stages.
+        for stage in stages:
+            if isinstance(stage, list):
+                log.info('--> Scheduler: streaming exposures through ' + ', '.join([task for task, kwargs in stage]))
+                self._run_stream(stage)
+            else:
+                task, kwargs = stage
+                if isinstance(task, str):
+                    log.info('--> Scheduler: running ' + task + ' on all exposures')
+                    getattr(ImageTools(self.database), task)(**kwargs)
+                else:
+                    log.info('--> Scheduler: running ' + task.__name__ + ' on all exposures')
+                    task(self.database, **kwargs)
+        
+        pass
+    
+    def _run_stream(self,
+                    tasks):
+        """
+        Stream all exposures through a sequence of per-file tasks.
+        
+        Parameters
+        ----------
+        tasks : list of tuple
+            List of per-file tasks and their keyword arguments.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Get number of worker processes.
+        n_jobs = self.n_jobs
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count()
+        
+        # Get all exposures.
+        todo = []
+        for i, key in enumerate(self.database.obs.keys()):
+            nfitsfiles = len(self.database.obs[key])
+            for j in range(nfitsfiles):
+                todo += [(key, j)]
+        
+        # Run serially.
+        if n_jobs == 1:
+            for key, j in todo:
+                row, history = _run_exposure(_sub_database(self.database, key, j), key, tasks)
+                self._update(key, j, row, history)
+        
+        # Run in parallel.
+        else:
+            
+            # Fetch reference files of all stage 0 files.
+            if 'coron1' in [task for task, kwargs in tasks]:
+                log.info('--> Scheduler: fetching reference files')
+                coron1pipeline.fetch_references([os.path.abspath(self.database.obs[key]['FITSFILE'][j]) for key, j in todo if self.database.obs[key]['DATAMODL'][j] == 'STAGE0'])
+            
+            # Submit all exposures and update the database as soon as each
+            # of them is completed.
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = {}
+                for key, j in todo:
+                    futures[executor.submit(_run_exposure, _sub_database(self.database, key, j), key, tasks)] = (key, j)
+                for future in as_completed(futures):
+                    key, j = futures[future]
+                    row, history = future.result()
+                    self._update(key, j, row, history)
+        
+        # Save spaceKLIP database.
+        if self.database.autosave:
+            self.database.save()
+        
+        pass
+    
+    def _update(self,
+                key,
+                j,
+                row,
+                history):
+        """
+        Update the spaceKLIP database with the result of a single exposure.
+        The index of the exposure in its single exposure database is
+        replaced by its index in the spaceKLIP database in the provenance.
+        
+        Parameters
+        ----------
+        key : str
+            Database key of the exposure.
+        j : int
+            Database index of the exposure.
+        row : astropy.table.Table
+            Updated database row of the exposure.
+        history : list of tuple
+            Provenance recorded by the tasks, see spaceKLIP.Database.history.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        # Update spaceKLIP database.
+        for name in row.colnames:
+            self.database.obs[key][name][j] = row[name][0]
+        self.database.history.setdefault(key, []).extend([(j,) + tuple(item[1:]) for item in history])
+        
+        pass
@@ -16,12 +16,16 @@ import astropy.io.fits as pyfits
 import matplotlib.pyplot as plt
 import numpy as np
 
+import functools
 import importlib
+import scipy.fft
 import scipy.ndimage.interpolation as sinterp
 
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.integrate import simps
 from scipy.ndimage import fourier_shift, gaussian_filter
 from scipy.ndimage import shift as spline_shift
+from skimage.registration import phase_cross_correlation
 
 import logging
 log = logging.getLogger(__name__)
@@ -32,8 +36,36 @@ log.setLevel(logging.INFO)
 # MAIN
 # =============================================================================
 
+def _get_data(hdul,
+              ext):
+    """
+    Get the data of a FITS file extension. Scaled data (e.g., unsigned
+    integer DQ arrays) cannot be memory-mapped and are read into memory
+    instead.
+    
+    Parameters
+    ----------
+    hdul : HDUList
+        Opened FITS file.
+    ext : str or int
+        Name or index of the extension.
+    
+    Returns
+    -------
+    data : array
+        Extension data.
+    
+    """
+    
+    # Get data.
+    try:
+        return hdul[ext].data
+    except ValueError:
+        return pyfits.getdata(hdul.filename(), ext, memmap=False)
+
 def read_obs(fitsfile,
-             return_var=False):
+             return_var=False,
+             memmap=None):
     """
     Read an observation from a FITS file.
     
@@ -43,6 +75,10 @@ def read_obs(fitsfile,
         Path of input FITS file.
     return_var : bool, optional
         Return VAR_POISSON and VAR_RNOISE arrays? The default is False.
+    memmap : bool, optional
+        Memory-map the FITS file? If True, the returned arrays are
+        copy-on-write views of the file on disk which are only paged in when
+        accessed. If None, use the astropy default. The default is None.
     
     Returns
     -------
@@ -72,10 +108,10 @@ def read_obs(fitsfile,
     """
     
     # Read FITS file.
-    hdul = pyfits.open(fitsfile)
-    data = hdul['SCI'].data
-    erro = hdul['ERR'].data
-    pxdq = hdul['DQ'].data
+    hdul = pyfits.open(fitsfile, memmap=memmap)
+    data = _get_data(hdul, 'SCI')
+    erro = _get_data(hdul, 'ERR')
+    pxdq = _get_data(hdul, 'DQ')
     head_pri = hdul[0].header
     head_sci = hdul['SCI'].header
     is2d = False
@@ -95,8 +131,8 @@ def read_obs(fitsfile,
     except KeyError:
         maskoffs = None
     if return_var:
-        var_poisson = hdul['VAR_POISSON'].data
-        var_rnoise = hdul['VAR_RNOISE'].data
+        var_poisson = _get_data(hdul, 'VAR_POISSON')
+        var_rnoise = _get_data(hdul, 'VAR_RNOISE')
     hdul.close()
     
     if return_var:
@@ -104,6 +140,84 @@ def read_obs(fitsfile,
     else:
         return data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs
 
+def _write_hdul(fitsfile,
+                fitsfile_out,
+                hdul,
+                output_verify='fix'):
+    """
+    Write new HDUs to a FITS file and copy all other extensions of an input
+    FITS file byte-for-byte after them, i.e., without decoding their data.
+    
+    Parameters
+    ----------
+    fitsfile : path
+        Path of input FITS file.
+    fitsfile_out : path
+        Path of output FITS file. May be identical to the input FITS file.
+    hdul : HDUList
+        New HDUs. The primary HDU and all extensions with the same name as one
+        of the new HDUs are not copied from the input FITS file.
+    output_verify : str, optional
+        Astropy output verification option for the new HDUs. Use 'ignore' to
+        skip the verification if the headers are known to be good. The
+        default is 'fix'.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    
+    # Write new HDUs to a temporary file first so that the input FITS file
+    # can be overwritten.
+    names = [hdu.name for hdu in hdul]
+    fitsfile_temp = fitsfile_out + '.temp'
+    with pyfits.open(fitsfile) as hdul_src, open(fitsfile, 'rb') as fsrc, open(fitsfile_temp, 'wb') as fout:
+        hdul.writeto(fout, output_verify=output_verify)
+        
+        # Copy header and data blocks of all other extensions.
+        for i in range(1, len(hdul_src)):
+            if hdul_src[i].name in names:
+                continue
+            fileinfo = hdul_src.fileinfo(i)
+            fsrc.seek(fileinfo['hdrLoc'])
+            nbytes = fileinfo['datLoc'] + fileinfo['datSpan'] - fileinfo['hdrLoc']
+            while nbytes > 0:
+                chunk = fsrc.read(min(nbytes, 2**24))
+                if len(chunk) == 0:
+                    raise UserWarning('Unexpected end of file while copying ' + fitsfile)
+                fout.write(chunk)
+                nbytes -= len(chunk)
+    os.replace(fitsfile_temp, fitsfile_out)
+    
+    pass
+
+def _ext_header(header):
+    """
+    Copy an extension header without the scaling keywords so that astropy can
+    set them according to the new data.
+    
+    Parameters
+    ----------
+    header : FITS header
+        Input FITS header. May be None.
+    
+    Returns
+    -------
+    header : FITS header
+        Output FITS header. None if the input FITS header is None.
+    
+    """
+    
+    # Copy header.
+    if header is None:
+        return None
+    header = header.copy()
+    for key in ['BZERO', 'BSCALE', 'BLANK']:
+        header.remove(key, ignore_missing=True)
+    
+    return header
+
 def write_obs(fitsfile,
               output_dir,
               data,
@@ -115,9 +229,12 @@ def write_obs(fitsfile,
               imshifts=None,
               maskoffs=None,
               var_poisson=None,
-              var_rnoise=None):
+              var_rnoise=None,
+              output_verify='fix'):
     """
-    Write an observation to a FITS file.
+    Write an observation to a FITS file. The output FITS file is built
+    directly from the provided arrays and headers. All other extensions of the
+    input FITS file (e.g., AREA or ASDF) are copied byte-for-byte.
     
     Parameters
     ----------
@@ -147,6 +264,10 @@ def write_obs(fitsfile,
         'VAR_POISSON' extension data. The default is None.
     var_rnoise : 3D-array, optional
         'VAR_RNOISE' extension data. The default is None.
+    output_verify : str, optional
+        Astropy output verification option for the new extensions. Use
+        'ignore' to skip the verification if the headers are known to be good.
+        The default is 'fix'.
     
     Returns
     -------
@@ -155,41 +276,146 @@ def write_obs(fitsfile,
     
     """
     
-    # Write FITS file.
-    hdul = pyfits.open(fitsfile)
+    # Get headers of the extensions to be replaced.
+    with pyfits.open(fitsfile) as hdul_src:
+        heads = {}
+        for ext in ['ERR', 'DQ', 'VAR_POISSON', 'VAR_RNOISE', 'IMSHIFTS', 'MASKOFFS']:
+            try:
+                heads[ext] = hdul_src[ext].header
+            except KeyError:
+                heads[ext] = None
+    
+    # Build new HDUs.
     if is2d:
-        hdul['SCI'].data = data[0]
-        hdul['ERR'].data = erro[0]
-        hdul['DQ'].data = pxdq[0]
-    else:
-        hdul['SCI'].data = data
-        hdul['ERR'].data = erro
-        hdul['DQ'].data = pxdq
-    hdul[0].header = head_pri
-    hdul['SCI'].header = head_sci
-    if imshifts is not None:
-        try:
-            hdul['IMSHIFTS'].data = imshifts
-        except KeyError:
-            hdu = pyfits.ImageHDU(imshifts, name='IMSHIFTS')
-            hdul.append(hdu)
-    if maskoffs is not None:
-        try:
-            hdul['MASKOFFS'].data = maskoffs
-        except KeyError:
-            hdu = pyfits.ImageHDU(maskoffs, name='MASKOFFS')
-            hdul.append(hdu)
+        data = data[0]
+        erro = erro[0]
+        pxdq = pxdq[0]
+    hdul = pyfits.HDUList([pyfits.PrimaryHDU(header=head_pri)])
+    hdul.append(pyfits.ImageHDU(data, header=_ext_header(head_sci), name='SCI'))
+    hdul.append(pyfits.ImageHDU(erro, header=_ext_header(heads['ERR']), name='ERR'))
+    hdul.append(pyfits.ImageHDU(pxdq, header=_ext_header(heads['DQ']), name='DQ'))
     if var_poisson is not None:
-        hdul['VAR_POISSON'].data = var_poisson
+        hdul.append(pyfits.ImageHDU(var_poisson, header=_ext_header(heads['VAR_POISSON']), name='VAR_POISSON'))
     if var_rnoise is not None:
-        hdul['VAR_RNOISE'].data = var_rnoise
-    fitsfile = os.path.join(output_dir, os.path.split(fitsfile)[1])
-    hdul.writeto(fitsfile, output_verify='fix', overwrite=True)
-    hdul.close()
+        hdul.append(pyfits.ImageHDU(var_rnoise, header=_ext_header(heads['VAR_RNOISE']), name='VAR_RNOISE'))
+    if imshifts is not None:
+        hdul.append(pyfits.ImageHDU(imshifts, header=_ext_header(heads['IMSHIFTS']), name='IMSHIFTS'))
+    if maskoffs is not None:
+        hdul.append(pyfits.ImageHDU(maskoffs, header=_ext_header(heads['MASKOFFS']), name='MASKOFFS'))
     
-    return fitsfile
+    # Write FITS file.
+    fitsfile_out = os.path.join(output_dir, os.path.split(fitsfile)[1])
+    _write_hdul(fitsfile, fitsfile_out, hdul, output_verify=output_verify)
+    
+    return fitsfile_out
 
-def read_msk(maskfile):
+def read_ext(fitsfile,
+             extname,
+             memmap=True):
+    """
+    Read only the requested extension(s) from a FITS file. The headers of the
+    other extensions are parsed, but their data are never loaded.
+    
+    Parameters
+    ----------
+    fitsfile : path
+        Path of input FITS file.
+    extname : str or list of str
+        Name(s) of the extension(s) to be read, e.g., 'MASKOFFS' or ['SCI',
+        'DQ'].
+    memmap : bool, optional
+        Memory-map the FITS file? If True, the returned arrays are
+        copy-on-write views of the file on disk which are only paged in when
+        accessed. The default is True.
+    
+    Returns
+    -------
+    data : array or list of array
+        Data of the requested extension(s). None if not available.
+    
+    """
+    
+    # Read FITS file.
+    if isinstance(extname, str):
+        extnames = [extname]
+    else:
+        extnames = extname
+    data = []
+    with pyfits.open(fitsfile, memmap=memmap, lazy_load_hdus=True) as hdul:
+        for ext in extnames:
+            try:
+                data += [_get_data(hdul, ext)]
+            except KeyError:
+                data += [None]
+    
+    if isinstance(extname, str):
+        return data[0]
+    else:
+        return data
+
+@functools.lru_cache(maxsize=256)
+def _get_header(fitsfile,
+                ext,
+                mtime,
+                size):
+    """
+    Read a FITS header. The file modification time and size are part of the
+    arguments so that the LRU cache is invalidated when the file changes.
+    
+    Parameters
+    ----------
+    fitsfile : path
+        Absolute path of input FITS file.
+    ext : int or str
+        Index or name of the extension whose header shall be read.
+    mtime : int
+        Modification time of the FITS file (ns).
+    size : int
+        Size of the FITS file (bytes).
+    
+    Returns
+    -------
+    head : astropy.io.fits.Header
+        Requested FITS header.
+    
+    """
+    
+    # Read FITS header.
+    with pyfits.open(fitsfile, lazy_load_hdus=True) as hdul:
+        head = hdul[ext].header.copy()
+    
+    return head
+
+def get_header(fitsfile,
+               ext='SCI'):
+    """
+    Read a single FITS header through an LRU cache keyed by path, file
+    modification time, and file size, so that repeated reads of the same
+    unchanged file do not reopen it.
+    
+    Parameters
+    ----------
+    fitsfile : path
+        Path of input FITS file.
+    ext : int or str, optional
+        Index or name of the extension whose header shall be read. The
+        default is 'SCI'.
+    
+    Returns
+    -------
+    head : astropy.io.fits.Header
+        Copy of the requested FITS header.
+    
+    """
+    
+    # Read FITS header.
+    stat = os.stat(fitsfile)
+    head = _get_header(os.path.abspath(fitsfile), ext, stat.st_mtime_ns, stat.st_size)
+    
+    return head.copy()
+
+def read_msk(maskfile,
+             memmap=None):
     """
     Read a PSF mask from a FITS file.
     
@@ -197,6 +423,9 @@ def read_msk(maskfile):
     ----------
     maskfile : path
         Path of input FITS file.
+    memmap : bool, optional
+        Memory-map the FITS file? If None, use the astropy default. The
+        default is None.
     
     Returns
     -------
@@ -207,9 +436,7 @@ def read_msk(maskfile):
     
     # Read FITS file.
     if maskfile != 'NONE':
-        hdul = pyfits.open(maskfile)
-        mask = hdul['SCI'].data
-        hdul.close()
+        mask = read_ext(maskfile, 'SCI', memmap=memmap)
     else:
         mask = None
     
@@ -218,9 +445,11 @@ def read_msk(maskfile):
 
 def write_msk(maskfile,
               mask,
-              fitsfile):
+              fitsfile,
+              output_verify='fix'):
     """
-    Write a PSF mask to a FITS file.
+    Write a PSF mask to a FITS file. All other extensions of the input FITS
+    file are copied byte-for-byte.
     
     Parameters
     ----------
@@ -230,6 +459,10 @@ def write_msk(maskfile,
         PSF mask. None if not available.
     fitsfile : path
         Path of output FITS file (to save the PSF mask in the same directory).
+    output_verify : str, optional
+        Astropy output verification option for the new extensions. Use
+        'ignore' to skip the verification if the headers are known to be good.
+        The default is 'fix'.
     
     Returns
     -------
@@ -240,11 +473,15 @@ def write_msk(maskfile,
     
     # Write FITS file.
     if mask is not None:
-        hdul = pyfits.open(maskfile)
-        hdul['SCI'].data = mask
-        maskfile = fitsfile.replace('.fits', '_psfmask.fits')
-        hdul.writeto(maskfile, output_verify='fix', overwrite=True)
-        hdul.close()
+        with pyfits.open(maskfile) as hdul_src:
+            data_pri = hdul_src[0].data
+            head_pri = _ext_header(hdul_src[0].header)
+            head_sci = _ext_header(hdul_src['SCI'].header)
+        hdul = pyfits.HDUList([pyfits.PrimaryHDU(data_pri, header=head_pri)])
+        hdul.append(pyfits.ImageHDU(mask, header=head_sci, name='SCI'))
+        maskfile_out = fitsfile.replace('.fits', '_psfmask.fits')
+        _write_hdul(maskfile, maskfile_out, hdul, output_verify=output_verify)
+        maskfile = maskfile_out
     else:
         maskfile = 'NONE'
     
@@ -451,6 +688,204 @@ def imshift(image,
         else:
             raise UserWarning('Image shift method "' + method + '" is not known')
 
+@functools.lru_cache(maxsize=32)
+def _fourier_ramps(ny,
+                   nx):
+    """
+    Get the phase ramps for shifting real-valued images of a given shape in
+    the Fourier domain. The frequencies follow the convention of
+    scipy.ndimage.fourier_shift so that the Nyquist terms are treated in the
+    same way as by the imshift routine.
+    
+    Parameters
+    ----------
+    ny : int
+        Image size along the y-axis.
+    nx : int
+        Image size along the x-axis.
+    
+    Returns
+    -------
+    ramp_y : 1D-array
+        Phase ramp per pixel of y-shift.
+    ramp_x : 1D-array
+        Phase ramp per pixel of x-shift for the real-to-complex transform.
+    
+    """
+    
+    # Compute phase ramps.
+    freq_x = np.fft.rfftfreq(nx)
+    if nx % 2 == 0:
+        freq_x[-1] *= -1.
+    ramp_y = -2j * np.pi * np.fft.fftfreq(ny)
+    ramp_x = -2j * np.pi * freq_x
+    ramp_y.flags.writeable = False
+    ramp_x.flags.writeable = False
+    
+    return ramp_y, ramp_x
+
+def _fourier_phase(shifts,
+                   ny,
+                   nx,
+                   deriv=False):
+    """
+    Get the phase factors for shifting real-valued images in the Fourier
+    domain of the real-to-complex transform. The phase ramps are separable in
+    x and y. Taking the real part of the complex inverse transform in the
+    imshift routine reduces the phase of the Nyquist terms to its real part,
+    which is replicated here.
+    
+    Parameters
+    ----------
+    shifts : 2D-array
+        X- and y-shift of shape (nints, 2).
+    ny : int
+        Image size along the y-axis.
+    nx : int
+        Image size along the x-axis.
+    deriv : bool, optional
+        Also return the derivatives of the phase factors with respect to the
+        x- and y-shift? The default is False.
+    
+    Returns
+    -------
+    phase : 3D-array
+        Phase factors of shape (nints, ny, nx // 2 + 1).
+    dphase_x : 3D-array
+        Derivative of the phase factors with respect to the x-shift. Only
+        returned if deriv is True.
+    dphase_y : 3D-array
+        Derivative of the phase factors with respect to the y-shift. Only
+        returned if deriv is True.
+    
+    """
+    
+    # Compute phase factors.
+    ramp_y, ramp_x = _fourier_ramps(ny, nx)
+    phase_y = np.exp(shifts[:, 1, None] * ramp_y[None, :])
+    phase_x = np.exp(shifts[:, 0, None] * ramp_x[None, :])
+    dphase_y = phase_y * ramp_y[None, :]
+    if ny % 2 == 0:
+        phase_y[:, ny // 2] = np.cos(np.pi * shifts[:, 1])
+        dphase_y[:, ny // 2] = -np.pi * np.sin(np.pi * shifts[:, 1])
+    phase = phase_y[:, :, None] * phase_x[:, None, :]
+    if ny % 2 == 0 and nx % 2 == 0:
+        phase[:, ny // 2, -1] = np.cos(np.pi * (shifts[:, 0] + shifts[:, 1]))
+    if not deriv:
+        return phase
+    
+    # Compute derivatives.
+    dphase_x = phase * ramp_x[None, None, :]
+    dphase_y = dphase_y[:, :, None] * phase_x[:, None, :]
+    if ny % 2 == 0 and nx % 2 == 0:
+        dphase_x[:, ny // 2, -1] = -np.pi * np.sin(np.pi * (shifts[:, 0] + shifts[:, 1]))
+        dphase_y[:, ny // 2, -1] = dphase_x[:, ny // 2, -1]
+    
+    return phase, dphase_x, dphase_y
+
+def _fourier_shift_cube(cube,
+                        shifts,
+                        workers=-1):
+    """
+    Shift all frames of a cube with a single batched real-to-complex FFT.
+    The frames wrap around the edges.
+    
+    Parameters
+    ----------
+    cube : 3D-array or ND-array
+        Input cube of shape (..., nints, ny, nx) to be shifted.
+    shifts : 2D-array
+        X- and y-shift of shape (nints, 2) to be applied to each frame.
+    workers : int, optional
+        Number of workers for the scipy.fft routines. Negative values count
+        from the number of available CPU cores. The default is -1.
+    
+    Returns
+    -------
+    cbsft : 3D-array or ND-array
+        The shifted cube.
+    
+    """
+    
+    # Shift cube.
+    ny, nx = cube.shape[-2:]
+    cbsft = scipy.fft.rfft2(cube.astype(np.result_type(cube.dtype, np.float32), copy=False), workers=workers)
+    cbsft *= _fourier_phase(shifts, ny, nx)
+    cbsft = scipy.fft.irfft2(cbsft, s=(ny, nx), workers=workers)
+    
+    return cbsft
+
+def imshift_cube(cube,
+                 shifts,
+                 pad=False,
+                 cval=0.,
+                 method='fourier',
+                 kwargs={},
+                 workers=-1):
+    """
+    Shift all frames of a cube. For the Fourier method, all frames are
+    shifted with a single batched real-to-complex FFT. Leading axes in front
+    of the frame axis (e.g., stacked data and uncertainties) share the same
+    shifts and are transformed together.
+    
+    Parameters
+    ----------
+    cube : 3D-array or ND-array
+        Input cube of shape (..., nints, ny, nx) to be shifted.
+    shifts : 2D-array
+        X- and y-shift of shape (nints, 2) to be applied to each frame.
+    pad : bool, optional
+        Pad the frames before shifting them? Otherwise, they will wrap around
+        the edges. Each frame is padded by its own shift as in the imshift
+        routine. The default is False.
+    cval : float, optional
+        Fill value for the padded pixels. The default is 0.
+    method : 'fourier' or 'spline' (not recommended), optional
+        Method for shifting the frames. The default is 'fourier'.
+    kwargs : dict, optional
+        Keyword arguments for the scipy.ndimage.shift routine. The default
+        is {}.
+    workers : int, optional
+        Number of workers for the scipy.fft routines. Negative values count
+        from the number of available CPU cores. The default is -1.
+    
+    Returns
+    -------
+    cbsft : 3D-array or ND-array
+        The shifted cube.
+    
+    """
+    
+    # Check input.
+    cube = np.asarray(cube)
+    shifts = np.asarray(shifts, dtype=float).reshape((-1, 2))
+    if cube.ndim < 3 or cube.shape[-3] != shifts.shape[0]:
+        raise UserWarning('Number of shifts does not match the number of frames')
+    
+    # Spline shifts are applied frame by frame.
+    if method == 'spline':
+        cbsft = np.empty(cube.shape)
+        for index in np.ndindex(cube.shape[:-2]):
+            cbsft[index] = imshift(cube[index], shifts[index[-1]], pad=pad, cval=cval, method=method, kwargs=kwargs)
+        return cbsft
+    elif method != 'fourier':
+        raise UserWarning('Image shift method "' + method + '" is not known')
+    
+    # Shift cube. With padding, each frame is padded by its own shift in the
+    # same way as by the imshift routine, so that the frames are shifted in
+    # batches of equal padding.
+    if not pad:
+        return _fourier_shift_cube(cube, shifts, workers)
+    sy, sx = cube.shape[-2:]
+    pads = np.abs(shifts.astype(int)) + 5
+    cbsft = np.empty(cube.shape, dtype=np.result_type(cube.dtype, np.float32))
+    for padx, pady in np.unique(pads, axis=0):
+        ww = np.where((pads[:, 0] == padx) & (pads[:, 1] == pady))[0]
+        impad = np.pad(cube[..., ww, :, :], [(0, 0)] * (cube.ndim - 2) + [(pady, pady), (padx, padx)], mode='constant', constant_values=cval)
+        cbsft[..., ww, :, :] = _fourier_shift_cube(impad, shifts[ww], workers)[..., pady:pady + sy, padx:padx + sx]
+    
+    return cbsft
+
 def alignlsq(shift,
              image,
              ref_image,
@@ -490,6 +925,112 @@ def alignlsq(shift,
     else:
         return ((ref_image - shift[2] * imshift(image, shift[:2], method=method, kwargs=kwargs)) * mask).ravel()
 
+def alignfast(cube,
+              ref_image,
+              mask=None,
+              upsample_factor=10,
+              maxiter=20,
+              tol=1e-6,
+              maxmem=2**30,
+              workers=-1):
+    """
+    Align all frames of a cube to a reference image. The initial shifts are
+    determined from a masked, upsampled DFT cross-correlation and then
+    refined with a Gauss-Newton least squares fit of the same model as the
+    alignlsq routine. The Jacobians are computed analytically in Fourier
+    space and the scaling factor is solved in closed form at each iteration.
+    
+    Parameters
+    ----------
+    cube : 3D-array
+        Input frames of shape (nints, ny, nx) to be aligned to a reference
+        image.
+    ref_image : 2D-array
+        Reference image.
+    mask : 2D-array, optional
+        Weights to be applied to the input and reference images. The
+        default is None.
+    upsample_factor : int, optional
+        Upsampling factor of the DFT cross-correlation. Only needs to bring
+        the initial shifts within the convergence range of the subsequent
+        least squares fit. The default is 10.
+    maxiter : int, optional
+        Maximum number of Gauss-Newton iterations. The default is 20.
+    tol : float, optional
+        Convergence tolerance on the shift update in pixels. The default is
+        1e-6.
+    maxmem : int, optional
+        Maximum number of bytes used for the temporary arrays. The frames
+        are processed in chunks if required. The default is 2**30.
+    workers : int, optional
+        Number of workers for the scipy.fft routines. Negative values count
+        from the number of available CPU cores. The default is -1.
+    
+    Returns
+    -------
+    shifts : 2D-array
+        X- and y-shift and scaling factor of shape (nints, 3) to be applied
+        to each frame.
+    
+    """
+    
+    # Check input.
+    cube = np.asarray(cube, dtype=float)
+    nints, ny, nx = cube.shape
+    if mask is None:
+        mask = np.ones((ny, nx))
+    weight = mask.ravel()**2
+    
+    # Get initial shifts from the upsampled DFT cross-correlation.
+    shifts = np.zeros((nints, 3))
+    for k in range(nints):
+        yshift, xshift = phase_cross_correlation(ref_image * mask,
+                                                 cube[k] * mask,
+                                                 upsample_factor=upsample_factor,
+                                                 normalization=None)[0]
+        shifts[k, :2] = [xshift, yshift]
+    
+    # Refine shifts with a Gauss-Newton least squares fit. The frames are
+    # processed in chunks to limit the memory footprint.
+    nchunk = max(1, int(maxmem // (8 * 16 * ny * (nx // 2 + 1))))
+    for k0 in range(0, nints, nchunk):
+        ft = scipy.fft.rfft2(cube[k0:k0 + nchunk], workers=workers)
+        chunk = shifts[k0:k0 + nchunk]
+        active = np.arange(chunk.shape[0])
+        for it in range(maxiter):
+            
+            # Compute shifted frames and their derivatives.
+            phase, dphase_x, dphase_y = _fourier_phase(chunk[active, :2], ny, nx, deriv=True)
+            temp = np.array([phase, dphase_x, dphase_y]) * ft[active]
+            model, deriv_x, deriv_y = scipy.fft.irfft2(temp, s=(ny, nx), workers=workers).reshape((3, len(active), ny * nx))
+            
+            # Compute scaling factor in closed form.
+            temp = weight * model
+            scale = np.dot(temp, ref_image.ravel()) / np.einsum('ki,ki->k', temp, model)
+            chunk[active, 2] = scale
+            
+            # Solve normal equations for the shift update.
+            temp = weight * deriv_x
+            gxx = np.einsum('ki,ki->k', temp, deriv_x)
+            gxy = np.einsum('ki,ki->k', temp, deriv_y)
+            bx = np.dot(temp, ref_image.ravel()) - scale * np.einsum('ki,ki->k', temp, model)
+            temp = weight * deriv_y
+            gyy = np.einsum('ki,ki->k', temp, deriv_y)
+            by = np.dot(temp, ref_image.ravel()) - scale * np.einsum('ki,ki->k', temp, model)
+            det = (gxx * gyy - gxy**2) * scale
+            dx = (gyy * bx - gxy * by) / det
+            dy = (gxx * by - gxy * bx) / det
+            chunk[active, 0] += dx
+            chunk[active, 1] += dy
+            
+            # Check convergence.
+            active = active[np.sqrt(dx**2 + dy**2) > tol]
+            if len(active) == 0:
+                break
+        shifts[k0:k0 + nchunk] = chunk
+    
+    return shifts
+
 def recenterlsq(shift,
                 image,
                 method='fourier',
@@ -551,6 +1092,182 @@ def subtractlsq(shift,
     else:
         return res[mask]
 
+def _nanmedian(vals,
+               axis=-1):
+    """
+    Compute the nan-median along one axis of an array by sorting it. Gives
+    the same result as np.nanmedian, but is faster for short axes and avoids
+    its per-pixel Python loop for long axes.
+    
+    Parameters
+    ----------
+    vals : array
+        Input array.
+    axis : int, optional
+        Axis along which the nan-median shall be computed. The default is -1.
+    
+    Returns
+    -------
+    med : array
+        Nan-median along the requested axis of the input array.
+    
+    """
+    
+    # Sort values, nans go to the end.
+    vals = np.sort(vals, axis=axis)
+    nval = np.sum(np.logical_not(np.isnan(vals)), axis=axis, keepdims=True)
+    lo = np.squeeze(np.take_along_axis(vals, np.maximum((nval - 1) // 2, 0), axis=axis), axis=axis)
+    hi = np.squeeze(np.take_along_axis(vals, np.minimum(nval // 2, vals.shape[axis] - 1), axis=axis), axis=axis)
+    med = (lo + hi) / 2.
+    med[np.squeeze(nval, axis=axis) == 0] = np.nan
+    
+    return med
+
+def neighbor_median(cube,
+                    shift_x=[-1, 0, 1],
+                    shift_y=[-1, 0, 1],
+                    index=None,
+                    return_std=False,
+                    maxmem=2**30):
+    """
+    Compute the nan-median of the neighbors of each pixel in a cube of
+    frames. The neighbors of pixel (y, x) are the pixels (y - iy, x - ix) for
+    all combinations of ix in shift_x and iy in shift_y except (0, 0), where
+    the frames are edge-padded. The neighborhoods are taken from a strided
+    sliding window view of the whole cube, so that no shifted copies of the
+    frames are made.
+    
+    For footprints which are symmetric about (0, 0), the result is identical
+    to that of the previous implementation, which rolled edge-padded copies
+    of the frames. For asymmetric footprints, the previous implementation
+    wrapped around the padded frames and compared pixels within
+    max(|shift|) of the frame edges to pixels from the opposite edge. Here,
+    these neighbors are taken from the nearest edge pixel instead.
+    
+    Parameters
+    ----------
+    cube : 3D-array
+        Input frames. Bad pixels should be nan.
+    shift_x : list of int, optional
+        Pixels in x-direction from which the median shall be computed. The
+        default is [-1, 0, 1].
+    shift_y : list of int, optional
+        Pixels in y-direction from which the median shall be computed. The
+        default is [-1, 0, 1].
+    index : tuple of 1D-array, optional
+        Indices (frame, y, x) of the pixels for which the median shall be
+        computed, e.g., the output of np.nonzero applied to a bad pixel map.
+        If None, the median will be computed for all pixels. The default is
+        None.
+    return_std : bool, optional
+        Also return the nan-standard deviation of the neighbors? The default
+        is False.
+    maxmem : int, optional
+        Maximum number of bytes used for the gathered neighborhoods when
+        computing the median for all pixels. The default is 2**30.
+    
+    Returns
+    -------
+    med : 1D-array or 3D-array
+        Nan-median of the neighbors of the selected pixels (1D-array) or of
+        all pixels (3D-array).
+    std : 1D-array or 3D-array, optional
+        Nan-standard deviation of the neighbors of the selected pixels
+        (1D-array) or of all pixels (3D-array).
+    
+    """
+    
+    # Get footprint of the neighborhood within a window that contains the
+    # pixel (y, x) at position (ylo, xlo).
+    ylo, yhi = max(np.max(shift_y), 0), max(-np.min(shift_y), 0)
+    xlo, xhi = max(np.max(shift_x), 0), max(-np.min(shift_x), 0)
+    wyi = []
+    wxi = []
+    for ix in shift_x:
+        for iy in shift_y:
+            if ix != 0 or iy != 0:
+                wyi += [ylo - iy]
+                wxi += [xlo - ix]
+    
+    # Get sliding window view of the edge-padded frames.
+    pad = np.pad(cube, ((0, 0), (ylo, yhi), (xlo, xhi)), mode='edge')
+    win = sliding_window_view(pad, (ylo + yhi + 1, xlo + xhi + 1), axis=(1, 2))
+    
+    # Compute median of the neighbors of the selected pixels.
+    if index is not None:
+        vals = win[tuple(index)][:, wyi, wxi]
+        med = _nanmedian(vals, axis=-1)
+        if return_std:
+            return med, np.nanstd(vals, axis=-1)
+        else:
+            return med
+    
+    # Compute median of the neighbors of all pixels in chunks of frames.
+    med = np.empty(cube.shape, dtype=np.result_type(cube.dtype, np.float32))
+    if return_std:
+        std = np.empty_like(med)
+    nchunk = max(1, int(maxmem // (len(wyi) * np.prod(cube.shape[1:]) * cube.itemsize)))
+    for k in range(0, cube.shape[0], nchunk):
+        vals = win[k:k + nchunk][:, :, :, wyi, wxi]
+        med[k:k + nchunk] = _nanmedian(vals, axis=-1)
+        if return_std:
+            std[k:k + nchunk] = np.nanstd(vals, axis=-1)
+    
+    if return_std:
+        return med, std
+    else:
+        return med
+
+def temporal_median(cube,
+                    pixmask=None,
+                    maxmem=2**30):
+    """
+    Compute the nan-median along the first (time) axis of a cube. The median
+    is computed in spatial chunks so that the temporary arrays never exceed
+    the memory budget.
+    
+    Parameters
+    ----------
+    cube : array
+        Input cube of shape (nints, ...).
+    pixmask : array, optional
+        Binary map of shape cube.shape[1:] (1 = compute, 0 = skip) of the
+        pixels for which the median shall be computed. Skipped pixels are nan.
+        If None, the median will be computed for all pixels. The default is
+        None.
+    maxmem : int, optional
+        Maximum number of bytes used for the temporary arrays of each chunk.
+        The default is 2**30.
+    
+    Returns
+    -------
+    med : array
+        Nan-median of shape cube.shape[1:].
+    
+    """
+    
+    # Flatten spatial axes.
+    nint = cube.shape[0]
+    flat = cube.reshape((nint, -1))
+    med = np.full(flat.shape[1], np.nan, dtype=np.result_type(cube.dtype, np.float32))
+    if pixmask is None:
+        ind = None
+        npix = flat.shape[1]
+    else:
+        ind = np.flatnonzero(pixmask)
+        npix = len(ind)
+    
+    # Compute median in chunks of pixels. Sorting needs a copy of the chunk
+    # plus a few arrays of the same size.
+    nchunk = max(1, int(maxmem // (3 * nint * max(cube.itemsize, 4))))
+    for k in range(0, npix, nchunk):
+        if ind is None:
+            med[k:k + nchunk] = _nanmedian(flat[:, k:k + nchunk], axis=0)
+        else:
+            med[ind[k:k + nchunk]] = _nanmedian(flat[:, ind[k:k + nchunk]], axis=0)
+    
+    return med.reshape(cube.shape[1:])
+
 def get_tp_comsubst(instrume,
                     subarray,
                     filt):
@@ -0,0 +1,225 @@
+from __future__ import division
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+from astropy.table import Table
+from spaceKLIP import coron1pipeline, database
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def grow_saturation_roll(groupdq,
+                         sat):
+    
+    # Previous implementation which rolled the saturation mask of the whole
+    # ramp.
+    mask_sat = groupdq & sat == sat
+    mask_vp1 = np.roll(mask_sat, +1, axis=-2)
+    mask_vm1 = np.roll(mask_sat, -1, axis=-2)
+    mask_hp1 = np.roll(mask_sat, +1, axis=-1)
+    mask_hm1 = np.roll(mask_sat, -1, axis=-1)
+    mask_vp1[:, :, 0, :] = 0
+    mask_vm1[:, :, -1, :] = 0
+    mask_hp1[:, :, :, 0] = 0
+    mask_hm1[:, :, :, -1] = 0
+    mask_sat = mask_sat | mask_vp1 | mask_vm1 | mask_hp1 | mask_hm1
+    
+    return groupdq | (mask_sat * sat).astype(groupdq.dtype)
+
+def test_grow_saturation():
+    
+    # The in-place growth must flag the same pixels as the previous
+    # implementation.
+    rng = np.random.default_rng(6)
+    sat = 2
+    for shape in [(1, 3, 8, 8), (3, 5, 17, 23)]:
+        for frac in [0.01, 0.2]:
+            groupdq = rng.integers(0, 2**8, size=shape).astype(np.uint8)
+            groupdq &= ~np.uint8(sat)
+            groupdq[rng.random(shape) < frac] |= sat
+            groupdq[..., 0, 0] |= sat
+            groupdq[..., -1, -1] |= sat
+            ref = grow_saturation_roll(groupdq, sat)
+            coron1pipeline._grow_saturation(groupdq, sat)
+            np.testing.assert_array_equal(groupdq, ref)
+
+def make_ramp(nints=2,
+              ngroups=4,
+              seed=7):
+    
+    # Make a synthetic NIRCam subarray ramp with group-dependent drifts which
+    # are different in the even and odd columns.
+    rng = np.random.default_rng(seed)
+    ny, nx = 64, 64
+    data = rng.normal(scale=5., size=(nints, ngroups, ny, nx))
+    data += 100. * np.arange(ngroups)[None, :, None, None]
+    data += rng.normal(scale=20., size=(nints, ngroups, 1, 1))
+    data[:, :, :, 1::2] += rng.normal(scale=10., size=(nints, ngroups, 1, 1))
+    data[:, :, 1, 2] += 1e4
+    data[:, :, 30, -2] -= 1e4
+    model = coron1pipeline.RampModel(data=data.astype(np.float32),
+                                     pixeldq=np.zeros((ny, nx), dtype=np.uint32),
+                                     groupdq=np.zeros(data.shape, dtype=np.uint8))
+    model.meta.instrument.name = 'NIRCAM'
+    model.meta.instrument.detector = 'NRCALONG'
+    model.meta.instrument.channel = 'LONG'
+    model.meta.instrument.module = 'A'
+    model.meta.exposure.type = 'NRC_CORON'
+    model.meta.exposure.readpatt = 'MEDIUM8'
+    model.meta.exposure.nframes = 8
+    model.meta.exposure.groupgap = 2
+    model.meta.exposure.ngroups = ngroups
+    model.meta.exposure.nints = nints
+    model.meta.exposure.noutputs = 1
+    model.meta.exposure.zero_frame = False
+    model.meta.subarray.name = 'SUB64P'
+    model.meta.subarray.xstart = 1
+    model.meta.subarray.ystart = 1
+    model.meta.subarray.xsize = nx
+    model.meta.subarray.ysize = ny
+    
+    return model
+
+def test_pseudo_refpix(tmp_path):
+    
+    # The streamed pseudo reference pixel correction must match the JWST
+    # stage 1 refpix step run on the flagged pseudo reference pixels.
+    refpix = coron1pipeline.dqflags.pixel['REFERENCE_PIXEL']
+    for odd_even_columns in [True, False]:
+        pipeline = coron1pipeline.Coron1Pipeline_spaceKLIP(output_dir=str(tmp_path))
+        pipeline.refpix.odd_even_columns = odd_even_columns
+        pipeline.refpix.nlower = 4
+        pipeline.refpix.nupper = 0
+        pipeline.refpix.nleft = 4
+        pipeline.refpix.nright = 4
+        model = make_ramp()
+        res = pipeline.do_pseudo_refpix(model.copy())
+        assert res.meta.cal_step.refpix == 'COMPLETE'
+        assert pipeline.refpix_drifts.shape == (2, 4, 2 if odd_even_columns else 1)
+        np.testing.assert_array_equal(res.pixeldq, model.pixeldq)
+        
+        # Run the JWST stage 1 refpix step on the flagged pseudo reference
+        # pixels.
+        ref = model.copy()
+        ref.pixeldq[:4, :] |= refpix
+        ref.pixeldq[:, :4] |= refpix
+        ref.pixeldq[:, -4:] |= refpix
+        ref = pipeline.run_step(pipeline.refpix, ref, save_results=False)
+        assert ref.meta.cal_step.refpix == 'COMPLETE'
+        np.testing.assert_allclose(res.data, ref.data, rtol=0., atol=1e-3)
+
+def test_process_chunked(tmp_path):
+    
+    # Make an uncal file with ramps, cosmic rays, and matching gain and read
+    # noise reference files.
+    from jwst.datamodels import GainModel, ReadnoiseModel
+    model = make_ramp(nints=5, ngroups=6, seed=8)
+    model.data[2, 3:, 20, 20] += 5e3
+    model.data[4, 2:, 40, 12] += 5e3
+    model.meta.exposure.integration_start = 1
+    model.meta.exposure.integration_end = 5
+    model.meta.exposure.frame_time = 1.
+    model.meta.exposure.group_time = 10.
+    model.meta.exposure.drop_frames1 = 0
+    model.meta.observation.date = '2023-01-01'
+    model.meta.observation.time = '00:00:00'
+    uncal = os.path.join(str(tmp_path), 'jw01234001001_01101_00001_nrcalong_uncal.fits')
+    model.save(uncal)
+    reffiles = {}
+    for name, refmodel, value in [('gain', GainModel, 2.), ('readnoise', ReadnoiseModel, 10.)]:
+        ref = refmodel(data=np.full(model.data.shape[2:], value, dtype=np.float32))
+        ref.meta.instrument.name = 'NIRCAM'
+        ref.meta.instrument.detector = 'NRCALONG'
+        ref.meta.subarray.name = 'SUB64P'
+        ref.meta.subarray.xstart = 1
+        ref.meta.subarray.ystart = 1
+        ref.meta.subarray.xsize = model.data.shape[3]
+        ref.meta.subarray.ysize = model.data.shape[2]
+        reffiles[name] = os.path.join(str(tmp_path), name + '.fits')
+        ref.save(reffiles[name])
+    
+    # Run the pipeline with and without integration chunks. Only the steps
+    # which do not need CRDS reference files are run.
+    res = {}
+    for chunk_nints in [None, 2]:
+        output_dir = os.path.join(str(tmp_path), str(chunk_nints))
+        os.makedirs(output_dir)
+        pipeline = coron1pipeline.Coron1Pipeline_spaceKLIP(output_dir=output_dir)
+        pipeline.save_results = True
+        pipeline.chunk_nints = chunk_nints
+        pipeline.ramp_fit.save_calibrated_ramp = True
+        for name in ['dq_init', 'saturation', 'ipc', 'superbias', 'linearity', 'persistence', 'dark_current']:
+            getattr(pipeline, name).skip = True
+        for name in ['jump', 'ramp_fit', 'gain_scale']:
+            for reftype in ['gain', 'readnoise']:
+                setattr(getattr(pipeline, name), 'override_' + reftype, reffiles[reftype])
+        res[chunk_nints] = (pipeline.process(uncal), pipeline.refpix_drifts)
+    
+    # The chunked processing must be identical to the unchunked processing,
+    # including the calibrated ramp and the rateints product.
+    rate, drifts = res[None]
+    rate_chunked, drifts_chunked = res[2]
+    np.testing.assert_array_equal(drifts_chunked, drifts)
+    for ext in ['data', 'dq', 'err', 'var_poisson', 'var_rnoise']:
+        np.testing.assert_array_equal(getattr(rate_chunked, ext), getattr(rate, ext))
+    assert rate_chunked.meta.exposure.integration_start == 1
+    assert rate_chunked.meta.exposure.integration_end == 5
+    for suffix, exts in [('ramp', ['SCI', 'GROUPDQ', 'PIXELDQ']), ('rateints', ['SCI', 'DQ', 'ERR'])]:
+        file = os.path.basename(uncal).replace('uncal', suffix)
+        with pyfits.open(os.path.join(str(tmp_path), 'None', file)) as hdul, pyfits.open(os.path.join(str(tmp_path), '2', file)) as hdul_chunked:
+            for ext in exts:
+                np.testing.assert_array_equal(hdul_chunked[ext].data, hdul[ext].data)
+
+def run_file(fitspath,
+             output_dir,
+             steps,
+             chunk_nints=None):
+    
+    # Write a rateints file without running the pipeline.
+    fitsfile = os.path.join(output_dir, os.path.basename(fitspath).replace('uncal', 'rateints'))
+    with open(fitsfile, 'w') as f:
+        f.write(str(os.getpid()))
+    
+    return fitsfile, 'DN/s'
+
+def test_run_obs_parallel(tmp_path, monkeypatch):
+    
+    # The worker processes must update the database in the same order and
+    # with the same content as the serial run.
+    monkeypatch.setattr(coron1pipeline, '_run_file', run_file)
+    fetched = []
+    monkeypatch.setattr(coron1pipeline, 'fetch_references', lambda fitspaths: fetched.append(fitspaths))
+    databases = {}
+    for n_jobs in [1, 3]:
+        output_dir = os.path.join(str(tmp_path), str(n_jobs))
+        Database = database.Database(output_dir=output_dir)
+        Database.obs = {}
+        for key, nfitsfiles in [('KEY1', 3), ('KEY2', 2)]:
+            Database.obs[key] = Table([['%s_%.0f_uncal.fits' % (key, j) for j in range(nfitsfiles)],
+                                       ['NONE'] * nfitsfiles,
+                                       ['STAGE0'] * (nfitsfiles - 1) + ['STAGE1'],
+                                       ['NONE'] * nfitsfiles],
+                                      names=('FITSFILE', 'MASKFILE', 'DATAMODL', 'BUNIT'),
+                                      dtype=('object', 'object', 'object', 'object'))
+        coron1pipeline.run_obs(Database, n_jobs=n_jobs)
+        databases[n_jobs] = Database
+    assert len(fetched) == 1 and len(fetched[0]) == 3
+    with open(databases[3].obs['KEY1']['FITSFILE'][0]) as f:
+        assert f.read() != str(os.getpid())
+    for key in databases[1].obs.keys():
+        for name in ['DATAMODL', 'BUNIT']:
+            assert list(databases[3].obs[key][name]) == list(databases[1].obs[key][name])
+        assert [os.path.relpath(fitsfile, databases[3].output_dir) for fitsfile in databases[3].obs[key]['FITSFILE']] == [os.path.relpath(fitsfile, databases[1].output_dir) for fitsfile in databases[1].obs[key]['FITSFILE']]
+        assert [item[0] for item in databases[3].history[key]] == [item[0] for item in databases[1].history[key]]
+    assert list(databases[1].obs['KEY1']['DATAMODL']) == ['STAGE1', 'STAGE1', 'STAGE1']
+    assert databases[1].obs['KEY1']['FITSFILE'][2] == 'KEY1_2_uncal.fits'
@@ -0,0 +1,71 @@
+from __future__ import division
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+
+import numpy as np
+
+from jwst import datamodels
+from spaceKLIP import coron2pipeline
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def make_cal(output_dir,
+             name,
+             filt):
+    
+    # Make a minimal NIRCam stage 1 FITS file.
+    model = datamodels.CubeModel(data=np.zeros((2, 16, 16), dtype=np.float32))
+    model.meta.instrument.name = 'NIRCAM'
+    model.meta.instrument.detector = 'NRCALONG'
+    model.meta.instrument.filter = filt
+    model.meta.instrument.pupil = 'MASKRND'
+    model.meta.exposure.type = 'NRC_CORON'
+    model.meta.observation.date = '2023-01-01'
+    model.meta.observation.time = '00:00:00'
+    fitspath = os.path.join(str(output_dir), name + '_rateints.fits')
+    model.save(fitspath)
+    
+    return fitspath
+
+def test_get_references(tmp_path, monkeypatch):
+    
+    # The reference files are resolved by a single CRDS query per FITS file
+    # from the CRDS parameters of the FITS file.
+    queries = []
+    def get_multiple_reference_paths(parameters, reftypes, observatory):
+        queries.append(list(reftypes))
+        return {reftype: reftype + '_' + parameters['meta.instrument.filter'] + '.fits' for reftype in reftypes}
+    monkeypatch.setattr(coron2pipeline.crds_client, 'get_multiple_reference_paths', get_multiple_reference_paths)
+    steps = {'flat_field': {'override_flat': 'user_flat.fits'},
+             'photom': {'skip': True}}
+    template = coron2pipeline._get_pipeline(str(tmp_path), steps)
+    refs = coron2pipeline._get_references(template, make_cal(tmp_path, 'a', 'F444W'))
+    assert len(queries) == 1
+    assert ('assign_wcs', 'distortion') in refs.keys()
+    assert ('flat_field', 'flat') not in refs.keys()
+    assert 'photom' not in [name for name, reftype in refs.keys()]
+    for (name, reftype), path in refs.items():
+        assert path == reftype + '_F444W.fits'
+    
+    # The same configuration resolves to the same reference files, a
+    # different configuration does not.
+    refs_b = coron2pipeline._get_references(template, make_cal(tmp_path, 'b', 'F444W'))
+    refs_c = coron2pipeline._get_references(template, make_cal(tmp_path, 'c', 'F356W'))
+    assert tuple(sorted(refs_b.items())) == tuple(sorted(refs.items()))
+    assert tuple(sorted(refs_c.items())) != tuple(sorted(refs.items()))
+    
+    # The resolved reference files are set as step overrides, the reference
+    # files set by the user are kept.
+    pipeline = coron2pipeline._get_pipeline(str(tmp_path), steps, refs)
+    for (name, reftype), path in refs.items():
+        assert getattr(getattr(pipeline, name), 'override_' + reftype) == path
+    assert pipeline.flat_field.override_flat == 'user_flat.fits'
+    assert pipeline.photom.skip
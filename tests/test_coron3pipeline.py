@@ -0,0 +1,86 @@
+from __future__ import division
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import json
+import os
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+from astropy.table import Table
+from spaceKLIP import coron3pipeline, database
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def make_database(output_dir):
+    
+    # Make a spaceKLIP database with a single concatenation.
+    Database = database.Database(output_dir=str(output_dir))
+    Database.obs = {'KEY': Table([['sci0_calints.fits', 'ref0_calints.fits', 'sci1_calints.fits', 'ref1_calints.fits', 'ta_calints.fits'],
+                                  ['SCI', 'REF', 'SCI', 'REF', 'SCI_TA']],
+                                 names=('FITSFILE', 'TYPE'),
+                                 dtype=('object', 'object'))}
+    
+    return Database
+
+def test_make_asn(tmp_path):
+    
+    # The in-memory association must have the same content as the
+    # association file written by the previous implementation.
+    Database = make_database(tmp_path)
+    asn = coron3pipeline.make_asn(Database, 'KEY')
+    assert asn['asn_type'] == 'coron3'
+    assert asn['asn_rule'] == 'candidate_Asn_Lv3Coron'
+    assert asn['program'] == '00000'
+    assert asn['asn_id'] == 'c0000'
+    assert asn['target'] == 't000'
+    assert asn['asn_pool'] == 'jw00000_00000000t000000_pool.csv'
+    assert len(asn['products']) == 1
+    assert asn['products'][0]['name'] == 'KEY'
+    members = [(member['expname'], member['exptype']) for member in asn['products'][0]['members']]
+    assert members == [(os.path.abspath('sci0_calints.fits'), 'science'),
+                       (os.path.abspath('sci1_calints.fits'), 'science'),
+                       (os.path.abspath('ref0_calints.fits'), 'psf'),
+                       (os.path.abspath('ref1_calints.fits'), 'psf')]
+    
+    # The association file has the same content.
+    asnpath = coron3pipeline.make_asn_file(Database, 'KEY', str(tmp_path))
+    assert asnpath == os.path.join(str(tmp_path), 'KEY_asn.json')
+    with open(asnpath) as f:
+        content = json.load(f)
+    assert content['products'][0]['name'] == 'KEY'
+    assert [(member['expname'], member['exptype']) for member in content['products'][0]['members']] == members
+    
+    # Concatenations without reference files cannot be associated.
+    Database.obs['KEY']['TYPE'][1] = 'SCI'
+    Database.obs['KEY']['TYPE'][3] = 'SCI'
+    try:
+        coron3pipeline.make_asn(Database, 'KEY')
+    except UserWarning as e:
+        assert 'has no reference files' in str(e)
+    else:
+        raise AssertionError('Concatenation without reference files was associated')
+
+def test_save_model_klmode0(tmp_path):
+    
+    # The number of KL modes must be written to the primary header of the
+    # i2d product only, like the previous implementation did after the run.
+    from jwst.datamodels import ImageModel
+    pipeline = coron3pipeline.Coron3Pipeline_spaceKLIP(output_dir=str(tmp_path))
+    pipeline.klip.truncate = 7
+    for suffix in ['i2d', 'psfsub']:
+        model = ImageModel(np.zeros((4, 5), dtype=np.float32))
+        model.meta.filename = 'KEY.fits'
+        output_paths = pipeline.save_model(model, suffix=suffix, force=True)
+        head = pyfits.getheader(output_paths[0] if isinstance(output_paths, list) else output_paths, 0)
+        if suffix == 'i2d':
+            assert head['KLMODE0'] == 7
+        else:
+            assert 'KLMODE0' not in head
@@ -0,0 +1,200 @@
+from __future__ import division
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+from astropy.table import Table
+from spaceKLIP import database
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def test_autosave_disabled_by_default(tmp_path):
+    
+    # The database is only saved automatically on request.
+    Database = database.Database(output_dir=str(tmp_path))
+    assert not Database.autosave
+
+def test_save_load_roundtrip(tmp_path):
+    
+    # Saving and loading the database must restore all of its content,
+    # including None cells of object columns and nan values.
+    Database = database.Database(output_dir=str(tmp_path))
+    Database.verbose = False
+    obs = Table(names=('TYPE', 'EXPSTART', 'CRPIX1', 'NINTS', 'FITSFILE', 'MASKFILE'),
+                dtype=('object', 'float', 'float', 'int', 'object', 'object'))
+    obs.add_row(('SCI', 59000.5, np.nan, 10, '/data/stage2/a_calints.fits', None))
+    obs.add_row(('REF', 59000.7, 160.5, 12, '/data/stage2/b_calints.fits', '/data/stage2/b_psfmask.fits'))
+    obs.add_row(('REF', 59000.9, 161.5, 12, '/data/stage2/c_calints.fits', 'NONE'))
+    Database.obs = {'KEY': obs}
+    Database.history = {'KEY': [(0, 'stage2', '/data/stage2/a_calints.fits', None),
+                                (1, 'stage2', '/data/stage2/b_calints.fits', '/data/stage2/b_psfmask.fits')]}
+    red = Table(names=('TYPE', 'KLMODES', 'FITSFILE', 'MASKFILE'),
+                dtype=('object', 'object', 'object', 'object'))
+    red.add_row(('PYKLIP', '1,2,5', '/data/klipsub/a-KLmodes-all.fits', None))
+    Database.red = {'KEY': red}
+    src = Table(names=('ID', 'RA', 'DEC'), dtype=('int', 'float', 'float'))
+    src.add_row((1, 0.5, -0.2))
+    Database.update_src('KEY', 1, src)
+    Database.save()
+    assert os.path.exists(os.path.join(str(tmp_path), 'database.fits'))
+    
+    # Load database into a new instance.
+    Loaded = database.Database(output_dir=str(tmp_path))
+    Loaded.verbose = False
+    Loaded.load()
+    assert list(Loaded.obs.keys()) == ['KEY']
+    assert Loaded.obs['KEY'].colnames == obs.colnames
+    for name in obs.colnames:
+        assert Loaded.obs['KEY'][name].dtype.kind == obs[name].dtype.kind
+        if obs[name].dtype == object:
+            assert list(Loaded.obs['KEY'][name]) == list(obs[name])
+        else:
+            np.testing.assert_array_equal(Loaded.obs['KEY'][name], obs[name])
+    assert Loaded.obs['KEY']['MASKFILE'][0] is None
+    assert Loaded.history == Database.history
+    assert Loaded.history['KEY'][0][3] is None
+    assert Loaded.red['KEY'].colnames == red.colnames
+    assert Loaded.red['KEY']['MASKFILE'][0] is None
+    assert Loaded.src['KEY'][0] is None
+    np.testing.assert_array_equal(Loaded.src['KEY'][1]['RA'], src['RA'])
+
+def test_read_headers(tmp_path, monkeypatch):
+    
+    # The header-only reader must return the same keywords as the FITS
+    # headers, and NAXIS3 instead of the data shape.
+    fitsfiles = []
+    for j, nints in enumerate([4, 1]):
+        fitsfiles += [os.path.join(str(tmp_path), 'file%.0f_calints.fits' % j)]
+        hdul = pyfits.HDUList([pyfits.PrimaryHDU()])
+        hdul[0].header['TELESCOP'] = 'JWST'
+        hdul[0].header['INSTRUME'] = 'NIRCAM'
+        hdul[0].header['EXPSTART'] = 59000.5 + j
+        hdul[0].header['IS_PSF'] = bool(j)
+        hdul[0].header['UNUSED'] = 'not read'
+        hdul.append(pyfits.ImageHDU(np.zeros((nints, 5, 6)) if nints > 1 else np.zeros((5, 6)), name='SCI'))
+        hdul['SCI'].header['BUNIT'] = 'MJy/sr'
+        hdul['SCI'].header['CRPIX1'] = 3.5
+        hdul.writeto(fitsfiles[-1])
+    heads = database.read_headers(fitsfiles[0])
+    assert heads['PRI'] == {'TELESCOP': 'JWST', 'INSTRUME': 'NIRCAM', 'EXPSTART': 59000.5, 'IS_PSF': False}
+    assert heads['SCI'] == {'BUNIT': 'MJy/sr', 'CRPIX1': 3.5, 'NAXIS': 3, 'NAXIS3': 4}
+    assert database.read_headers(fitsfiles[1])['SCI']['NAXIS'] == 2
+    
+    # The header index is reused for unchanged files only.
+    Database = database.Database(output_dir=str(tmp_path))
+    heads = Database._read_headers(fitsfiles)
+    assert heads[0]['PRI'] == database.read_headers(fitsfiles[0])['PRI']
+    assert os.path.exists(os.path.join(str(tmp_path), 'header_index.json'))
+    calls = []
+    read_headers = database.read_headers
+    monkeypatch.setattr(database, 'read_headers', lambda fitsfile: calls.append(fitsfile) or read_headers(fitsfile))
+    assert [head['SCI'] for head in Database._read_headers(fitsfiles)] == [head['SCI'] for head in heads]
+    assert calls == []
+    with pyfits.open(fitsfiles[1], mode='update') as hdul:
+        hdul['SCI'].header['BUNIT'] = 'DN/s'
+        hdul['SCI'].header['HISTORY'] = 'Changed the data unit so that the file size changes.' * 50
+    heads = Database._read_headers(fitsfiles)
+    assert calls == [fitsfiles[1]]
+    assert heads[1]['SCI']['BUNIT'] == 'DN/s'
+    
+    # The header index can be bypassed.
+    Database._read_headers(fitsfiles, use_cache=False)
+    assert calls == [fitsfiles[1]] + fitsfiles
+
+def make_s012_file(fitsfile,
+                   exp_type='NRC_CORON',
+                   coronmsk='MASKA335R',
+                   subarray='SUB320A335R'):
+    
+    # Make a NIRCam coronagraphy calints FITS file.
+    hdul = pyfits.HDUList([pyfits.PrimaryHDU()])
+    hdul[0].header['TELESCOP'] = 'JWST'
+    hdul[0].header['INSTRUME'] = 'NIRCAM'
+    hdul[0].header['DETECTOR'] = 'NRCALONG'
+    hdul[0].header['FILTER'] = 'F335M'
+    hdul[0].header['PUPIL'] = 'MASKRND'
+    hdul[0].header['CORONMSK'] = coronmsk
+    hdul[0].header['EXP_TYPE'] = exp_type
+    hdul[0].header['SUBARRAY'] = subarray
+    hdul[0].header['TARGPROP'] = 'TARGET'
+    hdul.append(pyfits.ImageHDU(np.zeros((2, 5, 6)), name='SCI'))
+    hdul['SCI'].header['BUNIT'] = 'MJy/sr'
+    hdul.writeto(fitsfile)
+    
+    pass
+
+def test_read_jwst_s012_data_ta(tmp_path):
+    
+    # TA files must be associated with the concatenation that has the same
+    # pupil mask and a subarray matching the TA subarray, like in the
+    # previous implementation which compared the concatenation names.
+    fitsfiles = {}
+    for name, kwargs in [('sci', {}),
+                         ('sci_ta', {'exp_type': 'NRC_TACQ', 'coronmsk': 'NONE', 'subarray': 'SUBFSA335R'}),
+                         ('sci_430', {'coronmsk': 'MASKA430R', 'subarray': 'SUB320A430R'}),
+                         ('ref', {}),
+                         ('ref_ta', {'exp_type': 'NRC_TACQ', 'coronmsk': 'NONE', 'subarray': 'SUBFSA335R'})]:
+        fitsfiles[name] = os.path.join(str(tmp_path), name + '_calints.fits')
+        make_s012_file(fitsfiles[name], **kwargs)
+    Database = database.Database(output_dir=str(tmp_path))
+    Database.verbose = False
+    Database.read_jwst_s012_data([fitsfiles['sci'], fitsfiles['sci_ta'], fitsfiles['sci_430']],
+                                 psflibpaths=[fitsfiles['ref'], fitsfiles['ref_ta']],
+                                 use_cache=False)
+    assert sorted(Database.obs.keys()) == ['JWST_NIRCAM_NRCALONG_F335M_MASKRND_MASKA335R_SUB320A335R',
+                                           'JWST_NIRCAM_NRCALONG_F335M_MASKRND_MASKA430R_SUB320A430R']
+    obs = Database.obs['JWST_NIRCAM_NRCALONG_F335M_MASKRND_MASKA335R_SUB320A335R']
+    types = dict(zip([os.path.basename(fitsfile) for fitsfile in obs['FITSFILE']], obs['TYPE']))
+    assert types == {'sci_calints.fits': 'SCI',
+                     'sci_ta_calints.fits': 'SCI_TA',
+                     'ref_calints.fits': 'REF',
+                     'ref_ta_calints.fits': 'REF_TA'}
+    assert list(Database.obs['JWST_NIRCAM_NRCALONG_F335M_MASKRND_MASKA430R_SUB320A430R']['TYPE']) == ['SCI']
+    assert list(obs['NINTS']) == [2, 2, 2, 2]
+    
+    # TA files without a matching concatenation cannot be associated.
+    fitsfile = os.path.join(str(tmp_path), 'other_ta_calints.fits')
+    make_s012_file(fitsfile, exp_type='NRC_TACQ', coronmsk='NONE', subarray='SUBFSA210R')
+    try:
+        Database.read_jwst_s012_data([fitsfiles['sci'], fitsfile], use_cache=False)
+    except UserWarning as e:
+        assert 'Could not associate TA files' in str(e)
+    else:
+        raise AssertionError('Unmatched TA file was associated')
+
+def test_update_obs(tmp_path):
+    
+    # The FITS file is not opened if the data unit is passed.
+    Database = database.Database(output_dir=str(tmp_path))
+    Database.obs = {'KEY': Table([['a_rateints.fits', 'b_rateints.fits'],
+                                  ['NONE', 'NONE'],
+                                  ['STAGE1', 'STAGE1'],
+                                  ['DN/s', 'DN/s']],
+                                 names=('FITSFILE', 'MASKFILE', 'DATAMODL', 'BUNIT'),
+                                 dtype=('object', 'object', 'object', 'object'))}
+    fitsfile = os.path.join(str(tmp_path), 'stage2', 'a_calints.fits')
+    Database.update_obs('KEY', 0, fitsfile, bunit='MJy/sr')
+    assert not os.path.exists(fitsfile)
+    assert list(Database.obs['KEY'][0]) == [fitsfile, 'NONE', 'STAGE2', 'MJy/sr']
+    assert Database.history['KEY'] == [(0, 'stage2', fitsfile, 'NONE')]
+    
+    # Otherwise, the data unit is read from the SCI header of the FITS file,
+    # like in the previous implementation.
+    fitsfile = os.path.join(str(tmp_path), 'stage2', 'b_calints.fits')
+    os.makedirs(os.path.dirname(fitsfile))
+    hdul = pyfits.HDUList([pyfits.PrimaryHDU(), pyfits.ImageHDU(np.zeros((2, 5, 6)), name='SCI')])
+    hdul['SCI'].header['BUNIT'] = 'MJy/sr'
+    hdul.writeto(fitsfile)
+    Database.update_obs('KEY', 1, fitsfile, maskfile='b_psfmask.fits')
+    assert Database.obs['KEY']['BUNIT'][1] == pyfits.getheader(fitsfile, 'SCI')['BUNIT']
+    assert Database.history['KEY'][1] == (1, 'stage2', fitsfile, 'b_psfmask.fits')
@@ -0,0 +1,225 @@
+from __future__ import division
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import pickle
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+from astropy.table import Table
+from spaceKLIP import database, imagetools
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def make_database(output_dir,
+                  nfitsfiles=3):
+    
+    # Make a spaceKLIP database with a single concatenation.
+    Database = database.Database(output_dir=str(output_dir))
+    Database.obs = {'KEY': Table([['file%.0f.fits' % j for j in range(nfitsfiles)],
+                                  ['NONE'] * nfitsfiles,
+                                  ['SCI'] + ['REF'] * (nfitsfiles - 1)],
+                                 names=('FITSFILE', 'MASKFILE', 'TYPE'),
+                                 dtype=('object', 'object', 'object'))}
+    
+    return Database
+
+def test_file_tools_single_observation(tmp_path):
+    
+    # The worker processes must only receive the observation to be processed.
+    Database = make_database(tmp_path, nfitsfiles=100)
+    tools = imagetools.ImageTools(Database, n_jobs=2)
+    tools._resident_obs = {'file7.fits': {'data': np.zeros(1)}, 'file8.fits': {'data': np.zeros(10**6)}}
+    sub = tools._file_tools('KEY', 7)
+    assert list(sub.database.obs.keys()) == ['KEY']
+    assert len(sub.database.obs['KEY']) == 1
+    assert sub.database.obs['KEY']['FITSFILE'][0] == 'file7.fits'
+    assert list(sub._resident_obs.keys()) == ['file7.fits']
+    assert len(pickle.dumps(sub)) < len(pickle.dumps(tools)) / 10.
+    
+    # The original database must not be modified.
+    assert len(Database.obs['KEY']) == 100
+    assert len(tools._resident_obs) == 2
+
+def test_bpclean_progress_is_logged(capsys, caplog):
+    
+    # The bpclean progress must not be written to stdout.
+    np.random.seed(0)
+    data = np.random.normal(size=(2, 32, 32))
+    data[0, 10, 10] = 100.
+    erro = np.ones_like(data)
+    pxdq = np.zeros(data.shape, dtype=bool)
+    tools = imagetools.ImageTools(make_database(os.getcwd()))
+    with caplog.at_level('INFO', logger='spaceKLIP'):
+        tools.find_bad_pixels_bpclean(data, erro, pxdq, np.zeros(data.shape, dtype=bool), {})
+    assert capsys.readouterr().out == ''
+    assert any('iteration' in record.getMessage() for record in caplog.records)
+    assert pxdq[0, 10, 10]
+
+def test_step_cache(tmp_path, caplog):
+    
+    # The step cache is opt-in.
+    Database = make_database(tmp_path, nfitsfiles=1)
+    assert imagetools.ImageTools(Database)._load_cache(str(tmp_path)) is None
+    
+    # Make input and output files.
+    fitsfile = os.path.join(str(tmp_path), 'file0.fits')
+    outfile = os.path.join(str(tmp_path), 'out', 'file0.fits')
+    os.makedirs(os.path.dirname(outfile))
+    for path in [fitsfile, outfile]:
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 2880)
+    Database.obs['KEY']['FITSFILE'][0] = fitsfile
+    tools = imagetools.ImageTools(Database, use_cache=True)
+    output_dir = os.path.dirname(outfile)
+    
+    # Store a data product in the step cache and look it up again.
+    cache = tools._load_cache(output_dir)
+    ckey, update = tools._lookup_cache(cache, '_crop_frames_file', 'KEY', 0, output_dir, (1,))
+    assert update is None
+    tools._store_cache(cache, ckey, {'fitsfile': outfile, 'maskfile': 'NONE', 'bunit': 'MJy/sr'})
+    tools._save_cache(cache, output_dir)
+    cache = tools._load_cache(output_dir)
+    with caplog.at_level('INFO', logger='spaceKLIP'):
+        ckey_new, update = tools._lookup_cache(cache, '_crop_frames_file', 'KEY', 0, output_dir, (1,))
+    assert ckey_new == ckey
+    assert update == {'fitsfile': outfile, 'maskfile': 'NONE', 'bunit': 'MJy/sr'}
+    assert any('skipping crop_frames' in record.getMessage() for record in caplog.records)
+    
+    # Different parameters or a modified input file change the cache key.
+    ckey_new, update = tools._lookup_cache(cache, '_crop_frames_file', 'KEY', 0, output_dir, (2,))
+    assert ckey_new != ckey and update is None
+    os.utime(fitsfile, ns=(0, 10**9))
+    ckey_new, update = tools._lookup_cache(cache, '_crop_frames_file', 'KEY', 0, output_dir, (1,))
+    assert ckey_new != ckey and update is None
+    
+    # A modified data product is not used.
+    os.utime(fitsfile, ns=(0, 10**9))
+    cache[ckey_new] = cache.pop(ckey)
+    ckey, update = tools._lookup_cache(cache, '_crop_frames_file', 'KEY', 0, output_dir, (1,))
+    assert update is not None
+    os.utime(outfile, ns=(0, 2 * 10**9))
+    ckey, update = tools._lookup_cache(cache, '_crop_frames_file', 'KEY', 0, output_dir, (1,))
+    assert update is None
+    
+    # The full content of large arrays is part of the cache key.
+    bpmap = np.zeros((320, 320))
+    ckey_map, update_bp = tools._lookup_cache(cache, '_fix_bad_pixels_file', 'KEY', 0, output_dir, ('bpclean+custom', {'custom': {'KEY': bpmap}}))
+    bpmap[160, 160] = 1.
+    ckey_bp, update_bp = tools._lookup_cache(cache, '_fix_bad_pixels_file', 'KEY', 0, output_dir, ('bpclean+custom', {'custom': {'KEY': bpmap}}))
+    assert ckey_bp != ckey_map
+    ckey_bp, update_bp = tools._lookup_cache(cache, '_fix_bad_pixels_file', 'KEY', 0, output_dir, ('bpclean+custom', {'custom': {'KEY': bpmap.astype(np.float32)}}))
+    assert ckey_bp != ckey_map
+
+def test_fix_bad_pixels_timemed():
+    
+    # The time median correction must match the previous implementation
+    # which stacked nints copies of the median images.
+    rng = np.random.default_rng(9)
+    data = rng.normal(size=(6, 16, 16))
+    erro = rng.uniform(0.5, 1., size=data.shape)
+    pxdq = rng.random(data.shape) < 0.1
+    pxdq[:, 3, 4] = True
+    data_ref, erro_ref, pxdq_ref = data.copy(), erro.copy(), pxdq.copy()
+    ww = pxdq_ref != 0
+    ww_all_bad = np.array([np.sum(ww, axis=0) == ww.shape[0]] * ww.shape[0])
+    ww_not_all_bad = ww & np.logical_not(ww_all_bad)
+    data_ref[ww_not_all_bad] = np.nan
+    data_ref[ww_not_all_bad] = np.array([np.nanmedian(data_ref, axis=0)] * data_ref.shape[0])[ww_not_all_bad]
+    erro_ref[ww_not_all_bad] = np.nan
+    erro_ref[ww_not_all_bad] = np.array([np.nanmedian(erro_ref, axis=0)] * erro_ref.shape[0])[ww_not_all_bad]
+    pxdq_ref[ww_not_all_bad] = 0
+    tools = imagetools.ImageTools(make_database(os.getcwd()))
+    tools.fix_bad_pixels_timemed(data, erro, pxdq, {'maxmem': 1})
+    np.testing.assert_array_equal(data, data_ref)
+    np.testing.assert_array_equal(erro, erro_ref)
+    np.testing.assert_array_equal(pxdq, pxdq_ref)
+
+def make_calints_database(output_dir,
+                          nfitsfiles=2):
+    
+    # Make a spaceKLIP database of calints FITS files and PSF masks.
+    rng = np.random.default_rng(11)
+    indir = os.path.join(str(output_dir), 'input')
+    os.makedirs(indir)
+    fitsfiles = []
+    maskfiles = []
+    for j in range(nfitsfiles):
+        fitsfiles += [os.path.join(indir, 'file%.0f_calints.fits' % j)]
+        hdul = pyfits.HDUList([pyfits.PrimaryHDU()])
+        hdul.append(pyfits.ImageHDU(rng.normal(size=(3, 12, 14)), name='SCI'))
+        hdul['SCI'].header['BUNIT'] = 'MJy/sr'
+        hdul.append(pyfits.ImageHDU(rng.uniform(size=(3, 12, 14)), name='ERR'))
+        hdul.append(pyfits.ImageHDU(rng.integers(0, 2, size=(3, 12, 14)).astype(np.uint32), name='DQ'))
+        hdul.writeto(fitsfiles[-1])
+        maskfiles += [os.path.join(indir, 'file%.0f_psfmask.fits' % j)]
+        pyfits.HDUList([pyfits.PrimaryHDU(), pyfits.ImageHDU(rng.uniform(size=(12, 14)), name='SCI')]).writeto(maskfiles[-1])
+    Database = database.Database(output_dir=str(output_dir))
+    Database.verbose = False
+    Database.obs = {'KEY': Table([fitsfiles,
+                                  maskfiles,
+                                  ['SCI'] + ['REF'] * (nfitsfiles - 1),
+                                  ['STAGE2'] * nfitsfiles,
+                                  ['MJy/sr'] * nfitsfiles,
+                                  [6.5] * nfitsfiles,
+                                  [5.5] * nfitsfiles],
+                                 names=('FITSFILE', 'MASKFILE', 'TYPE', 'DATAMODL', 'BUNIT', 'CRPIX1', 'CRPIX2'),
+                                 dtype=('object', 'object', 'object', 'object', 'object', 'float', 'float'))}
+    
+    return Database
+
+def test_inmemory_session(tmp_path):
+    
+    # A chain of steps run in the in-memory session mode must produce the
+    # same database and FITS files as the same chain with a FITS file round
+    # trip per step.
+    databases = []
+    for inmemory in [False, True]:
+        Database = make_calints_database(os.path.join(str(tmp_path), str(inmemory)))
+        tools = imagetools.ImageTools(Database, inmemory=inmemory)
+        tools.crop_frames(npix=[1, 2, 1, 1])
+        tools.pad_frames(npix=[2, 1, 0, 3], cval=0.)
+        if inmemory:
+            assert not os.path.exists(Database.obs['KEY']['FITSFILE'][0])
+            tools.checkpoint(release=True)
+        databases += [Database]
+    for j in range(len(databases[0].obs['KEY'])):
+        files = []
+        for Database in databases:
+            assert os.path.relpath(Database.obs['KEY']['FITSFILE'][j], Database.output_dir) == os.path.join('padded', 'file%.0f_calints.fits' % j)
+            files += [(Database.obs['KEY']['FITSFILE'][j], Database.obs['KEY']['MASKFILE'][j])]
+        for name in ['CRPIX1', 'CRPIX2', 'BUNIT', 'DATAMODL']:
+            assert databases[1].obs['KEY'][name][j] == databases[0].obs['KEY'][name][j]
+        assert [item[1] for item in databases[1].history['KEY']] == [item[1] for item in databases[0].history['KEY']]
+        for ext in ['SCI', 'ERR', 'DQ']:
+            np.testing.assert_array_equal(pyfits.getdata(files[1][0], ext), pyfits.getdata(files[0][0], ext))
+        assert pyfits.getheader(files[1][0], 'SCI') == pyfits.getheader(files[0][0], 'SCI')
+        np.testing.assert_array_equal(pyfits.getdata(files[1][1], 'SCI'), pyfits.getdata(files[0][1], 'SCI'))
+
+def test_parallel_steps(tmp_path):
+    
+    # Per-file steps spread over worker processes must produce the same
+    # database and FITS files as the serial run.
+    databases = []
+    for n_jobs in [1, 2]:
+        Database = make_calints_database(os.path.join(str(tmp_path), str(n_jobs)), nfitsfiles=3)
+        tools = imagetools.ImageTools(Database, n_jobs=n_jobs)
+        tools.crop_frames(npix=[1, 2, 1, 1])
+        tools.pad_frames(npix=[2, 1, 0, 3], cval=0.)
+        databases += [Database]
+    for j in range(len(databases[0].obs['KEY'])):
+        for name in ['CRPIX1', 'CRPIX2', 'BUNIT', 'DATAMODL']:
+            assert databases[1].obs['KEY'][name][j] == databases[0].obs['KEY'][name][j]
+        files = [Database.obs['KEY']['FITSFILE'][j] for Database in databases]
+        assert os.path.relpath(files[1], databases[1].output_dir) == os.path.relpath(files[0], databases[0].output_dir)
+        for ext in ['SCI', 'ERR', 'DQ']:
+            np.testing.assert_array_equal(pyfits.getdata(files[1], ext), pyfits.getdata(files[0], ext))
+    assert [item[:2] for item in databases[1].history['KEY']] == [item[:2] for item in databases[0].history['KEY']]
@@ -0,0 +1,163 @@
+from __future__ import division
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+
+import numpy as np
+
+from collections import OrderedDict
+from spaceKLIP import psf
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def test_psf_cache_disabled_by_default(monkeypatch):
+    
+    # Without a configured cache directory, nothing is written to disk.
+    monkeypatch.delenv('SPACEKLIP_PSF_CACHE', raising=False)
+    cache = psf.PSFCache()
+    assert not cache.enabled
+    key = cache.key(kind='off', filter='F335M')
+    cache.put(key, np.ones((3, 3)))
+    assert cache.get(key) is None
+
+def test_psf_cache_roundtrip(tmp_path, monkeypatch):
+    
+    # A configured cache directory stores and evicts model PSFs.
+    monkeypatch.setenv('SPACEKLIP_PSF_CACHE', str(tmp_path))
+    cache = psf.PSFCache(max_size=3 * (128 + 8 * 100))
+    assert cache.enabled
+    keys = [cache.key(kind='off', filter=filt) for filt in ['F250M', 'F300M', 'F335M', 'F444W']]
+    assert len(set(keys)) == 4
+    for i, key in enumerate(keys):
+        cache.put(key, np.full((10, 10), float(i)))
+        os.utime(os.path.join(str(tmp_path), key + '.npy'), (i, i))
+    assert cache.get(keys[0]) is None
+    np.testing.assert_array_equal(cache.get(keys[3]), np.full((10, 10), 3.))
+    cache.clear()
+    assert cache.get(keys[3]) is None
+
+def test_psf_cache_key_uses_opd_file(monkeypatch):
+    
+    # Dates which resolve to the same OPD file share their cache keys.
+    opd_files = {'2022-07-01T00:00:00': 'R2022070101-NRCA3_FP1-1.fits',
+                 '2022-07-01T12:00:00': 'R2022070101-NRCA3_FP1-1.fits',
+                 '2022-07-20T00:00:00': 'R2022072001-NRCA3_FP1-1.fits'}
+    monkeypatch.setattr(psf, 'get_opd_at_time', lambda date, choice='closest', verbose=False: opd_files[date])
+    psf.get_opd_file.cache_clear()
+    keys = [psf.psf_cache.key(kind='off', opd=psf.get_opd_file(date)) for date in opd_files.keys()]
+    psf.get_opd_file.cache_clear()
+    assert keys[0] == keys[1]
+    assert keys[0] != keys[2]
+    assert psf.get_opd_file(None) is None
+
+def test_psf_grid_keyed_on_spectrum(monkeypatch):
+    
+    # Each spectrum gets its own field-dependent PSF grid.
+    from types import SimpleNamespace
+    spectra = {'A': SimpleNamespace(wave=np.array([1., 2.]), flux=np.array([1., 1.])),
+               'B': SimpleNamespace(wave=np.array([1., 2.]), flux=np.array([1., 2.]))}
+    values = {None: 0., psf.hash_spectrum(spectra['A']): 1., psf.hash_spectrum(spectra['B']): 2.}
+    def gen_psf_idl(coord_vals, coord_frame='idl', quick=True, sp=None, return_oversample=False):
+        return np.full((len(coord_vals[0]), 5, 5), values[psf.hash_spectrum(sp)])
+    model = psf.JWST_PSF.__new__(psf.JWST_PSF)
+    model.inst_on = SimpleNamespace(image_mask='MASK335R', oversample=1, fov_pix=5)
+    model._psf_grids = {}
+    monkeypatch.setattr(model, 'gen_psf_idl', gen_psf_idl)
+    for sp in [None, spectra['A'], spectra['B'], None]:
+        psfs = model._interp_psf_grid(([0.5, 1.2], [0.1, -0.3]), 'idl', sp=sp)
+        assert psfs.shape == (2, 5, 5)
+        np.testing.assert_allclose(psfs, values[psf.hash_spectrum(sp)])
+    assert len(model._psf_grids) == 3
+
+def make_model(monkeypatch):
+    
+    # Make a JWST_PSF with synthetic on-axis and off-axis PSFs and a radial
+    # mask transmission.
+    from types import SimpleNamespace
+    yy, xx = np.indices((32, 32)) - 15.5
+    model = psf.JWST_PSF.__new__(psf.JWST_PSF)
+    model.inst_on = SimpleNamespace(image_mask='MASK335R', oversample=2, fov_pix=16,
+                                    siaf_ap=SimpleNamespace(XSciScale=0.063, YSciScale=0.063, V3IdlYAngle=-0.5))
+    model.psf_on = 0.1 * np.exp(-(xx**2 + yy**2) / (2. * 4.**2))
+    model.psf_off = np.exp(-(xx**2 + yy**2) / (2. * 2.**2))
+    model._bar_interp = None
+    model._psf_grids = {}
+    def transmission_map(inst, coord_vals, coord_frame):
+        xidl, yidl = np.broadcast_arrays(*coord_vals)
+        return np.clip(np.hypot(xidl, yidl), 0., 1.), xidl, yidl
+    monkeypatch.setattr(psf, '_transmission_map', transmission_map)
+    
+    return model
+
+def test_gen_psf_batched(monkeypatch):
+    
+    # PSFs generated for several positions at once must match the PSFs
+    # generated for each position on its own.
+    model = make_model(monkeypatch)
+    rng = np.random.default_rng(5)
+    xidl = rng.uniform(-1., 1., 7)
+    yidl = rng.uniform(-1., 1., 7)
+    PA_V3 = np.array([10., 10., 100., 100., 100., 250., 250.])
+    for return_oversample in [True, False]:
+        for normalize in [False, True]:
+            kwargs = {'return_oversample': return_oversample, 'normalize': normalize}
+            psfs = model.gen_psf((xidl, yidl), PA_V3=PA_V3, **kwargs)
+            psfs_chunked = model.gen_psf((xidl, yidl), PA_V3=PA_V3, maxmem=1, **kwargs)
+            assert psfs.shape == (7,) + model.gen_psf((xidl[0], yidl[0]), PA_V3=PA_V3[0], **kwargs).shape
+            np.testing.assert_allclose(psfs_chunked, psfs, rtol=0., atol=1e-12)
+            for i in range(len(xidl)):
+                psf_single = model.gen_psf((xidl[i], yidl[i]), PA_V3=PA_V3[i], **kwargs)
+                np.testing.assert_allclose(psfs[i], psf_single, rtol=0., atol=1e-10 * np.max(np.abs(psf_single)))
+
+class PSFInstrument():
+    
+    # Picklable stand-in for a webbpsf_ext instrument object.
+    def calc_psf(self, coord_vals=(0., 0.), **kwargs):
+        return np.full((4, 4), coord_vals[0] + 10. * coord_vals[1])
+    
+    def calc_psf_from_coeff(self, coord_vals=(0., 0.), **kwargs):
+        return -self.calc_psf(coord_vals=coord_vals, **kwargs)
+
+def test_calc_psfs_parallel():
+    
+    # PSFs computed in worker processes must match the serial calculation
+    # and be returned in the order of the requested positions.
+    inst = PSFInstrument()
+    kwargs_list = [{'coord_vals': (0.1 * i, -0.2 * i)} for i in range(5)]
+    for use_coeff in [False, True]:
+        psfs = psf.calc_psfs(inst, use_coeff, kwargs_list, n_jobs=1)
+        psfs_parallel = psf.calc_psfs(inst, use_coeff, kwargs_list, n_jobs=2)
+        for i, kwargs in enumerate(kwargs_list):
+            psf_single = inst.calc_psf_from_coeff(**kwargs) if use_coeff else inst.calc_psf(**kwargs)
+            np.testing.assert_array_equal(psfs[i], psf_single)
+            np.testing.assert_array_equal(psfs_parallel[i], psf_single)
+    assert psf._worker_inst is None
+
+def test_jwst_psf_get(monkeypatch):
+    
+    # Instances are memoised by their constructor arguments and the least
+    # recently used instance is evicted first.
+    calls = []
+    def __init__(self, inst, filt, image_mask, fov_pix, oversample=2, sp=None, use_coeff=True, date=None, n_jobs=None, **kwargs):
+        calls.append((inst, filt, image_mask, fov_pix, oversample))
+    monkeypatch.setattr(psf.JWST_PSF, '__init__', __init__)
+    monkeypatch.setattr(psf.JWST_PSF, '_instances', OrderedDict())
+    monkeypatch.setattr(psf.JWST_PSF, 'max_instances', 2)
+    model1 = psf.JWST_PSF.get('NIRCam', 'F335M', 'MASK335R', 65)
+    assert psf.JWST_PSF.get('NIRCAM', 'F335M', 'MASK335R', 65) is model1
+    assert psf.JWST_PSF.get('NIRCam', 'F335M', 'MASK335R', 65, n_jobs=4) is model1
+    model2 = psf.JWST_PSF.get('NIRCam', 'F335M', 'MASK335R', 65, oversample=4)
+    assert model2 is not model1
+    assert len(calls) == 2
+    psf.JWST_PSF.get('NIRCam', 'F335M', 'MASK335R', 65)
+    psf.JWST_PSF.get('NIRCam', 'F444W', 'MASK335R', 65)
+    assert psf.JWST_PSF.get('NIRCam', 'F335M', 'MASK335R', 65) is model1
+    assert psf.JWST_PSF.get('NIRCam', 'F335M', 'MASK335R', 65, oversample=4) is not model2
+    assert len(calls) == 4
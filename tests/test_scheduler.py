@@ -0,0 +1,120 @@
+from __future__ import division
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import time
+
+import pytest
+
+from astropy.table import Table
+from spaceKLIP import database, scheduler
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def make_database(output_dir):
+    
+    # Make a spaceKLIP database with two concatenations.
+    Database = database.Database(output_dir=str(output_dir))
+    Database.verbose = False
+    for key, nfitsfiles in [('KEY1', 3), ('KEY2', 2)]:
+        Database.obs[key] = Table([[key + '_%.0f.fits' % j for j in range(nfitsfiles)],
+                                   ['NONE'] * nfitsfiles],
+                                  names=('FITSFILE', 'MASKFILE'),
+                                  dtype=('object', 'object'))
+        Database.history[key] = [(j, 'INPUT', Database.obs[key]['FITSFILE'][j], 'NONE') for j in range(nfitsfiles)]
+    
+    return Database
+
+def test_add():
+    
+    # Only per-file tasks, public ImageTools routines, and functions are
+    # known tasks.
+    Scheduler = scheduler.Scheduler(None)
+    Scheduler.add('coron1')
+    Scheduler.add('subtract_median', subdir='medsub')
+    Scheduler.add('align_frames')
+    Scheduler.add(print)
+    for task in ['unknown', '_file_tools', 'database', 'n_jobs']:
+        with pytest.raises(UserWarning):
+            Scheduler.add(task)
+    with pytest.raises(UserWarning):
+        Scheduler.add(1)
+    assert [task for task, kwargs in Scheduler.tasks] == ['coron1', 'subtract_median', 'align_frames', print]
+
+def test_run_stages(tmp_path, monkeypatch):
+    
+    # Consecutive per-file tasks are streamed together and all other tasks
+    # are barriers.
+    stages = []
+    monkeypatch.setattr(scheduler.Scheduler, '_run_stream', lambda self, tasks: stages.append([task for task, kwargs in tasks]))
+    def barrier(database, name):
+        stages.append(name)
+    Scheduler = scheduler.Scheduler(make_database(tmp_path))
+    Scheduler.add('coron1')
+    Scheduler.add('coron2')
+    Scheduler.add(barrier, name='barrier1')
+    Scheduler.add('crop_frames')
+    Scheduler.add(barrier, name='barrier2')
+    Scheduler.add(barrier, name='barrier3')
+    Scheduler.add('pad_frames')
+    Scheduler.add('blur_frames')
+    Scheduler.run()
+    assert stages == [['coron1', 'coron2'], 'barrier1', ['crop_frames'], 'barrier2', 'barrier3', ['pad_frames', 'blur_frames']]
+
+def test_run_stream(tmp_path, monkeypatch):
+    
+    # Each exposure is run on a single exposure database and its provenance
+    # is recorded at its index in the spaceKLIP database.
+    def run_exposure(sub, key, tasks):
+        assert list(sub.obs.keys()) == [key] and len(sub.obs[key]) == 1
+        assert not sub.autosave
+        fitsfile = sub.obs[key]['FITSFILE'][0].replace('.fits', '_medsub.fits')
+        sub.obs[key]['FITSFILE'][0] = fitsfile
+        sub.history.setdefault(key, []).append((0, 'subtract_median', fitsfile, 'NONE'))
+        return sub.obs[key], sub.history[key]
+    monkeypatch.setattr(scheduler, '_run_exposure', run_exposure)
+    Database = make_database(tmp_path)
+    Database.autosave = True
+    nsaves = []
+    monkeypatch.setattr(Database, 'save', lambda path=None: nsaves.append(path))
+    Scheduler = scheduler.Scheduler(Database)
+    Scheduler._run_stream([('subtract_median', {})])
+    
+    # The database is saved once per stage.
+    assert len(nsaves) == 1
+    for key, nfitsfiles in [('KEY1', 3), ('KEY2', 2)]:
+        assert list(Database.obs[key]['FITSFILE']) == [key + '_%.0f_medsub.fits' % j for j in range(nfitsfiles)]
+        assert Database.history[key][nfitsfiles:] == [(j, 'subtract_median', key + '_%.0f_medsub.fits' % j, 'NONE') for j in range(nfitsfiles)]
+
+def run_exposure_delayed(sub, key, tasks):
+    
+    # Record the provenance at the single exposure index, with the worker
+    # process ID in place of the PSF mask. The first exposure finishes last.
+    fitsfile = sub.obs[key]['FITSFILE'][0]
+    if fitsfile.endswith('_0.fits'):
+        time.sleep(0.5)
+    sub.obs[key]['FITSFILE'][0] = fitsfile.replace('.fits', '_medsub.fits')
+    sub.history.setdefault(key, []).append((0, 'subtract_median', sub.obs[key]['FITSFILE'][0], str(os.getpid())))
+    return sub.obs[key], sub.history[key]
+
+def test_run_stream_parallel(tmp_path, monkeypatch):
+    
+    # Exposures which finish out of order must be recorded at their index in
+    # the spaceKLIP database.
+    monkeypatch.setattr(scheduler, '_run_exposure', run_exposure_delayed)
+    Database = make_database(tmp_path)
+    Scheduler = scheduler.Scheduler(Database, n_jobs=2)
+    Scheduler._run_stream([('subtract_median', {})])
+    for key, nfitsfiles in [('KEY1', 3), ('KEY2', 2)]:
+        assert list(Database.obs[key]['FITSFILE']) == [key + '_%.0f_medsub.fits' % j for j in range(nfitsfiles)]
+        history = Database.history[key][nfitsfiles:]
+        assert sorted(item[:3] for item in history) == [(j, 'subtract_median', key + '_%.0f_medsub.fits' % j) for j in range(nfitsfiles)]
+        assert all(item[3] != str(os.getpid()) for item in history)
+    assert [item[0] for item in Database.history['KEY1'][3:]] != [0, 1, 2]
@@ -0,0 +1,285 @@
+from __future__ import division
+
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+
+import os
+import warnings
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+from spaceKLIP import utils as ut
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def neighbor_median_roll(cube,
+                         shift_x,
+                         shift_y):
+    
+    # Previous implementation which rolled edge-padded copies of the frames.
+    pad_left = np.abs(np.min(shift_x))
+    pad_right = np.abs(np.max(shift_x))
+    right = None if pad_right == 0 else -pad_right
+    pad_bottom = np.abs(np.min(shift_y))
+    pad_top = np.abs(np.max(shift_y))
+    top = None if pad_top == 0 else -pad_top
+    pad_vals = ((0, 0), (pad_bottom, pad_top), (pad_left, pad_right))
+    pad_data = np.pad(cube, pad_vals, mode='edge')
+    data_arr = []
+    for ix in shift_x:
+        for iy in shift_y:
+            if ix != 0 or iy != 0:
+                data_arr += [np.roll(pad_data, (iy, ix), axis=(1, 2))]
+    data_arr = np.array(data_arr)[:, :, pad_bottom:top, pad_left:right]
+    
+    return np.nanmedian(data_arr, axis=0), np.nanstd(data_arr, axis=0)
+
+def neighbor_median_clip(cube,
+                         shift_x,
+                         shift_y):
+    
+    # Reference implementation which takes the neighbors outside of the
+    # frames from the nearest edge pixel.
+    ny, nx = cube.shape[1:]
+    yy, xx = np.indices((ny, nx))
+    data_arr = []
+    for ix in shift_x:
+        for iy in shift_y:
+            if ix != 0 or iy != 0:
+                data_arr += [cube[:, np.clip(yy - iy, 0, ny - 1), np.clip(xx - ix, 0, nx - 1)]]
+    data_arr = np.array(data_arr)
+    
+    return np.nanmedian(data_arr, axis=0), np.nanstd(data_arr, axis=0)
+
+def make_cube(seed=0):
+    
+    # Make a cube of noise frames with some bad pixels.
+    rng = np.random.default_rng(seed)
+    cube = rng.normal(size=(3, 17, 23))
+    cube[rng.random(cube.shape) < 0.1] = np.nan
+    
+    return cube
+
+def test_neighbor_median_symmetric():
+    
+    # Symmetric footprints must match the previous implementation.
+    cube = make_cube()
+    for shift_x, shift_y in [([-1, 0, 1], [-1, 0, 1]), ([-2, -1, 0, 1, 2], [0]), ([-2, 0, 2], [-1, 0, 1])]:
+        med, std = ut.neighbor_median(cube, shift_x, shift_y, return_std=True)
+        med_ref, std_ref = neighbor_median_roll(cube, shift_x, shift_y)
+        np.testing.assert_array_equal(med, med_ref)
+        np.testing.assert_allclose(std, std_ref, rtol=1e-12)
+
+def test_neighbor_median_asymmetric():
+    
+    # Asymmetric footprints take the neighbors outside of the frames from the
+    # nearest edge pixel.
+    cube = make_cube(1)
+    for shift_x, shift_y in [([-1, 0, 2], [0, 1]), ([0, 1, 2], [-2, 0])]:
+        med, std = ut.neighbor_median(cube, shift_x, shift_y, return_std=True)
+        med_ref, std_ref = neighbor_median_clip(cube, shift_x, shift_y)
+        np.testing.assert_array_equal(med, med_ref)
+        np.testing.assert_allclose(std, std_ref, rtol=1e-12)
+        
+        # Away from the frame edges, they match the previous implementation.
+        med_roll, std_roll = neighbor_median_roll(cube, shift_x, shift_y)
+        np.testing.assert_array_equal(med[:, 2:-2, 2:-2], med_roll[:, 2:-2, 2:-2])
+
+def test_neighbor_median_index():
+    
+    # The median of selected pixels must match the median of all pixels.
+    cube = make_cube(2)
+    index = np.nonzero(np.isnan(cube))
+    med = ut.neighbor_median(cube, [-1, 0, 1], [-1, 0, 1])
+    np.testing.assert_array_equal(ut.neighbor_median(cube, [-1, 0, 1], [-1, 0, 1], index=index), med[index])
+
+def test_imshift_cube():
+    
+    # The batched shifts must match the frame-by-frame shifts, including the
+    # padding of each frame by its own shift.
+    rng = np.random.default_rng(3)
+    for ny, nx in [(32, 32), (31, 40), (25, 17)]:
+        cube = rng.normal(size=(5, ny, nx))
+        shifts = rng.uniform(-7., 7., size=(5, 2))
+        shifts[1] = [0.3, -0.2]
+        for pad in [False, True]:
+            for cval in [0., np.nan]:
+                if not pad and cval != 0.:
+                    continue
+                cbsft = ut.imshift_cube(cube, shifts, pad=pad, cval=cval)
+                for i in range(cube.shape[0]):
+                    imsft = ut.imshift(cube[i], shifts[i], pad=pad, cval=cval)
+                    np.testing.assert_allclose(cbsft[i], imsft, rtol=0., atol=1e-10)
+    
+    # Leading axes share the same shifts.
+    stack = np.array([cube, 2. * cube])
+    cbsft = ut.imshift_cube(stack, shifts, pad=True)
+    np.testing.assert_allclose(cbsft[1], 2. * ut.imshift_cube(cube, shifts, pad=True), rtol=0., atol=1e-10)
+
+def test_alignfast():
+    
+    # The batched alignment must find the same shifts and scaling factors as
+    # the frame-by-frame least squares fit of the alignlsq routine.
+    from scipy.optimize import leastsq
+    rng = np.random.default_rng(4)
+    yy, xx = np.indices((48, 48)) - 24.
+    ref_image = np.exp(-(xx**2 + yy**2) / (2. * 2.5**2))
+    nints = 6
+    truth = np.zeros((nints, 3))
+    truth[:, :2] = rng.uniform(-1.5, 1.5, size=(nints, 2))
+    truth[:, 2] = rng.uniform(0.9, 1.1, size=nints)
+    cube = np.array([ut.imshift(ref_image, -truth[i, :2]) / truth[i, 2] for i in range(nints)])
+    cube += rng.normal(scale=1e-3, size=cube.shape)
+    for mask in [None, np.exp(-(xx**2 + yy**2) / (2. * 10.**2))]:
+        shifts = ut.alignfast(cube, ref_image, mask=mask)
+        for i in range(nints):
+            p0 = np.array([np.round(truth[i, 0]), np.round(truth[i, 1]), 1.])
+            pp = leastsq(ut.alignlsq, p0, args=(cube[i], ref_image, mask), xtol=1e-12, ftol=1e-12)[0]
+            np.testing.assert_allclose(shifts[i], pp, rtol=0., atol=1e-5)
+            np.testing.assert_allclose(shifts[i], truth[i], rtol=0., atol=1e-2)
+
+def test_temporal_median():
+    
+    # The chunked time median must match np.nanmedian, including pixels
+    # which are nan in all frames.
+    rng = np.random.default_rng(5)
+    for shape, dtype in [((7, 13, 11), np.float64), ((8, 13, 11), np.float32), ((4, 3, 9, 10), np.float64)]:
+        cube = rng.normal(size=shape).astype(dtype)
+        cube[rng.random(shape) < 0.3] = np.nan
+        cube[:, 0, 0] = np.nan
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            med_ref = np.nanmedian(cube, axis=0)
+        for maxmem in [2**30, 1]:
+            med = ut.temporal_median(cube, maxmem=maxmem)
+            assert med.shape == cube.shape[1:]
+            np.testing.assert_allclose(med, med_ref, rtol=1e-6 if dtype == np.float32 else 0., atol=0.)
+        
+        # Skipped pixels are nan.
+        pixmask = rng.random(shape[1:]) < 0.5
+        med = ut.temporal_median(cube, pixmask, maxmem=1)
+        np.testing.assert_allclose(med[pixmask], med_ref[pixmask], rtol=1e-6 if dtype == np.float32 else 0., atol=0.)
+        assert np.all(np.isnan(med[np.logical_not(pixmask)]))
+
+def make_calints(fitsfile,
+                 seed=10):
+    
+    # Make a calints-like FITS file with extensions which are not touched by
+    # spaceKLIP.
+    rng = np.random.default_rng(seed)
+    hdul = pyfits.HDUList([pyfits.PrimaryHDU()])
+    hdul[0].header['TELESCOP'] = 'JWST'
+    hdul[0].header['INSTRUME'] = 'NIRCAM'
+    hdul.append(pyfits.ImageHDU(rng.normal(size=(3, 8, 9)).astype(np.float32), name='SCI'))
+    hdul['SCI'].header['BUNIT'] = 'MJy/sr'
+    hdul.append(pyfits.ImageHDU(rng.uniform(size=(3, 8, 9)).astype(np.float32), name='ERR'))
+    hdul.append(pyfits.ImageHDU(rng.integers(0, 2**31, size=(3, 8, 9)).astype(np.uint32), name='DQ'))
+    hdul.append(pyfits.ImageHDU(rng.uniform(size=(3, 8, 9)).astype(np.float32), name='VAR_POISSON'))
+    hdul.append(pyfits.ImageHDU(rng.uniform(size=(3, 8, 9)).astype(np.float32), name='VAR_RNOISE'))
+    hdul.append(pyfits.ImageHDU(rng.uniform(size=(8, 9)).astype(np.float32), name='AREA'))
+    hdul.append(pyfits.BinTableHDU.from_columns([pyfits.Column(name='ASDF_METADATA', format='20B', array=rng.integers(0, 256, size=(1, 20)))], name='ASDF'))
+    hdul.writeto(fitsfile)
+    
+    pass
+
+def test_read_obs(tmp_path):
+    
+    # The memory-mapped and extension-selective readers must return the
+    # same data as the FITS file.
+    fitsfile = os.path.join(str(tmp_path), 'a_calints.fits')
+    make_calints(fitsfile)
+    for memmap in [None, True, False]:
+        data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs, var_poisson, var_rnoise = ut.read_obs(fitsfile, return_var=True, memmap=memmap)
+        for ext, arr in [('SCI', data), ('ERR', erro), ('DQ', pxdq), ('VAR_POISSON', var_poisson), ('VAR_RNOISE', var_rnoise)]:
+            ref = pyfits.getdata(fitsfile, ext)
+            assert arr.dtype == ref.dtype
+            np.testing.assert_array_equal(arr, ref)
+        assert head_sci['BUNIT'] == 'MJy/sr'
+        assert not is2d and imshifts is None and maskoffs is None
+        sci, dq, maskoffs = ut.read_ext(fitsfile, ['SCI', 'DQ', 'MASKOFFS'], memmap=memmap)
+        np.testing.assert_array_equal(sci, data)
+        np.testing.assert_array_equal(dq, pxdq)
+        assert maskoffs is None
+    
+    # The cached header reader notices modified files.
+    assert ut.get_header(fitsfile)['BUNIT'] == 'MJy/sr'
+    with pyfits.open(fitsfile, mode='update') as hdul:
+        hdul['SCI'].header['BUNIT'] = 'DN/s'
+        hdul['SCI'].header['HISTORY'] = 'Changed the data unit so that the file size changes.' * 50
+    assert ut.get_header(fitsfile)['BUNIT'] == 'DN/s'
+
+def ext_bytes(fitsfile,
+              extname):
+    
+    # Get the raw header and data bytes of a FITS file extension.
+    with pyfits.open(fitsfile) as hdul, open(fitsfile, 'rb') as f:
+        fileinfo = hdul.fileinfo(hdul.index_of(extname))
+        f.seek(fileinfo['hdrLoc'])
+        
+        return f.read(fileinfo['datLoc'] + fileinfo['datSpan'] - fileinfo['hdrLoc'])
+
+def write_obs_reopen(fitsfile,
+                     output_dir,
+                     data,
+                     erro,
+                     pxdq,
+                     head_pri,
+                     head_sci,
+                     imshifts):
+    
+    # Previous implementation which reopened and re-serialized the input
+    # FITS file.
+    hdul = pyfits.open(fitsfile)
+    hdul['SCI'].data = data
+    hdul['ERR'].data = erro
+    hdul['DQ'].data = pxdq
+    hdul[0].header = head_pri
+    hdul['SCI'].header = head_sci
+    hdul.append(pyfits.ImageHDU(imshifts, name='IMSHIFTS'))
+    fitsfile = os.path.join(output_dir, os.path.split(fitsfile)[1])
+    hdul.writeto(fitsfile, output_verify='fix', overwrite=True)
+    hdul.close()
+    
+    return fitsfile
+
+def test_write_obs(tmp_path):
+    
+    # The streamed FITS file must contain the same data and headers as the
+    # previous implementation and the untouched extensions byte-for-byte.
+    fitsfile = os.path.join(str(tmp_path), 'a_calints.fits')
+    make_calints(fitsfile)
+    for subdir in ['new', 'old']:
+        os.makedirs(os.path.join(str(tmp_path), subdir))
+    data, erro, pxdq, head_pri, head_sci, is2d, imshifts, maskoffs = ut.read_obs(fitsfile, memmap=False)
+    data = data[:, 1:-1, 1:-1] * 2.
+    erro = erro[:, 1:-1, 1:-1]
+    pxdq = pxdq[:, 1:-1, 1:-1]
+    head_pri['HISTORY'] = 'spaceKLIP'
+    imshifts = np.ones((data.shape[0], 2))
+    new = ut.write_obs(fitsfile, os.path.join(str(tmp_path), 'new'), data, erro, pxdq, head_pri, head_sci, is2d, imshifts=imshifts)
+    old = write_obs_reopen(fitsfile, os.path.join(str(tmp_path), 'old'), data, erro, pxdq, head_pri, head_sci, imshifts)
+    with pyfits.open(new) as hdul_new, pyfits.open(old) as hdul_old:
+        assert sorted([hdu.name for hdu in hdul_new]) == sorted([hdu.name for hdu in hdul_old])
+        assert hdul_new[0].header['HISTORY'] == hdul_old[0].header['HISTORY']
+        assert hdul_new['SCI'].header['BUNIT'] == hdul_old['SCI'].header['BUNIT']
+        for hdu in hdul_old[1:]:
+            assert hdul_new[hdu.name].data.dtype == hdu.data.dtype
+            np.testing.assert_array_equal(hdul_new[hdu.name].data, hdu.data)
+    for ext in ['VAR_POISSON', 'VAR_RNOISE', 'AREA', 'ASDF']:
+        assert ext_bytes(new, ext) == ext_bytes(fitsfile, ext)
+    
+    # The input FITS file can be overwritten and 2D data stay 2D.
+    out = ut.write_obs(fitsfile, str(tmp_path), data[:1], erro[:1], pxdq[:1], head_pri, head_sci, True, output_verify='ignore')
+    assert out == fitsfile
+    data_2d, erro_2d, pxdq_2d, head_pri_2d, head_sci_2d, is2d_2d, imshifts_2d, maskoffs_2d = ut.read_obs(fitsfile)
+    assert is2d_2d and pyfits.getdata(fitsfile, 'SCI').ndim == 2
+    np.testing.assert_array_equal(data_2d, data[:1])
+    np.testing.assert_array_equal(pxdq_2d, pxdq[:1])
+    assert ext_bytes(fitsfile, 'ASDF') == ext_bytes(new, 'ASDF')
+    assert not os.path.exists(fitsfile + '.temp')